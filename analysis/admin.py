@@ -3,12 +3,26 @@ from django.contrib import admin
 # Register your models here.
 # File: analysis/admin.py
 from django.contrib import admin
-from .models import AnalysisParameters
+from .models import AnalysisParameters, RegionLayers, TileLayer
 
 class AnalysisParametersAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created_at', 'latitude', 'longitude', 'buffer_radius', 'mean_suitability')
-    list_filter = ('created_at',)
+    list_display = ('id', 'created_at', 'status', 'latitude', 'longitude', 'buffer_radius', 'mean_suitability')
+    list_filter = ('status', 'created_at')
     search_fields = ('id', 'latitude', 'longitude')
-    readonly_fields = ('id', 'created_at')
+    readonly_fields = ('id', 'created_at', 'started_at', 'finished_at')
 
-admin.site.register(AnalysisParameters, AnalysisParametersAdmin)
\ No newline at end of file
+admin.site.register(AnalysisParameters, AnalysisParametersAdmin)
+
+class RegionLayersAdmin(admin.ModelAdmin):
+    list_display = ('region_hash', 'latitude', 'longitude', 'buffer_radius', 'created_at', 'last_used_at')
+    search_fields = ('region_hash', 'latitude', 'longitude')
+    readonly_fields = ('region_hash', 'created_at', 'last_used_at')
+
+admin.site.register(RegionLayers, RegionLayersAdmin)
+
+class TileLayerAdmin(admin.ModelAdmin):
+    list_display = ('key', 'created_at', 'pyramid', 'pyramid_error')
+    search_fields = ('key',)
+    readonly_fields = ('key', 'created_at', 'pyramid', 'pyramid_error')
+
+admin.site.register(TileLayer, TileLayerAdmin)
\ No newline at end of file
@@ -0,0 +1,264 @@
+# File: analysis/artifacts.py
+"""Disk budget for the map files under static/maps.
+
+Every analysis writes its suitability map to static/maps/<id>/ and the
+criterion maps of a region are shared in static/maps/regions/<hash>/ (see
+RegionLayers). Maps are only needed while an analysis is viewed: all its
+parameters are stored, so they can be rendered again.
+
+When the directories exceed settings.ARTIFACT_MAX_BYTES, whole directories
+are evicted, least recently viewed first. Evicted map URLs are cleared from
+every analysis and region referencing them (analyses that reused a cached
+result point at another analysis' maps), and the results page renders them
+again when an analysis is next opened (see restore_missing_maps). Natura
+2000 overlay files are small and shared by every map, so they are counted
+but never evicted. Compressed copies (see compression.py) and tile pyramids
+(see pyramids.py) live next to their map and are counted and evicted with it.
+"""
+import os
+import shutil
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import AnalysisParameters, RegionLayers, TileLayer
+from .result_cache import region_hash
+
+STATIC_URL_PREFIX = '/static/maps/'
+REGIONS_DIR = 'regions'
+OVERLAYS_DIR = 'natura'
+PRUNE_LOCK_KEY = 'analysis:artifacts:prune'
+
+MAP_FIELDS = [field.name for field in AnalysisParameters._meta.fields if field.name.endswith('_map')]
+REGION_MAP_FIELDS = [field.name for field in RegionLayers._meta.fields if field.name.endswith('_map')]
+
+# kind is 'analysis' or 'region'; last_used is None for directories nothing refers to.
+# Protected directories belong to running jobs or were written too recently to evict.
+Artifact = namedtuple('Artifact', ['kind', 'key', 'path', 'url_prefix', 'size', 'last_used', 'protected'])
+
+
+def artifact_root():
+    """Return the directory holding the generated map files."""
+    return os.path.join(settings.BASE_DIR, 'static', 'maps')
+
+
+def url_path(map_url):
+    """Return the file of a map URL, or None for URLs outside static/maps."""
+    if not map_url or not map_url.startswith(STATIC_URL_PREFIX):
+        return None
+    return os.path.join(artifact_root(), *map_url[len(STATIC_URL_PREFIX):].split('/'))
+
+
+def served_url(map_url):
+    """Return the URL of the map_file view serving a map, for URLs inside static/maps.
+
+    The view sends the precompressed copy the browser accepts (see compression.py)
+    with long-lived cache headers, since every map file has a unique name.
+    """
+    if not map_url or not map_url.startswith(STATIC_URL_PREFIX):
+        return map_url
+    return reverse('analysis:map_file', args=[map_url[len(STATIC_URL_PREFIX):]])
+
+
+def _tree_size(path):
+    """Return (bytes, newest modification time) of the files below a directory."""
+    size, newest = 0, os.path.getmtime(path)
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            newest = max(newest, stat.st_mtime)
+    return size, newest
+
+
+def _directory_key(map_url):
+    # '/static/maps/<id>/x.json' -> ('analysis', id), '/static/maps/regions/<hash>/x.json' -> ('region', hash)
+    parts = map_url[len(STATIC_URL_PREFIX):].split('/')
+    if parts[0] == REGIONS_DIR and len(parts) > 2:
+        return 'region', parts[1]
+    if len(parts) > 1 and parts[0] != OVERLAYS_DIR:
+        return 'analysis', parts[0]
+    return None
+
+
+def _latest(a, b):
+    return b if a is None or (b is not None and b > a) else a
+
+
+def scan():
+    """List the evictable map directories.
+
+    Returns:
+        Tuple of (list of Artifact, bytes in overlays and other files that are never evicted)
+    """
+    root = artifact_root()
+    if not os.path.isdir(root):
+        return [], 0
+
+    # Last use of each directory: the latest view of any analysis referring to it
+    last_used = {}
+    running = set()
+    rows = AnalysisParameters.objects.values_list('id', 'status', 'last_viewed_at', 'finished_at', 'created_at',
+                                                  *MAP_FIELDS)
+    for analysis_id, status, viewed_at, finished_at, created_at, *map_urls in rows:
+        if status in (AnalysisParameters.STATUS_QUEUED, AnalysisParameters.STATUS_RUNNING):
+            running.add(str(analysis_id))
+        used_at = viewed_at or finished_at or created_at
+        for map_url in map_urls:
+            key = _directory_key(map_url) if map_url and map_url.startswith(STATIC_URL_PREFIX) else None
+            if key is not None:
+                last_used[key] = _latest(last_used.get(key), used_at)
+    for key, used_at in RegionLayers.objects.values_list('region_hash', 'last_used_at'):
+        last_used[('region', key)] = _latest(last_used.get(('region', key)), used_at)
+
+    min_age = getattr(settings, 'ARTIFACT_MIN_AGE', 10 * 60)
+    now = time.time()
+    artifacts = []
+    kept_bytes = 0
+
+    def _add(kind, key, path, url_prefix):
+        size, newest = _tree_size(path)
+        protected = (kind == 'analysis' and key in running) or now - newest < min_age
+        artifacts.append(Artifact(kind, key, path, url_prefix, size, last_used.get((kind, key)), protected))
+
+    for entry in os.scandir(root):
+        if entry.name == REGIONS_DIR and entry.is_dir():
+            for region in os.scandir(entry.path):
+                if region.is_dir():
+                    _add('region', region.name, region.path, f"{STATIC_URL_PREFIX}{REGIONS_DIR}/{region.name}/")
+        elif entry.is_dir() and entry.name != OVERLAYS_DIR:
+            _add('analysis', entry.name, entry.path, f"{STATIC_URL_PREFIX}{entry.name}/")
+        elif entry.is_dir():
+            kept_bytes += _tree_size(entry.path)[0]
+        else:
+            kept_bytes += entry.stat().st_size
+    return artifacts, kept_bytes
+
+
+def usage():
+    """Return the disk usage of the map files by kind, with the configured budget."""
+    artifacts, kept_bytes = scan()
+    report = {
+        'budget_bytes': getattr(settings, 'ARTIFACT_MAX_BYTES', None),
+        'total_bytes': kept_bytes + sum(artifact.size for artifact in artifacts),
+        'overlay_bytes': kept_bytes,
+        'unreferenced': sum(1 for artifact in artifacts if artifact.last_used is None),
+        'protected': sum(1 for artifact in artifacts if artifact.protected),
+    }
+    for kind in ('analysis', 'region'):
+        of_kind = [artifact for artifact in artifacts if artifact.kind == kind]
+        report[kind] = {'count': len(of_kind), 'bytes': sum(artifact.size for artifact in of_kind)}
+    return report
+
+
+def evict(artifact):
+    """Delete a map directory and clear every map URL and tile pyramid pointing into it."""
+    for field in MAP_FIELDS:
+        AnalysisParameters.objects.filter(**{field + '__startswith': artifact.url_prefix}).update(**{field: None})
+    if artifact.kind == 'region':
+        RegionLayers.objects.filter(region_hash=artifact.key).update(**{field: None for field in REGION_MAP_FIELDS})
+    # Pyramids are stored relative to static/maps; their layers are served upstream again
+    # until the pyramids are rebuilt
+    TileLayer.objects.filter(pyramid__startswith=os.path.relpath(artifact.path, artifact_root()) + os.sep).update(
+        pyramid=None, pyramid_error=None)
+    shutil.rmtree(artifact.path, ignore_errors=True)
+
+
+def prune(max_bytes=None, dry_run=False):
+    """Evict the least recently used map directories until the files fit the budget.
+
+    Directories nothing refers to go first.
+
+    Args:
+        max_bytes: Budget in bytes (defaults to settings.ARTIFACT_MAX_BYTES)
+        dry_run: Only return what would be evicted
+
+    Returns:
+        Tuple of (list of evicted Artifact, total bytes afterwards)
+    """
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'ARTIFACT_MAX_BYTES', None)
+    artifacts, kept_bytes = scan()
+    total = kept_bytes + sum(artifact.size for artifact in artifacts)
+    if max_bytes is None:
+        return [], total
+
+    candidates = sorted((artifact for artifact in artifacts if not artifact.protected),
+                        key=lambda artifact: artifact.last_used.timestamp() if artifact.last_used else float('-inf'))
+    evicted = []
+    for artifact in candidates:
+        if total <= max_bytes:
+            break
+        if not dry_run:
+            evict(artifact)
+        total -= artifact.size
+        evicted.append(artifact)
+    return evicted, total
+
+
+def maybe_prune():
+    """Prune to the budget, at most once per settings.ARTIFACT_PRUNE_INTERVAL across processes.
+
+    Walking static/maps takes a while once it holds many analyses, so
+    finished jobs call this instead of prune.
+    """
+    if getattr(settings, 'ARTIFACT_MAX_BYTES', None) is None:
+        return []
+    # add() only succeeds for the first caller until the key expires
+    if not cache.add(PRUNE_LOCK_KEY, True, timeout=getattr(settings, 'ARTIFACT_PRUNE_INTERVAL', 5 * 60)):
+        return []
+    evicted, _ = prune()
+    return evicted
+
+
+def touch(params):
+    """Record that an analysis was viewed, along with its region's shared maps.
+
+    Views within settings.ARTIFACT_VIEW_RESOLUTION of the last recorded one
+    are not written, so opening results does not write to the database every time.
+    """
+    now = timezone.now()
+    resolution = timedelta(seconds=getattr(settings, 'ARTIFACT_VIEW_RESOLUTION', 60 * 60))
+    if params.last_viewed_at is not None and now - params.last_viewed_at < resolution:
+        return
+    AnalysisParameters.objects.filter(id=params.id).update(last_viewed_at=now)
+    params.last_viewed_at = now
+    # update() bypasses auto_now, so the time is passed explicitly
+    RegionLayers.objects.filter(region_hash=region_hash(params)).update(last_used_at=now)
+
+
+def restore_missing_maps(params):
+    """Clear the map URLs of a finished analysis whose files are gone and queue it to render them again.
+
+    Criterion maps are rendered on first view when settings.ANALYSIS_LAZY_LAYERS
+    is set, so then only a missing suitability map needs the analysis to run again.
+
+    Returns:
+        True if the analysis was queued
+    """
+    from .jobs import enqueue_analysis
+
+    missing = [field for field in MAP_FIELDS
+               if getattr(params, field) and url_path(getattr(params, field))
+               and not os.path.exists(url_path(getattr(params, field)))]
+    for field in missing:
+        setattr(params, field, None)
+    if missing:
+        params.save(update_fields=missing)
+
+    if getattr(settings, 'ANALYSIS_LAZY_LAYERS', False):
+        complete = bool(params.suitability_map)
+    else:
+        complete = all(getattr(params, field) for field in MAP_FIELDS)
+    if complete:
+        return False
+    enqueue_analysis(params)
+    return True
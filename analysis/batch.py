@@ -0,0 +1,472 @@
+# File: analysis/batch.py
+"""Batch suitability screening of many candidate sites.
+
+Sites share one set of weights and thresholds. By default no maps are
+rendered: statistics come from the local scoring engine, and sites whose
+regions overlap are downloaded from Earth Engine together as one covering
+raster that each site crops from.
+"""
+import csv
+import io
+import json
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .forms import AnalysisForm
+from .models import AnalysisParameters, BatchJob
+from .raster_engine import (COMBINATIONS, DEFAULT_SCALE, STACK_BANDS, RasterGrid, combination_codes,
+                            compact_stack, fetch_criterion_stack, pixel_area_km2, region_grid, rescore,
+                            stats_from_counts, thresholds_from_params, weights_from_params)
+from .result_cache import params_hash, region_hash
+
+# Statistics columns copied from the scoring results, and all columns written for every site
+STAT_FIELDS = [
+    'mean_suitability', 'min_suitability', 'max_suitability', 'pixel_count',
+    'percent_above_50', 'percent_above_75', 'area_above_50_km2', 'area_above_75_km2'
+]
+OUTPUT_FIELDS = ['name', 'latitude', 'longitude', 'buffer_radius'] + STAT_FIELDS + ['analysis_id', 'error']
+
+# Mean Earth radius used for the circular site mask
+EARTH_RADIUS_M = 6371008.8
+
+
+def default_parameters():
+    """Return the analysis form's default values for every field."""
+    form = AnalysisForm()
+    return {name: field.initial for name, field in form.fields.items()}
+
+
+def load_sites(path):
+    """Read candidate sites from a CSV or JSON file.
+
+    CSV files need latitude and longitude columns and may have name and
+    buffer_radius columns. JSON files hold a list of objects with the same
+    keys, or an object with a 'sites' list.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        return parse_sites(f.read(), 'json' if path.lower().endswith('.json') else 'csv')
+
+
+def parse_sites(content, fmt):
+    """Parse sites from CSV or JSON text, see load_sites."""
+    if fmt == 'json':
+        data = json.loads(content)
+        sites = data.get('sites', []) if isinstance(data, dict) else data
+    else:
+        sites = list(csv.DictReader(io.StringIO(content)))
+    if not isinstance(sites, list):
+        raise ValueError("Sites must be a list")
+    return sites
+
+
+def prepare_batch(sites, shared=None):
+    """Validate the sites and shared parameters of a batch before it runs.
+
+    Individual sites are validated with the analysis form when the batch
+    runs, and an invalid site only fails its own row. Shared parameters
+    apply to every site, so an invalid value fails the whole batch here.
+
+    Args:
+        sites: List of site dictionaries (see load_sites)
+        shared: Weights, thresholds and default buffer_radius as form field names
+
+    Returns:
+        The shared parameters completed with the form defaults
+
+    Raises:
+        ValueError: If a site is not an object or a shared parameter is unknown or invalid
+    """
+    if shared is None:
+        shared = {}
+    if not isinstance(shared, dict):
+        raise ValueError("Parameters must be an object of weight_*/threshold_* values")
+    allowed = set(AnalysisForm.Meta.fields) - {'latitude', 'longitude'}
+    unknown = sorted(set(shared) - allowed)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(unknown)}")
+    for index, site in enumerate(sites):
+        if not isinstance(site, dict):
+            raise ValueError(f"Site {index + 1} must be an object with latitude and longitude")
+
+    shared = {**default_parameters(), **shared}
+    form = AnalysisForm(shared)
+    errors = {field: messages for field, messages in form.errors.items() if field in allowed}
+    if errors:
+        raise ValueError('; '.join(f"{field}: {' '.join(messages)}" for field, messages in errors.items()))
+    return shared
+
+
+def build_site_params(site, shared, index):
+    """Validate one site with the analysis form.
+
+    Args:
+        site: Dictionary with latitude, longitude and optionally name and buffer_radius
+        shared: Weights, thresholds and default buffer_radius shared by all sites
+        index: Position of the site, used as its default name
+
+    Returns:
+        Tuple of (site name, unsaved AnalysisParameters or None, error message or None)
+    """
+    name = str(site.get('name') or site.get('id') or index + 1)
+    data = {**shared, **{key: value for key, value in site.items()
+                         if key in AnalysisForm.Meta.fields and value not in (None, '')}}
+    form = AnalysisForm(data)
+    if not form.is_valid():
+        errors = '; '.join(f"{field}: {' '.join(messages)}" for field, messages in form.errors.items())
+        return name, None, errors
+    return name, form.save(commit=False), None
+
+
+def circle_mask(grid, lat, lon, buffer_km):
+    """Boolean mask of the grid pixels whose centers lie within buffer_km of a point."""
+    lons, lats = grid.pixel_centers()
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    distance = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return distance <= buffer_km * 1000
+
+
+def union_grid(grids):
+    """Smallest grid covering several grids of the same pixel size.
+
+    region_grid aligns every grid to multiples of the pixel size, so the
+    covering grid contains each input grid exactly.
+    """
+    pixel_size = grids[0].pixel_size
+    west = min(g.x0 for g in grids)
+    north = max(g.y0 for g in grids)
+    east = max(g.x0 + g.width * pixel_size for g in grids)
+    south = min(g.y0 - g.height * pixel_size for g in grids)
+    return RasterGrid(
+        x0=west,
+        y0=north,
+        pixel_size=pixel_size,
+        width=int(round((east - west) / pixel_size)),
+        height=int(round((north - south) / pixel_size))
+    )
+
+
+def _overlaps(a, b):
+    return (a.x0 < b.x0 + b.width * b.pixel_size and b.x0 < a.x0 + a.width * a.pixel_size and
+            a.y0 - a.height * a.pixel_size < b.y0 and b.y0 - b.height * b.pixel_size < a.y0)
+
+
+def cluster_sites(entries, max_pixels):
+    """Group sites whose region grids overlap.
+
+    Args:
+        entries: List of (params, grid) tuples
+        max_pixels: Largest covering grid a cluster may grow to
+
+    Returns:
+        List of clusters, each a list of indices into entries
+    """
+    clusters = []
+    for i, (_, grid) in enumerate(entries):
+        merged = [c for c in clusters if any(_overlaps(grid, entries[j][1]) for j in c['members'])]
+        members = [i] + [j for c in merged for j in c['members']]
+        cover = union_grid([entries[j][1] for j in members])
+        if merged and cover.width * cover.height > max_pixels:
+            # Too large to download in one piece: keep the site on its own
+            clusters.append({'members': [i]})
+            continue
+        clusters = [c for c in clusters if c not in merged] + [{'members': members}]
+    return [sorted(c['members']) for c in clusters]
+
+
+class PixelBudget:
+    """Bounds the criterion raster pixels held in memory by concurrently scored clusters.
+
+    A downloaded cluster holds len(STACK_BANDS) float32 values per pixel,
+    so concurrent clusters wait until their pixels fit the budget. A
+    cluster larger than the whole budget runs on its own.
+    """
+
+    def __init__(self, max_pixels):
+        self.max_pixels = max_pixels
+        self.used = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, pixels):
+        pixels = min(pixels, self.max_pixels)
+        with self._condition:
+            self._condition.wait_for(lambda: self.used + pixels <= self.max_pixels)
+            self.used += pixels
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= pixels
+                self._condition.notify_all()
+
+
+_pixel_budget = None
+_pixel_budget_lock = threading.Lock()
+
+
+def get_pixel_budget():
+    """Return the process-wide budget of settings.BATCH_MAX_CONCURRENT_PIXELS, shared by all batches."""
+    global _pixel_budget
+    with _pixel_budget_lock:
+        if _pixel_budget is None:
+            _pixel_budget = PixelBudget(getattr(settings, 'BATCH_MAX_CONCURRENT_PIXELS', 8_000_000))
+        return _pixel_budget
+
+
+def _score_cluster(entries, members, weights, thresholds, scale):
+    """Score the sites of one cluster, downloading their shared region once.
+
+    Returns:
+        Dictionary of entry index -> statistics
+    """
+    regions = {region_hash(entries[i][0]) for i in members}
+    if len(regions) == 1:
+        # Identical regions use the raster store like any single analysis
+        stats = rescore(entries[members[0]][0], weights, thresholds, scale)
+        return {i: stats for i in members}
+
+    # Imported here so that batches of stored regions do not need Earth Engine
+    import ee
+
+    cover = union_grid([entries[i][1] for i in members])
+    bounds = ee.Geometry.Rectangle(
+        [cover.x0, cover.y0 - cover.height * cover.pixel_size, cover.x0 + cover.width * cover.pixel_size, cover.y0],
+        'EPSG:4326', False)
+    stack = fetch_criterion_stack(bounds, cover)
+
+    results = {}
+    for i in members:
+        params, grid = entries[i]
+        col = int(round((grid.x0 - cover.x0) / cover.pixel_size))
+        row = int(round((cover.y0 - grid.y0) / cover.pixel_size))
+        window = {name: stack[b, row:row + grid.height, col:col + grid.width]
+                  for b, name in enumerate(STACK_BANDS)}
+        window['valid'] = (window['valid'] > 0) & circle_mask(grid, params.latitude, params.longitude,
+                                                               params.buffer_radius)
+        codes = combination_codes(compact_stack(window), thresholds)
+        results[i] = stats_from_counts(np.bincount(codes, minlength=COMBINATIONS), weights,
+                                       pixel_area_km2(params.latitude, scale))
+    return results
+
+
+def _render_site(params):
+    """Run the full analysis with maps for one site and return its statistics."""
+    from .gee_utils import run_suitability_analysis
+
+    # Hashed like form submissions, so later identical analyses reuse the result
+    params.params_hash = params_hash(params)
+    params.status = AnalysisParameters.STATUS_RUNNING
+    params.started_at = timezone.now()
+    params.save()
+    results = run_suitability_analysis(params)
+    params.status = AnalysisParameters.STATUS_DONE if results.get('success') else AnalysisParameters.STATUS_FAILED
+    params.error_message = results.get('error_message')
+    params.finished_at = timezone.now()
+    params.save()
+    if not results.get('success'):
+        raise RuntimeError(results.get('error_message', 'Unknown error'))
+    return results['stats']
+
+
+def run_batch(sites, shared=None, render_maps=False, max_workers=None, scale=DEFAULT_SCALE, progress=None):
+    """Screen many sites with shared weights and thresholds.
+
+    Args:
+        sites: List of site dictionaries (see load_sites)
+        shared: Weights, thresholds and default buffer_radius as form field names;
+            missing values use the form defaults
+        render_maps: Run the full analysis with maps for every site and store it
+        max_workers: Maximum number of regions processed at once
+        scale: Pixel size in meters for local scoring
+        progress: Optional callable receiving (sites done, total sites)
+
+    Returns:
+        List of result rows with the OUTPUT_FIELDS keys, in input order
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, 'BATCH_MAX_WORKERS', 4)
+    shared = prepare_batch(sites, shared)
+
+    rows = []
+    entries = []
+    for index, site in enumerate(sites):
+        name, params, error = build_site_params(site, shared, index)
+        row = {field: None for field in OUTPUT_FIELDS}
+        row['name'] = name
+        row['error'] = error
+        if params is not None:
+            row.update(latitude=params.latitude, longitude=params.longitude, buffer_radius=params.buffer_radius)
+            entries.append((params, region_grid(params.latitude, params.longitude, params.buffer_radius, scale)))
+        else:
+            entries.append(None)
+        rows.append(row)
+
+    valid = [i for i, entry in enumerate(entries) if entry is not None]
+    done = [len(sites) - len(valid)]
+    lock = threading.Lock()
+
+    def _record(indices, stats_by_index=None, error=None):
+        with lock:
+            for i in indices:
+                if error is not None:
+                    rows[i]['error'] = error
+                else:
+                    stats = stats_by_index[i]
+                    for key in STAT_FIELDS:
+                        rows[i][key] = stats.get(key)
+            done[0] += len(indices)
+            if progress:
+                progress(done[0], len(sites))
+
+    def _run_cluster(members):
+        params = entries[members[0]][0]
+        cover = union_grid([entries[i][1] for i in members])
+        try:
+            with get_pixel_budget().reserve(cover.width * cover.height):
+                stats = _score_cluster(entries, members, weights_from_params(params),
+                                       thresholds_from_params(params), scale)
+            _record(members, stats)
+        except Exception as e:
+            print(f"Error in batch cluster: {e}")
+            _record(members, error=str(e))
+
+    def _run_rendered(i):
+        from django.db import close_old_connections
+        params = entries[i][0]
+        close_old_connections()
+        try:
+            stats = _render_site(params)
+            rows[i]['analysis_id'] = str(params.id)
+            _record([i], {i: stats})
+        except Exception as e:
+            rows[i]['analysis_id'] = str(params.id)
+            _record([i], error=str(e))
+        finally:
+            close_old_connections()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='batch') as pool:
+        if render_maps:
+            futures = [pool.submit(_run_rendered, i) for i in valid]
+        else:
+            max_pixels = getattr(settings, 'BATCH_MAX_SHARED_PIXELS', 4_000_000)
+            clusters = cluster_sites([entries[i] for i in valid], max_pixels)
+            futures = [pool.submit(_run_cluster, [valid[j] for j in c]) for c in clusters]
+        for future in futures:
+            future.result()
+
+    return rows
+
+
+def write_rows(rows, path, fields=OUTPUT_FIELDS):
+    """Write result rows to a CSV or JSON file, chosen by extension."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        f.write(format_rows(rows, 'json' if path.lower().endswith('.json') else 'csv', fields))
+
+
+def format_rows(rows, fmt, fields=OUTPUT_FIELDS):
+    """Serialize result rows as CSV or JSON text."""
+    if fmt == 'json':
+        return json.dumps(rows, indent=2)
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Return the process-wide job runner, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='batch-job')
+        return _executor
+
+
+def submit_batch(sites, shared=None, render_maps=False):
+    """Run a batch in the background and return its ID."""
+    return submit_job(lambda progress: run_batch(sites, shared, render_maps=render_maps, progress=progress),
+                      len(sites))
+
+
+def submit_job(run, total, fields=OUTPUT_FIELDS):
+    """Run a job producing result rows in the background and return its ID.
+
+    Job state is kept in the database (BatchJob) so any web process can
+    report it, and a job lost to a restart is reported as failed (see get_batch).
+
+    Args:
+        run: Callable receiving a progress callable (done, total) and returning the rows
+        total: Number of items the job processes
+        fields: Columns of the rows, used for CSV downloads
+    """
+    # Jobs are kept for settings.BATCH_RESULT_TIMEOUT seconds after their last update
+    expired = timezone.now() - timedelta(seconds=getattr(settings, 'BATCH_RESULT_TIMEOUT', 24 * 3600))
+    BatchJob.objects.filter(updated_at__lt=expired).delete()
+
+    job = BatchJob.objects.create(id=uuid.uuid4().hex, total=total, fields=list(fields))
+    batch_id = job.id
+
+    def _update(**values):
+        # update() bypasses auto_now, so the time is passed explicitly
+        BatchJob.objects.filter(id=batch_id).update(updated_at=timezone.now(), **values)
+
+    def _progress(done, total):
+        _update(status=BatchJob.STATUS_RUNNING, done=done)
+
+    def _run():
+        from django.db import close_old_connections
+        close_old_connections()
+        start = time.perf_counter()
+        result = {}
+        try:
+            _update(status=BatchJob.STATUS_RUNNING)
+            result = {'rows': run(_progress), 'status': BatchJob.STATUS_DONE}
+        except Exception as e:
+            print(f"Error in batch {batch_id}: {e}")
+            result = {'status': BatchJob.STATUS_FAILED, 'error': str(e)}
+        finally:
+            _update(elapsed_seconds=round(time.perf_counter() - start, 3), **result)
+            metrics.flush()
+            close_old_connections()
+
+    # Only start once the row is committed, otherwise the job may not see it
+    transaction.on_commit(lambda: _get_executor().submit(_run))
+    return batch_id
+
+
+def get_batch(batch_id):
+    """Return the state of a submitted batch as a dictionary, or None.
+
+    Jobs run in the process that submitted them. An unfinished job whose
+    state was not updated for settings.BATCH_JOB_TIMEOUT seconds lost that
+    process, e.g. to a restart, and is marked failed.
+    """
+    job = BatchJob.objects.filter(id=batch_id).first()
+    if job is None:
+        return None
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'BATCH_JOB_TIMEOUT', 60 * 60))
+    if not job.is_finished and job.updated_at < cutoff:
+        error = 'The batch was interrupted, e.g. by a server restart; submit it again'
+        if BatchJob.objects.filter(id=batch_id, updated_at__lt=cutoff).exclude(
+                status__in=[BatchJob.STATUS_DONE, BatchJob.STATUS_FAILED]).update(status=BatchJob.STATUS_FAILED,
+                                                                                 error=error):
+            job.status, job.error = BatchJob.STATUS_FAILED, error
+    return job.as_state()
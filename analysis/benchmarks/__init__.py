@@ -0,0 +1,2 @@
+# File: analysis/benchmarks/__init__.py
+"""Offline benchmarks of the analysis pipeline, run with ``python manage.py run_benchmarks``."""
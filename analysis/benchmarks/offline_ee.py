@@ -0,0 +1,183 @@
+# File: analysis/benchmarks/offline_ee.py
+"""Offline stand-in for the ``ee`` module used by the benchmarks.
+
+Every Earth Engine object is an Expression that records the calls made on
+it, like the client library builds a computation graph without contacting
+the server. Only the calls that are server round-trips (getInfo, getMapId,
+ee.data.computePixels) wait, for a simulated latency:
+
+    latency * jitter factor + seconds_per_km2 * area of the region involved
+
+so larger analysis regions take longer, as reductions over more pixels do
+on Earth Engine. Responses are canned but shaped like the real ones, so the
+code under benchmark runs unchanged. Round-trips are counted per kind,
+which tells regressions that add requests apart from slower machines.
+"""
+import math
+import random
+import threading
+import time
+
+import numpy as np
+
+# Simulated server behaviour, see configure()
+_config = {'latency': 0.05, 'jitter': 0.2, 'seconds_per_km2': 2e-5}
+_random = random.Random(0)
+_counts = {}
+_lock = threading.Lock()
+
+
+def configure(latency=0.05, jitter=0.2, seconds_per_km2=2e-5, seed=0):
+    """Set the simulated latency of round-trips.
+
+    Args:
+        latency: Mean fixed cost of one request in seconds
+        jitter: Relative spread of the fixed cost, e.g. 0.2 for +-20%
+        seconds_per_km2: Additional seconds per square kilometer of the region reduced
+        seed: Seed of the jitter, so runs are repeatable
+    """
+    _config.update(latency=latency, jitter=jitter, seconds_per_km2=seconds_per_km2)
+    _random.seed(seed)
+
+
+def request_counts():
+    """Return and reset the number of round-trips made per kind since the last call."""
+    with _lock:
+        counts = dict(_counts)
+        _counts.clear()
+    return counts
+
+
+def _round_trip(kind, area_km2=0):
+    with _lock:
+        _counts[kind] = _counts.get(kind, 0) + 1
+        factor = 1 + _random.uniform(-_config['jitter'], _config['jitter'])
+    time.sleep(max(0.0, _config['latency'] * factor + _config['seconds_per_km2'] * area_km2))
+
+
+class _TileFetcher:
+    def __init__(self, mapid):
+        self.url_format = f"https://earthengine.googleapis.com/v1/projects/offline/maps/{mapid}/tiles/{{z}}/{{x}}/{{y}}"
+
+
+class Expression:
+    """A node of a recorded computation: a name called or looked up on a parent node."""
+
+    def __init__(self, name, parent=None, args=(), kwargs=None, called=False):
+        self._name = name
+        self._parent = parent
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._called = called
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Expression(name, parent=self)
+
+    def __call__(self, *args, **kwargs):
+        return Expression(self._name, parent=self._parent, args=args, kwargs=kwargs, called=True)
+
+    def __repr__(self):
+        text = f"{self._parent!r}.{self._name}" if self._parent is not None else self._name
+        if self._called:
+            arguments = [repr(arg) for arg in self._args]
+            arguments += [f"{key}={value!r}" for key, value in sorted(self._kwargs.items())]
+            text += f"({', '.join(arguments)})"
+        return text
+
+    def _chain(self):
+        node = self
+        while node is not None:
+            yield node
+            node = node._parent
+
+    def _calls(self, name):
+        return [node for node in self._chain() if node._name == name and node._called]
+
+    def _circle(self):
+        """Return (lon, lat, radius in meters) of the first buffered point this expression refers to."""
+        for node in self._nodes():
+            parent = node._parent
+            if node._name == 'buffer' and node._called and parent is not None and parent._name == 'Point':
+                lon, lat = parent._args[0]
+                return lon, lat, node._args[0]
+        return None
+
+    def _nodes(self):
+        # Depth-first over the chain and every expression passed as an argument
+        for node in self._chain():
+            yield node
+            for value in list(node._args) + list(node._kwargs.values()):
+                for item in (value if isinstance(value, (list, tuple)) else [value]):
+                    if isinstance(item, Expression):
+                        yield from item._nodes()
+
+    def _area_km2(self):
+        circle = self._circle()
+        return math.pi * (circle[2] / 1000) ** 2 if circle else 0
+
+    def serialize(self):
+        return repr(self)
+
+    def getInfo(self):
+        if self._calls('coordinates'):
+            _round_trip('getInfo')
+            lon, lat, radius = self._circle() or (0, 0, 0)
+            dlat = radius / 111320
+            dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+            return [[[lon - dlon, lat - dlat], [lon + dlon, lat - dlat], [lon + dlon, lat + dlat],
+                     [lon - dlon, lat + dlat], [lon - dlon, lat - dlat]]]
+        if self._calls('reduceRegions'):
+            _round_trip('reduceRegions', self._area_km2())
+            return {'type': 'FeatureCollection', 'features': []}
+        if self._calls('reduceRegion'):
+            area = self._area_km2()
+            _round_trip('reduceRegion', area)
+            pixels = int(area * 100)
+            return {
+                'suitability_mean': 52.5, 'suitability_min': 0.0, 'suitability_max': 100.0,
+                'suitability_count': pixels, 'area_km2_sum': area,
+                'histogram_histogram': [[edge, pixels / 10] for edge in range(0, 100, 10)]
+            }
+        _round_trip('getInfo')
+        return {}
+
+    def getMapId(self, vis_params=None):
+        _round_trip('getMapId')
+        mapid = f"{abs(hash(repr(self))):x}"
+        return {'mapid': mapid, 'token': '', 'tile_fetcher': _TileFetcher(mapid)}
+
+
+class _Data:
+    @staticmethod
+    def computePixels(request):
+        grid = request['grid']['dimensions']
+        # 100 m pixels, the scale of local scoring
+        _round_trip('computePixels', grid['width'] * grid['height'] / 100)
+        return _Pixels((grid['height'], grid['width']))
+
+
+class _Pixels(dict):
+    """computePixels result: a zero array for every band name."""
+
+    def __init__(self, shape):
+        super().__init__()
+        self.shape = shape
+
+    def __missing__(self, key):
+        return np.zeros(self.shape, dtype=np.float32)
+
+
+data = _Data()
+
+
+def Initialize(*args, **kwargs):
+    """The offline stand-in needs no credentials."""
+
+
+def __getattr__(name):
+    # ee.Image, ee.Geometry, ee.Reducer, ... are all recorded expressions
+    if name.startswith('__'):
+        raise AttributeError(name)
+    return Expression(name)
@@ -0,0 +1,40 @@
+# File: analysis/benchmarks/offline_geemap.py
+"""Offline stand-in for ``geemap.foliumap`` used by the benchmarks.
+
+Map records the layers added to it and to_html writes a page of about the
+size geemap produces, so map rendering keeps its file write cost.
+"""
+
+# Size of a page written by geemap's to_html for one layer, colorbar and outline
+PAGE_BYTES = 150 * 1024
+
+
+class Map:
+    """Records layers instead of building a folium map."""
+
+    def __init__(self, *args, **kwargs):
+        self.layers = []
+
+    def centerObject(self, ee_object, zoom=None):
+        self.center = (ee_object, zoom)
+
+    def add_tile_layer(self, tiles=None, name=None, attribution=None, **kwargs):
+        self.layers.append(('tiles', name, tiles))
+
+    def add_geojson(self, data, layer_name=None, style=None, **kwargs):
+        self.layers.append(('geojson', layer_name, data))
+
+    def add_colorbar(self, vis_params=None, label=None, **kwargs):
+        self.layers.append(('colorbar', label, vis_params))
+
+    def add_legend(self, title=None, legend_dict=None, **kwargs):
+        self.layers.append(('legend', title, legend_dict))
+
+    def to_html(self, filename=None):
+        body = ''.join(f"<!-- {kind} {name}: {value!r} -->\n" for kind, name, value in self.layers)
+        html = f"<!DOCTYPE html><html><body>\n{body}"
+        html += ' ' * max(0, PAGE_BYTES - len(html)) + '</body></html>\n'
+        if filename is None:
+            return html
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(html)
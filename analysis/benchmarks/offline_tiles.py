@@ -0,0 +1,39 @@
+# File: analysis/benchmarks/offline_tiles.py
+"""Offline stand-in for the tile proxy's upstream used by the benchmarks.
+
+Set settings.TILE_UPSTREAM to 'analysis.benchmarks.offline_tiles.OfflineUpstream'
+to serve tiles without Earth Engine, e.g. when testing the proxy locally.
+Map IDs are requested as usual (from the offline ``ee`` stand-in when it is
+installed); each tile download waits for one simulated round-trip and
+returns a blank 256x256 PNG.
+"""
+import struct
+import zlib
+
+from ..tiles import EarthEngineUpstream
+from . import offline_ee
+
+TILE_SIZE = 256
+
+
+def _png(width, height):
+    """Return a transparent RGBA PNG."""
+    def _chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\x00' + b'\x00' * 4 * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + _chunk(b'IDAT', zlib.compress(rows))
+            + _chunk(b'IEND', b''))
+
+
+BLANK_TILE = _png(TILE_SIZE, TILE_SIZE)
+
+
+class OfflineUpstream(EarthEngineUpstream):
+    """Upstream whose tile downloads are simulated round-trips."""
+
+    def download(self, url):
+        offline_ee._round_trip('tile')
+        return BLANK_TILE
@@ -0,0 +1,487 @@
+# File: analysis/benchmarks/runner.py
+"""Benchmark scenarios for the analysis pipeline and the comparison with a stored baseline.
+
+Scenarios run against the offline Earth Engine stand-in (offline_ee.py, and
+offline_tiles.py for tile downloads through the tile proxy), so
+no network or credentials are needed and the simulated server latency is
+the same on every run. Each scenario is run for every buffer radius and
+concurrency level: sync scenarios from a thread pool, async views from one
+event loop, as an ASGI server would. Every run reports latency
+percentiles, throughput, the peak of traced Python memory and the number
+of Earth Engine round-trips per call.
+
+Output files go to a temporary directory and the database rows created by
+a run are deleted afterwards. Settings that change the amount of work
+(scoring engine, map format, lazy layers, data sources, tile proxy, cache) are pinned
+to BENCHMARK_SETTINGS so results compare across configurations.
+"""
+import asyncio
+import inspect
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.db import close_old_connections
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from . import offline_ee, offline_geemap
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+DEFAULT_RADII = [10, 25, 50]
+DEFAULT_CONCURRENCY = [1, 4]
+DEFAULT_ITERATIONS = 8
+# Worker processes of the tile_pyramid_workers scenario
+PYRAMID_WORKERS = 2
+
+BENCHMARK_SETTINGS = {
+    'ANALYSIS_SCORING_ENGINE': 'earthengine',
+    'ROAD_SOURCE': 'earthengine',
+    'NATURA_2000_SOURCE': 'earthengine',
+    'ANALYSIS_LAZY_LAYERS': False,
+    'ANALYSIS_MAP_FORMAT': 'html',
+    'ANALYSIS_MAP_WORKERS': 7,
+    'TILE_PROXY': True,
+    'TILE_UPSTREAM': 'analysis.benchmarks.offline_tiles.OfflineUpstream',
+    # A private cache, so no tile URL cached by the application is reused
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                           'LOCATION': 'analysis-benchmarks'}},
+}
+
+# Result fields compared with the baseline (larger is worse for all of them) and the
+# absolute difference below which a change is noise, e.g. in millisecond-long views
+COMPARED_FIELDS = {'p50_ms': 10, 'p90_ms': 20, 'peak_memory_kb': 512, 'ee_requests': 0}
+REQUEST_TOLERANCE = 0.1
+
+# Scenario name -> (function(context, radius, prepared), setup(context, radius) or None).
+# Coroutine functions are run on an event loop; setup runs before timing starts.
+SCENARIOS = {}
+
+
+def scenario(name, setup=None):
+    """Register a benchmark scenario under a name."""
+    def register(func):
+        SCENARIOS[name] = (func, setup)
+        return func
+    return register
+
+
+def install():
+    """Make ``import ee`` and ``import geemap.foliumap`` load the offline stand-ins.
+
+    Must be called before analysis.gee_utils is imported.
+    """
+    for name in ('analysis.gee_utils',):
+        module = sys.modules.get(name)
+        if module is not None and module.ee is not offline_ee:
+            raise RuntimeError(f"{name} was imported with the real Earth Engine client; "
+                               "install the offline stand-in first")
+    geemap = types.ModuleType('geemap')
+    geemap.foliumap = offline_geemap
+    sys.modules.update({'ee': offline_ee, 'geemap': geemap, 'geemap.foliumap': offline_geemap})
+
+
+class BenchmarkContext:
+    """State shared by the scenarios of one benchmark run."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.factory = RequestFactory()
+        self.analysis_ids = []
+        self._centers = itertools.count()
+        self._tiles = itertools.count()
+        self.started_at = timezone.now()
+        self.counters = None
+        self._pyramid_pool = None
+
+    def pyramid_pool(self):
+        """Return the pool of pyramid worker processes shared by the run, started on first use."""
+        from functools import partial
+
+        from ..pyramids import create_pool
+
+        if self._pyramid_pool is None:
+            self._pyramid_pool = create_pool(PYRAMID_WORKERS, setup=partial(_offline_worker, dict(offline_ee._config)))
+        return self._pyramid_pool
+
+    def save_counters(self):
+        """Remember the shared metric counters, which cleanup restores after the run."""
+        from .. import metrics
+        from ..models import MetricCounter
+
+        metrics.flush()
+        self.counters = dict(MetricCounter.objects.values_list('name', 'value'))
+
+    def center(self):
+        """Return a new region center, so no region map or tile URL is reused between calls."""
+        i = next(self._centers)
+        return round(45 + (i % 500) * 0.01, 4), round(2 + (i // 500) * 0.01, 4)
+
+    def tile(self):
+        """Return new tile coordinates (z, x, y), so no stored tile is reused between calls."""
+        i = next(self._tiles)
+        return 12, 2048 + i % 1024, 1024 + i // 1024
+
+    def new_analysis(self, radius, **values):
+        """Create an analysis with the form defaults around a new center."""
+        from ..batch import build_site_params, default_parameters
+
+        lat, lon = self.center()
+        site = {'latitude': lat, 'longitude': lon, 'buffer_radius': radius}
+        _, params, error = build_site_params(site, default_parameters(), 0)
+        if error:
+            raise ValueError(error)
+        for field, value in values.items():
+            setattr(params, field, value)
+        params.save()
+        self.analysis_ids.append(params.id)
+        return params
+
+    def cleanup(self):
+        from .. import metrics
+        from ..models import AnalysisParameters, MetricCounter, RegionLayers, TileLayer
+        from ..result_cache import region_hash
+
+        if self._pyramid_pool is not None:
+            self._pyramid_pool.shutdown()
+
+        analyses = AnalysisParameters.objects.filter(id__in=self.analysis_ids)
+        RegionLayers.objects.filter(region_hash__in=[region_hash(params) for params in analyses]).delete()
+        analyses.delete()
+        # Layers registered with the tile proxy during the run; offline expressions never match real ones
+        TileLayer.objects.filter(created_at__gte=self.started_at).delete()
+        # Counters live in the database, so the run's cache hits and misses are taken out again
+        metrics.flush()
+        if self.counters is not None:
+            MetricCounter.objects.exclude(name__in=self.counters).delete()
+            for name, value in self.counters.items():
+                MetricCounter.objects.filter(name=name).update(value=value)
+
+
+def _check_response(response):
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    if response['Content-Type'].startswith('application/json') and 'Content-Disposition' not in response:
+        data = json.loads(response.content)
+        if not data.get('success', True):
+            raise RuntimeError(data.get('error'))
+
+
+@scenario('analysis')
+def _analysis(context, radius, prepared):
+    from ..gee_utils import run_suitability_analysis
+    from ..progress import ProgressReporter
+
+    params = context.new_analysis(radius)
+    # A reporter without an analysis ID keeps the stage timings but emits no events
+    results = run_suitability_analysis(params, reporter=ProgressReporter())
+    if not results['success']:
+        raise RuntimeError(results['error_message'])
+
+
+@scenario('create_map')
+def _create_map(context, radius, prepared):
+    from .. import gee_utils
+
+    lat, lon = context.center()
+    region = gee_utils.create_region_of_interest(lat, lon, radius)
+    title, vis_params, landcover_legend = gee_utils.MAP_LAYERS['slope']
+    gee_utils.create_map(gee_utils.ee.Image('USGS/SRTMGL1_003'), region, vis_params, title,
+                         landcover_legend=landcover_legend, output_dir=context.output_dir)
+
+
+@scenario('preview_area')
+async def _preview_area(context, radius, prepared):
+    from .. import views
+
+    lat, lon = context.center()
+    request = context.factory.get('/preview/', {'latitude': lat, 'longitude': lon, 'buffer_radius': radius})
+    _check_response(await views.preview_area(request))
+
+
+@scenario('simple_preview')
+async def _simple_preview(context, radius, prepared):
+    from .. import views
+
+    lat, lon = context.center()
+    request = context.factory.get('/simple-preview/', {'latitude': lat, 'longitude': lon, 'buffer_radius': radius})
+    _check_response(await views.simple_preview(request))
+
+
+@scenario('preview_map')
+def _preview_map(context, radius, prepared):
+    from .. import views
+
+    lat, lon = context.center()
+    request = context.factory.get('/preview/map/', {'latitude': lat, 'longitude': lon, 'buffer_radius': radius})
+    _check_response(views.preview_map(request))
+
+
+def _tile_layer(context, radius):
+    from .. import gee_utils
+
+    lat, lon = context.center()
+    region = gee_utils.create_region_of_interest(lat, lon, radius)
+    _, vis_params, _ = gee_utils.MAP_LAYERS['slope']
+    tile_url = gee_utils.get_tile_url(gee_utils.ee.Image('USGS/SRTMGL1_003').clip(region), vis_params)
+    return tile_url.split('/')[-4]
+
+
+async def _get_tile(context, key, z, x, y):
+    from .. import views
+
+    response = await views.tile(context.factory.get(f'/tiles/{key}/{z}/{x}/{y}.png'), key, z, x, y)
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    response.close()
+
+
+@scenario('tile_proxy', setup=_tile_layer)
+async def _tile_proxy(context, radius, prepared):
+    # Every call fetches a tile the proxy has not stored yet
+    await _get_tile(context, prepared, *context.tile())
+
+
+def _stored_tile(context, radius):
+    from .. import tiles
+
+    key = _tile_layer(context, radius)
+    tiles.fetch_tile(key, 12, 2048, 1024)
+    return key
+
+
+@scenario('tile_proxy_cached', setup=_stored_tile)
+async def _tile_proxy_cached(context, radius, prepared):
+    # The setup stored the tile, so every call is served from disk
+    await _get_tile(context, prepared, 12, 2048, 1024)
+
+
+def _pyramid_analysis(context, radius):
+    """Create a finished analysis whose suitability layer is served through the tile proxy."""
+    from .. import gee_utils
+    from ..artifacts import artifact_root
+    from ..models import AnalysisParameters
+
+    params = context.new_analysis(radius, status=AnalysisParameters.STATUS_DONE)
+    region = gee_utils.create_region_of_interest(params.latitude, params.longitude, radius)
+    _, vis_params, _ = gee_utils.MAP_LAYERS['slope']
+    params.tile_urls = {'suitability': gee_utils.get_tile_url(gee_utils.ee.Image('USGS/SRTMGL1_003').clip(region),
+                                                              vis_params)}
+    params.suitability_map = f"/static/maps/{params.id}/map_suitability.json"
+    os.makedirs(os.path.join(artifact_root(), str(params.id)), exist_ok=True)
+    with open(os.path.join(artifact_root(), str(params.id), 'map_suitability.json'), 'w') as f:
+        f.write('{}')
+    params.save()
+    return params
+
+
+@scenario('tile_pyramid')
+def _tile_pyramid(context, radius, prepared):
+    from ..pyramids import build_pyramids
+
+    build_pyramids(_pyramid_analysis(context, radius), zooms=(7, 9), workers=1)
+
+
+def _offline_worker(config):
+    """Worker process setup: load the offline stand-ins before the worker imports Earth Engine."""
+    install()
+    offline_ee.configure(**config)
+
+
+@scenario('tile_pyramid_workers', setup=lambda context, radius: context.pyramid_pool())
+def _tile_pyramid_workers(context, radius, prepared):
+    from ..pyramids import build_pyramids
+
+    # Tiles are fetched by spawned worker processes as with the default TILE_PYRAMID_WORKERS; their
+    # Earth Engine round-trips are not counted in ee_requests
+    build_pyramids(_pyramid_analysis(context, radius), zooms=(7, 9), pool=prepared)
+
+
+def _finished_analysis(context, radius):
+    from ..models import AnalysisParameters
+
+    return context.new_analysis(radius, status=AnalysisParameters.STATUS_DONE, mean_suitability=52.5,
+                                statistics={'mean_suitability': 52.5}, timings={'stages': {'score': 0.1}})
+
+
+@scenario('export_analysis', setup=_finished_analysis)
+async def _export_analysis(context, radius, prepared):
+    from .. import views
+
+    _check_response(await views.export_analysis(context.factory.get('/export/'), prepared.id))
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 2)
+
+
+def _run_sync(func, context, radius, prepared, iterations, concurrency):
+    def _call():
+        start = time.perf_counter()
+        try:
+            func(context, radius, prepared)
+        finally:
+            close_old_connections()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='benchmark') as pool:
+        return [future.result() for future in [pool.submit(_call) for _ in range(iterations)]]
+
+
+def _run_async(func, context, radius, prepared, iterations, concurrency):
+    async def _main():
+        slots = asyncio.Semaphore(concurrency)
+
+        async def _call():
+            async with slots:
+                start = time.perf_counter()
+                await func(context, radius, prepared)
+                return time.perf_counter() - start
+
+        return await asyncio.gather(*[_call() for _ in range(iterations)])
+
+    return asyncio.run(_main())
+
+
+def run_scenario(name, context, radius, concurrency, iterations):
+    """Run one scenario and return its result dictionary."""
+    func, setup = SCENARIOS[name]
+    run = _run_async if inspect.iscoroutinefunction(func) else _run_sync
+    prepared = setup(context, radius) if setup is not None else None
+
+    offline_ee.request_counts()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        latencies = run(func, context, radius, prepared, iterations, concurrency)
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    requests = offline_ee.request_counts()
+
+    return {
+        'scenario': name,
+        'radius_km': radius,
+        'concurrency': concurrency,
+        'iterations': iterations,
+        'p50_ms': _percentile(latencies, 50),
+        'p90_ms': _percentile(latencies, 90),
+        'p99_ms': _percentile(latencies, 99),
+        'max_ms': round(max(latencies) * 1000, 2),
+        'throughput_per_s': round(iterations / wall, 2),
+        'peak_memory_kb': round(peak / 1024),
+        'ee_requests': round(sum(requests.values()) / iterations, 2),
+        'ee_requests_by_kind': {kind: round(count / iterations, 2) for kind, count in sorted(requests.items())},
+    }
+
+
+def run_benchmarks(scenarios=None, radii=None, concurrency=None, iterations=DEFAULT_ITERATIONS,
+                   latency=0.05, seconds_per_km2=2e-5, progress=None):
+    """Run scenarios for every radius and concurrency level.
+
+    Args:
+        scenarios: Names of SCENARIOS to run, all by default
+        radii: Buffer radii in kilometers, DEFAULT_RADII by default
+        concurrency: Numbers of calls in flight, DEFAULT_CONCURRENCY by default
+        iterations: Calls per scenario, radius and concurrency level
+        latency: Simulated fixed latency of an Earth Engine round-trip in seconds
+        seconds_per_km2: Simulated additional latency per square kilometer reduced
+        progress: Optional callable receiving each result as it is measured
+
+    Returns:
+        Dictionary with the run 'config' and the list of 'results'
+    """
+    install()
+    scenarios = list(scenarios or SCENARIOS)
+    radii = list(radii or DEFAULT_RADII)
+    concurrency = list(concurrency or DEFAULT_CONCURRENCY)
+    offline_ee.configure(latency=latency, seconds_per_km2=seconds_per_km2)
+
+    config = {
+        'latency': latency,
+        'seconds_per_km2': seconds_per_km2,
+        'iterations': iterations,
+        'settings': {key: value for key, value in BENCHMARK_SETTINGS.items() if key != 'CACHES'},
+    }
+    results = []
+    output_dir = tempfile.mkdtemp(prefix='windfarm-benchmarks-')
+    context = BenchmarkContext(output_dir)
+    context.save_counters()
+    try:
+        with override_settings(BASE_DIR=output_dir, TILE_CACHE_DIR=os.path.join(output_dir, 'tile_cache'),
+                               **BENCHMARK_SETTINGS):
+            for name in scenarios:
+                # One untimed call first, so lazy imports and first-use caches are not measured
+                func, setup = SCENARIOS[name]
+                run = _run_async if inspect.iscoroutinefunction(func) else _run_sync
+                run(func, context, radii[0], setup(context, radii[0]) if setup is not None else None, 1, 1)
+                for radius in radii:
+                    for level in concurrency:
+                        result = run_scenario(name, context, radius, level, iterations)
+                        results.append(result)
+                        if progress is not None:
+                            progress(result)
+    finally:
+        context.cleanup()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    return {
+        'config': config,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def load_baseline(path=BASELINE_PATH):
+    """Return the stored baseline run, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(run, path=BASELINE_PATH):
+    """Store a benchmark run as the baseline."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(run, f, indent=2)
+        f.write('\n')
+
+
+def compare(run, baseline, tolerance=0.5):
+    """Compare a run with a baseline run.
+
+    Latencies and memory regress when they exceed the baseline by more than
+    the tolerance and the noise floor in COMPARED_FIELDS. Earth Engine round-trips do not depend on the machine and
+    regress beyond REQUEST_TOLERANCE, which only allows for concurrent calls
+    that both miss the tile URL cache.
+
+    Returns:
+        List of (scenario, radius_km, concurrency, field, baseline value, current value) regressions
+    """
+    if run['config'] != baseline['config']:
+        raise ValueError("The baseline was recorded with other benchmark options: "
+                         f"{json.dumps(baseline['config'], sort_keys=True)}")
+    previous = {(r['scenario'], r['radius_km'], r['concurrency']): r for r in baseline['results']}
+    regressions = []
+    for result in run['results']:
+        key = (result['scenario'], result['radius_km'], result['concurrency'])
+        if key not in previous:
+            continue
+        for field, noise in COMPARED_FIELDS.items():
+            relative = REQUEST_TOLERANCE if field == 'ee_requests' else tolerance
+            limit = max(previous[key][field] * (1 + relative), previous[key][field] + noise)
+            if result[field] > limit:
+                regressions.append(key + (field, previous[key][field], result[field]))
+    return regressions
@@ -0,0 +1,133 @@
+# File: analysis/compression.py
+"""Precompressed copies of the generated map files.
+
+Maps, layer specs and Natura 2000 overlays are written once and then served
+to every results page, so they are compressed once when written: a .gz copy,
+and a .br copy when the brotli package is installed. The map_file view picks
+the smallest copy the browser accepts (see negotiate).
+"""
+import gzip
+import os
+import shutil
+import threading
+
+from django.conf import settings
+
+from . import metrics
+
+# Content codings in order of preference with the suffix of their copy
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Files smaller than this are served as written
+MIN_SIZE = 1024
+
+CHUNK_SIZE = 64 * 1024
+
+# Files are written once and served many times, so the strongest gzip level is used.
+# Brotli's highest qualities are several times slower for a few percent, so 9 is used.
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+
+def _gzip_file(source, target):
+    # mtime=0 and no file name, so the same map always compresses to the same bytes
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL, fileobj=target, mtime=0) as f:
+        shutil.copyfileobj(source, f, CHUNK_SIZE)
+
+
+def _brotli_file(source, target):
+    # Optional: without it only .gz copies are written
+    import brotli
+
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+        target.write(compressor.process(chunk))
+    target.write(compressor.finish())
+
+
+def _compressors():
+    """Return (encoding, suffix, compress function) for every available content coding."""
+    compressors = {'gzip': _gzip_file}
+    try:
+        import brotli  # noqa: F401
+        compressors['br'] = _brotli_file
+    except ImportError:
+        pass
+    return [(encoding, suffix, compressors[encoding]) for encoding, suffix in ENCODINGS if encoding in compressors]
+
+
+def precompress(path):
+    """Write compressed copies of a map file next to it.
+
+    Files are compressed in chunks, since standalone HTML maps with
+    embedded overlays can be several megabytes. Each copy is written to a
+    temporary name and then moved into place, so a copy is either complete
+    or missing while a request reads it.
+
+    Args:
+        path: File to compress
+
+    Returns:
+        List of the content codings written
+    """
+    if not getattr(settings, 'MAP_PRECOMPRESS', True):
+        return []
+    size = os.path.getsize(path)
+    if size < MIN_SIZE:
+        return []
+
+    written = []
+    with metrics.timer('map.precompress'):
+        for encoding, suffix, compress in _compressors():
+            tmp_path = f"{path}{suffix}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(path, 'rb') as source, open(tmp_path, 'wb') as target:
+                compress(source, target)
+            # A copy that is not smaller is never worth serving
+            if os.path.getsize(tmp_path) >= size:
+                os.remove(tmp_path)
+                continue
+            os.replace(tmp_path, path + suffix)
+            written.append(encoding)
+    return written
+
+
+def accepted_encodings(header):
+    """Parse an Accept-Encoding header into a dictionary of content coding to q-value."""
+    accepted = {}
+    for part in (header or '').split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def negotiate(header, path):
+    """Choose the copy of a map file to send for an Accept-Encoding header.
+
+    Args:
+        header: Accept-Encoding request header
+        path: Uncompressed map file
+
+    Returns:
+        Tuple of (file to send, content coding or None for the file as written)
+    """
+    accepted = accepted_encodings(header)
+    candidates = []
+    for rank, (encoding, suffix) in enumerate(ENCODINGS):
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and os.path.exists(path + suffix):
+            candidates.append((-quality, rank, encoding, path + suffix))
+    if not candidates:
+        return path, None
+    _, _, encoding, compressed_path = min(candidates)
+    return compressed_path, encoding
@@ -0,0 +1,70 @@
+# File: analysis/executor.py
+"""Run blocking work from async views without tying up the event loop.
+
+Earth Engine calls (getInfo, getMapId) and file writes block the calling
+thread. Async views hand them to one bounded thread pool per process, so an
+ASGI worker serves many slow requests with a fixed number of threads.
+Earth Engine calls additionally wait for a per-project concurrency limit,
+so a burst of requests queues in the event loop instead of exceeding the
+project's request quota.
+"""
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+# Event loop -> {project: asyncio.Semaphore}; semaphores belong to the loop they wait on
+_limiters = weakref.WeakKeyDictionary()
+
+
+def get_executor():
+    """Return the process-wide pool for blocking work, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ASYNC_BLOCKING_WORKERS', 16),
+                                           thread_name_prefix='blocking-io')
+        return _executor
+
+
+def _call(func, args, kwargs):
+    # Pool threads outlive requests, so stale database connections are closed like in job workers
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking function in the bounded pool and return its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(_call, func, args, kwargs))
+
+
+def _limiter(project):
+    limiters = _limiters.setdefault(asyncio.get_running_loop(), {})
+    if project not in limiters:
+        limits = getattr(settings, 'EARTH_ENGINE_CONCURRENCY', {})
+        limiters[project] = asyncio.Semaphore(limits.get(project, limits.get('default', 8)))
+    return limiters[project]
+
+
+async def run_earth_engine(func, *args, project=None, **kwargs):
+    """Run a function making Earth Engine requests, within the project's concurrency limit.
+
+    Args:
+        func: Blocking function to call with args and kwargs
+        project: Earth Engine project the requests are billed to
+            (defaults to settings.EARTH_ENGINE_PROJECT)
+    """
+    if project is None:
+        project = getattr(settings, 'EARTH_ENGINE_PROJECT', None)
+    async with _limiter(project):
+        return await run_blocking(func, *args, **kwargs)
@@ -88,4 +88,20 @@ class AnalysisForm(forms.ModelForm):
         self.fields['threshold_natura'].widget.attrs.update({
             'class': 'form-range', 'min': 500, 'max': 10000, 'step': 500, 'type': 'range'
         })
-        self.fields['threshold_natura'].help_text = 'Minimum distance to Natura 2000 sites (m)'
\ No newline at end of file
+        self.fields['threshold_natura'].help_text = 'Minimum distance to Natura 2000 sites (m)'
+    
+    def _check_range(self, field, minimum, maximum):
+        """Enforce the widget's min/max on the server too; API clients skip the browser checks"""
+        value = self.cleaned_data[field]
+        if value is not None and not minimum <= value <= maximum:
+            raise forms.ValidationError(f'Must be between {minimum} and {maximum}.')
+        return value
+    
+    def clean_latitude(self):
+        return self._check_range('latitude', -90, 90)
+    
+    def clean_longitude(self):
+        return self._check_range('longitude', -180, 180)
+    
+    def clean_buffer_radius(self):
+        return self._check_range('buffer_radius', 5, 100)
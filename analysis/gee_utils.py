@@ -1,17 +1,123 @@
 # File: analysis/gee_utils.py
 import ee
 import geemap.foliumap as geemap
+import json
+import numpy as np
 import os
-import tempfile
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from . import compression, metrics, tile_cache, tiles
+from .artifacts import served_url
+from .models import RegionLayers
+from .natura import (NATURA_2000_ASSET, NATURA_MAX_DISTANCE, get_natura_source, natura_overlay_url,
+                     natura_sites_geojson)
+from .progress import STAGES, ProgressReporter
+from .raster_engine import (CRITERION_BANDS, HISTOGRAM_EDGES, STACK_BANDS, SUITABILITY_LEVELS, region_grid,
+                            score_params)
+from .result_cache import region_hash
+from .roads import ROAD_MAX_DISTANCE
 
 # Initialize Earth Engine (in a production app, you would need a service account)
 try:
-    ee.Initialize(project='ee-chmilew')
+    ee.Initialize(project=getattr(settings, 'EARTH_ENGINE_PROJECT', 'ee-chmilew'))
 except Exception as e:
     print(f"Error initializing Earth Engine: {e}")
 
+# Maps rendered for every analysis: result key -> (title, visualization parameters, landcover legend)
+MAP_LAYERS = {
+    'slope': (
+        'Slope (degrees)',
+        {'min': 0, 'max': 20, 'palette': ['green', 'yellow', 'red']},
+        False
+    ),
+    'elevation': (
+        'Elevation (m)',
+        {'min': 0, 'max': 500, 'palette': ['green', 'yellow', 'red']},
+        False
+    ),
+    'wind_speed': (
+        'Wind Speed (ms)',
+        {'min': 0, 'max': 5, 'palette': ['blue', 'cyan', 'green', 'yellow', 'red']},
+        False
+    ),
+    'roads': (
+        'Distance to Roads (m)',
+        {'min': 0, 'max': 1000, 'palette': ['green', 'yellow', 'red']},
+        False
+    ),
+    'landcover': (
+        'Land Cover',
+        {'min': 0, 'max': 200, 'palette': ['#282828', '#ffbb22', '#ffff4c', '#f096ff',
+                                          '#fa0000', '#b4b4b4', '#f0f0f0', '#0032c8',
+                                          '#0096a0', '#fae6a0', '#009900', '#000080']},
+        True
+    ),
+    'natura_2000': (
+        'Distance from Natura 2000 Sites (m)',
+        {'min': 0, 'max': 10000, 'palette': ['red', 'yellow', 'green']},
+        False
+    ),
+    'suitability': (
+        'Wind Farm Suitability (%)',
+        {'min': 0, 'max': 100, 'palette': ['red', 'yellow', 'green']},
+        False
+    ),
+}
+
+# Land cover classes shown in the legend of the land cover map
+LANDCOVER_LEGEND = {
+    "0: Unknown": "#282828",
+    "20: Shrubs": "#ffbb22",
+    "30: Herbaceous vegetation": "#ffff4c",
+    "40: Cultivated / Agriculture": "#f096ff",
+    "50: Urban / Built up": "#fa0000",
+    "60: Bare / Sparse vegetation": "#b4b4b4",
+    "70: Snow and Ice": "#f0f0f0",
+    "80: Permanent water bodies": "#0032c8",
+    "90: Herbaceous wetland": "#0096a0",
+    "100: Moss and lichen": "#fae6a0",
+    "111-126: Forest": "#009900",
+    "200: Oceans, seas": "#000080"
+}
+
+NATURA_2000_STYLE = {'color': '0000FF', 'fillColor': '0000FF80'}  # Blue with transparency
+# The same style for sites drawn from the local index as GeoJSON (Leaflet path options)
+NATURA_2000_GEOJSON_STYLE = {'color': '#0000FF', 'weight': 1, 'fillColor': '#0000FF', 'fillOpacity': 0.5}
+
+# File extension of the map files written in each ANALYSIS_MAP_FORMAT
+MAP_FORMAT_EXTENSIONS = {'html': '.html', 'json': '.json'}
+
+def get_map_format():
+    """Return the configured map format: standalone 'html' pages or 'json' layer specs."""
+    return getattr(settings, 'ANALYSIS_MAP_FORMAT', 'html')
+
+def is_current_map_format(map_url):
+    """True if a stored map URL was written in the configured map format."""
+    return bool(map_url) and map_url.endswith(MAP_FORMAT_EXTENSIONS[get_map_format()])
+
+def region_extent(lat, lon, buffer_km):
+    """Describe a circular region for the map viewer, which draws its outline."""
+    return {'center': [lat, lon], 'radius_m': buffer_km * 1000}
+
+def region_bounds(lat, lon, buffer_km):
+    """Return the bounding box (west, south, east, north) of a circular region in degrees."""
+    return region_grid(lat, lon, buffer_km).bounds
+
+def _geometry_bounds(region):
+    """Request the bounding box of an Earth Engine geometry."""
+    with metrics.timer('ee.geometry_bounds'):
+        coords = region.bounds().coordinates().getInfo()[0]
+    lons, lats = [c[0] for c in coords], [c[1] for c in coords]
+    return (min(lons), min(lats), max(lons), max(lats))
+
+def _map_filename(title, extension):
+    """Return a unique file name for a map of the given title."""
+    unique_id = uuid.uuid4().hex[:8]
+    safe_title = title.replace(' ', '_').replace('(', '').replace(')', '').replace('%', 'pct')
+    return f"map_{safe_title}_{unique_id}{extension}"
+
 def create_region_of_interest(lat, lon, buffer_km):
     """Convert a point and buffer into a circular region for analysis."""
     point = ee.Geometry.Point([lon, lat])
@@ -24,7 +130,20 @@ def calculate_wind_speed(image):
     v = image.select('v_component_of_wind_10m')
     return image.addBands(u.hypot(v).rename('wind_speed'))
 
-def create_map(image, region, vis_params, title, landcover_legend=False, output_dir=None):
+def get_tile_url(image, vis_params):
+    """Return the XYZ tile URL template of an image.
+    
+    With settings.TILE_PROXY the template points at the tile proxy, which
+    caches tiles on disk and outlives the Earth Engine map ID. Otherwise it
+    is the Earth Engine URL, reusing a cached map ID when possible.
+    """
+    if getattr(settings, 'TILE_PROXY', False):
+        return tiles.layer_tile_url(ee.Image(image), vis_params)
+    return tile_cache.get_map_id(ee.Image(image), vis_params)['tile_url']
+
+@metrics.timer('map.create_map')
+def create_map(image, region, vis_params, title, landcover_legend=False, output_dir=None, tile_url=None,
+               overlays=None):
     """Create an interactive map for a specific analysis layer.
     
     Args:
@@ -34,284 +153,684 @@ def create_map(image, region, vis_params, title, landcover_legend=False, output_
         title: Title for the map
         landcover_legend: Whether to add a landcover legend
         output_dir: Directory to save map HTML file
+        tile_url: Tile URL template from an earlier get_tile_url call, requested if omitted
+        overlays: List returned by get_overlays(inline=True), requested if omitted
         
     Returns:
         Map object and path to the saved HTML file
     """
+    if tile_url is None:
+        tile_url = get_tile_url(image, vis_params)
+    
     m = geemap.Map()
     m.centerObject(region, 9)
-    m.addLayer(image, vis_params, title)
+    m.add_tile_layer(tiles=tile_url, name=title, attribution='Google Earth Engine')
     
     # Add colorbar
     m.add_colorbar(vis_params=vis_params, label=title, orientation='horizontal', position='bottomright')
     
     # Add region boundary
+    # The outline and overlay are the same on every map of a region, so their tile URLs come from the cache
     empty = ee.Image().byte()
     outline = empty.paint(featureCollection=ee.FeatureCollection([ee.Feature(region)]), color=1, width=2)
-    m.addLayer(outline, {'palette': 'FF0000'}, 'Region Boundary')
+    m.add_tile_layer(tiles=get_tile_url(outline, {'palette': 'FF0000'}), name='Region Boundary',
+                     attribution='Google Earth Engine')
     
-    # Add Natura 2000 sites if available in the region
-    try:
-        natura_2000_sites = ee.FeatureCollection('projects/ee-chmilew/assets/sic')
-        natura_2000_region = natura_2000_sites.filterBounds(region)
-        sites_style = {'color': '0000FF', 'fillColor': '0000FF80'}  # Blue with transparency
-        m.addLayer(natura_2000_region.style(**sites_style), {}, 'Natura 2000 Sites')
-    except Exception as e:
-        print(f"Could not load Natura 2000 sites: {e}")
+    # Add Natura 2000 sites
+    if overlays is None:
+        overlays = get_overlays(region, inline=True)
+    for overlay in overlays:
+        if 'geojson' in overlay:
+            m.add_geojson(overlay['geojson'], layer_name=overlay['name'], style=overlay['style'])
+        else:
+            m.add_tile_layer(tiles=overlay['tile_url'], name=overlay['name'], attribution='Google Earth Engine')
     
     # Add a custom legend if the map is for land cover
     if landcover_legend:
-        legend_dict = {
-            "0: Unknown": "#282828",
-            "20: Shrubs": "#ffbb22",
-            "30: Herbaceous vegetation": "#ffff4c",
-            "40: Cultivated / Agriculture": "#f096ff",
-            "50: Urban / Built up": "#fa0000",
-            "60: Bare / Sparse vegetation": "#b4b4b4",
-            "70: Snow and Ice": "#f0f0f0",
-            "80: Permanent water bodies": "#0032c8",
-            "90: Herbaceous wetland": "#0096a0",
-            "100: Moss and lichen": "#fae6a0",
-            "111-126: Forest": "#009900",
-            "200: Oceans, seas": "#000080"
-        }
-        m.add_legend(title="Land Cover Categories", legend_dict=legend_dict, position='bottomleft')
+        m.add_legend(title="Land Cover Categories", legend_dict=LANDCOVER_LEGEND, position='bottomleft')
     
     # Save map to file if output_dir is provided
     map_path = None
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
-        unique_id = uuid.uuid4().hex[:8]
-        safe_title = title.replace(' ', '_').replace('(', '').replace(')', '').replace('%', 'pct')
-        map_path = os.path.join(output_dir, f"map_{safe_title}_{unique_id}.html")
-        m.to_html(map_path)
+        map_path = os.path.join(output_dir, _map_filename(title, '.html'))
+        with metrics.timer('map.to_html'):
+            m.to_html(map_path)
+        compression.precompress(map_path)
     
     return m, map_path
 
-def run_suitability_analysis(params):
-    """Perform the complete wind farm suitability analysis for a given region.
+def get_overlays(region, extent=None, inline=False):
+    """Return the reference overlays drawn on top of every layer of a region.
+    
+    With the local Natura 2000 source the sites come from the in-memory
+    index as GeoJSON, so no Earth Engine request is needed. The GeoJSON is
+    written once to a static file shared by every map of the region, or
+    embedded in the overlay when inline is set (standalone HTML maps).
     
     Args:
-        params: AnalysisParameters object containing all necessary parameters
+        region: Earth Engine geometry
+        extent: Dictionary returned by region_extent, saves a request for the region's bounds
+        inline: Embed GeoJSON overlays instead of referencing a static file
         
     Returns:
-        Dictionary with results and map paths
+        List of dictionaries with the overlay name and either a tile URL
+        template ('tile_url') or GeoJSON ('geojson_url' or 'geojson') with its 'style'
     """
-    # Extract parameters
-    lat = params.latitude
-    lon = params.longitude
-    buffer_radius = params.buffer_radius
-    
-    # Get all weights and thresholds
-    weight_slope = params.weight_slope
-    weight_elevation = params.weight_elevation
-    weight_wind = params.weight_wind
-    weight_roads = params.weight_roads
-    weight_landcover = params.weight_landcover
-    weight_natura = params.weight_natura
-    
-    threshold_slope = params.threshold_slope
-    threshold_elevation = params.threshold_elevation
-    threshold_wind = params.threshold_wind
-    threshold_roads = params.threshold_roads
-    threshold_natura = params.threshold_natura
-    
-    # Create temporary directory for map files
-    maps_output_dir = os.path.join(settings.BASE_DIR, 'static', 'maps', str(params.id))
+    if get_natura_source() != 'local':
+        sites = ee.FeatureCollection(NATURA_2000_ASSET).filterBounds(region)
+        return [{'name': 'Natura 2000 Sites', 'tile_url': get_tile_url(sites.style(**NATURA_2000_STYLE), {})}]
     
-    # Create region of interest
-    region = create_region_of_interest(lat, lon, buffer_radius)
+    if extent is not None:
+        bounds = region_bounds(extent['center'][0], extent['center'][1], extent['radius_m'] / 1000)
+    else:
+        bounds = _geometry_bounds(region)
+    overlay = {'name': 'Natura 2000 Sites', 'style': NATURA_2000_GEOJSON_STYLE}
+    if inline:
+        overlay['geojson'] = natura_sites_geojson(bounds)
+    else:
+        overlay['geojson_url'] = served_url(natura_overlay_url(bounds))
+    return [overlay]
+
+def create_layer_spec(vis_params, title, tile_url, extent, landcover_legend=False, overlays=(), output_dir=None):
+    """Describe a map layer for the shared map viewer instead of writing a full HTML page.
     
-    # Create maps directory
-    os.makedirs(maps_output_dir, exist_ok=True)
+    The spec holds only what differs between maps: the tile URL template,
+    visualization parameters and legend. The Leaflet page around it is the
+    static map viewer (analysis/static/analysis/js/map_viewer.js), which the
+    browser caches once for every map.
     
-    # Dictionary to store results
-    results = {
-        'maps': {},
-        'stats': {}
+    Args:
+        vis_params: Visualization parameters
+        title: Title for the map
+        tile_url: Tile URL template from get_tile_url
+        extent: Dictionary returned by region_extent
+        landcover_legend: Whether to add a landcover legend
+        overlays: List returned by get_overlays
+        output_dir: Directory to save the JSON file
+        
+    Returns:
+        Spec dictionary and path to the saved JSON file
+    """
+    spec = {
+        'title': title,
+        'tile_url': tile_url,
+        'attribution': 'Google Earth Engine',
+        'vis_params': vis_params,
+        'legend': {
+            'title': 'Land Cover Categories',
+            'entries': [[label, color] for label, color in LANDCOVER_LEGEND.items()]
+        } if landcover_legend else None,
+        'region': extent,
+        'overlays': list(overlays)
     }
     
-    try:
-        # Load elevation data
-        elevation = ee.Image('USGS/SRTMGL1_003').select('elevation').clip(region)
-        slope = ee.Terrain.slope(elevation)
-        
-        # Load wind speed data
-        wind_speed = ee.ImageCollection('ECMWF/ERA5/MONTHLY') \
-            .filter(ee.Filter.date('2018-01-01', '2021-01-01')) \
-            .map(calculate_wind_speed) \
-            .select('wind_speed') \
-            .mean() \
-            .clip(region)
-        
-        # Load urban areas and land cover data
-        urban_areas = ee.ImageCollection("COPERNICUS/Landcover/100m/Proba-V-C3/Global") \
-            .filter(ee.Filter.date('2019-01-01', '2020-01-01')) \
-            .first() \
-            .select('urban-coverfraction') \
-            .clip(region)
-        
-        urban_distance = urban_areas.gt(20).Not().cumulativeCost(ee.Image.constant(1), 10000).clip(region)
-        
-        landcover = ee.ImageCollection("COPERNICUS/Landcover/100m/Proba-V-C3/Global") \
-            .filter(ee.Filter.date('2019-01-01', '2020-01-01')) \
-            .first() \
-            .select('discrete_classification') \
-            .clip(region)
+    spec_path = None
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        spec_path = os.path.join(output_dir, _map_filename(title, '.json'))
+        with metrics.timer('map.write_spec'), open(spec_path, 'w', encoding='utf-8') as f:
+            json.dump(spec, f)
+        compression.precompress(spec_path)
+    
+    return spec, spec_path
+
+def road_distance_image(region, max_distance=ROAD_MAX_DISTANCE):
+    """Distance to the nearest road in meters, masked beyond max_distance.
+    
+    Only roads within max_distance of the region are rasterized, instead of
+    the whole collection. Local scoring reads the same distances from the
+    precomputed tiles in roads.py when they cover the region.
+    
+    Args:
+        region: Earth Engine geometry
+        max_distance: Maximum search distance in meters
         
-        # Load road data
-        roads = ee.FeatureCollection("TIGER/2016/Roads")
-        roads_raster = roads.map(lambda f: f.set('constant', 1)).reduceToImage(
-            properties=['constant'], reducer=ee.Reducer.first())
-        distance_to_roads = roads_raster.Not().cumulativeCost(
-            ee.Image.constant(1), maxDistance=500).clip(region)
+    Returns:
+        Earth Engine image clipped to the region
+    """
+    roads = ee.FeatureCollection("TIGER/2016/Roads").filterBounds(region.buffer(max_distance))
+    roads_raster = roads.map(lambda f: f.set('constant', 1)).reduceToImage(
+        properties=['constant'], reducer=ee.Reducer.first())
+    return roads_raster.Not().cumulativeCost(
+        ee.Image.constant(1), maxDistance=max_distance).clip(region)
+
+def natura_distance_image(region, bounds=None):
+    """Distance to the nearest Natura 2000 site in meters.
+    
+    The Earth Engine source measures the distance to the sites of the asset
+    that intersect the region, as the analysis always has. With the local
+    source, the sites within NATURA_MAX_DISTANCE of the region are taken
+    from the in-memory index and sent with the request instead; pixels with
+    no site within that distance get the search distance, which passes every
+    threshold, like the local distance rasters (see natura.py).
+    
+    Args:
+        region: Earth Engine geometry
+        bounds: (west, south, east, north) of the region, requested from Earth Engine if omitted
         
-        # Load Natura 2000 sites
-        try:
-            natura_2000_sites = ee.FeatureCollection('projects/ee-chmilew/assets/sic')
-            natura_2000_region = natura_2000_sites.filterBounds(region)
-            natura_2000_distance = natura_2000_region.distance(1000000).clip(region)
-        except Exception as e:
-            print(f"Could not load Natura 2000 sites: {e}")
-            print("Using a placeholder for Natura 2000 distance.")
-            natura_2000_distance = ee.Image.constant(threshold_natura).clip(region)
+    Returns:
+        Earth Engine image clipped to the region
+    """
+    if get_natura_source() == 'local':
+        if bounds is None:
+            bounds = _geometry_bounds(region)
+        geojson = natura_sites_geojson(bounds, margin=NATURA_MAX_DISTANCE)
+        sites = ee.FeatureCollection([ee.Feature(ee.Geometry(feature['geometry']))
+                                      for feature in geojson['features']])
+        return sites.distance(NATURA_MAX_DISTANCE).unmask(NATURA_MAX_DISTANCE).clip(region)
+    
+    try:
+        natura_2000_sites = ee.FeatureCollection(NATURA_2000_ASSET)
+        natura_2000_region = natura_2000_sites.filterBounds(region)
+        return natura_2000_region.distance(1000000).clip(region)
+    except Exception as e:
+        print(f"Could not load Natura 2000 sites: {e}")
+        print("Using a placeholder for Natura 2000 distance.")
+        # Maximum search distance, i.e. no site nearby: every threshold is met
+        return ee.Image.constant(1000000).clip(region)
+
+@metrics.timer('ee.load_datasets')
+def load_criterion_layers(region, bounds=None):
+    """Region stage: build the six criterion images for a region.
+    
+    None of these depend on weights or thresholds, so their maps can be
+    shared by every analysis of the same region (see RegionLayers).
+    
+    Args:
+        region: Earth Engine geometry
+        bounds: (west, south, east, north) of the region, see natura_distance_image
         
-        # Create suitability map
-        slope_suitable = slope.lte(threshold_slope).multiply(weight_slope)
-        elevation_suitable = elevation.lte(threshold_elevation).multiply(weight_elevation)
-        wind_suitable = wind_speed.gte(threshold_wind).multiply(weight_wind)
-        roads_suitable = distance_to_roads.gte(threshold_roads).multiply(weight_roads)
-        landcover_suitable = landcover.eq(40).Or(landcover.eq(30)).multiply(weight_landcover)
-        natura_2000_suitable = natura_2000_distance.gte(threshold_natura).multiply(weight_natura)
+    Returns:
+        Dictionary of MAP_LAYERS key -> Earth Engine image
+    """
+    # Load elevation data
+    elevation = ee.Image('USGS/SRTMGL1_003').select('elevation').clip(region)
+    slope = ee.Terrain.slope(elevation)
+    
+    # Load wind speed data
+    wind_speed = ee.ImageCollection('ECMWF/ERA5/MONTHLY') \
+        .filter(ee.Filter.date('2018-01-01', '2021-01-01')) \
+        .map(calculate_wind_speed) \
+        .select('wind_speed') \
+        .mean() \
+        .clip(region)
+    
+    # Load land cover data
+    landcover = ee.ImageCollection("COPERNICUS/Landcover/100m/Proba-V-C3/Global") \
+        .filter(ee.Filter.date('2019-01-01', '2020-01-01')) \
+        .first() \
+        .select('discrete_classification') \
+        .clip(region)
+    
+    # Load road data
+    distance_to_roads = road_distance_image(region)
+    
+    # Load Natura 2000 sites
+    natura_2000_distance = natura_distance_image(region, bounds)
+    
+    return {
+        'slope': slope,
+        'elevation': elevation,
+        'wind_speed': wind_speed,
+        'roads': distance_to_roads,
+        'landcover': landcover,
+        'natura_2000': natura_2000_distance
+    }
+
+def download_criterion_rasters(layers, region, grid, tile_size=1024, max_workers=None, bands=None):
+    """Download the criterion layers of a region as a NumPy array.
+    
+    The grid is fetched in tiles with ee.data.computePixels, which limits the
+    size of a single request, and the tiles are requested concurrently.
+    
+    Args:
+        layers: Dictionary returned by load_criterion_layers
+        region: Earth Engine geometry
+        grid: raster_engine.RasterGrid to sample
+        tile_size: Maximum tile width and height in pixels
+        max_workers: Maximum number of concurrent requests
+        bands: Criterion bands to download, CRITERION_BANDS by default
         
-        # Combine all factors
-        suitability = slope_suitable \
-            .add(elevation_suitable) \
-            .add(wind_suitable) \
-            .add(roads_suitable) \
-            .add(landcover_suitable) \
-            .add(natura_2000_suitable) \
-            .rename('suitability')
+    Returns:
+        float32 array shaped (len(bands) + 1, grid.height, grid.width) holding the
+        bands followed by 'valid', i.e. STACK_BANDS order by default
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, 'RASTER_DOWNLOAD_WORKERS', 4)
+    
+    if bands is None:
+        bands = CRITERION_BANDS
+    band_names = list(bands) + ['valid']
+    
+    # A pixel is scored where every criterion has data, like the masked sum in score_suitability
+    valid = ee.Image.constant(1)
+    for name in bands:
+        valid = valid.And(layers[name].mask())
+    valid = valid.clip(region).unmask(0)
+    
+    image = ee.Image.cat(
+        [layers[name].rename(name).unmask(0) for name in bands] + [valid.rename('valid')]
+    ).toFloat()
+    
+    stack = np.zeros((len(band_names), grid.height, grid.width), dtype=np.float32)
+    
+    def _fetch(row, col):
+        height = min(tile_size, grid.height - row)
+        width = min(tile_size, grid.width - col)
+        with metrics.timer('ee.compute_pixels'):
+            data = ee.data.computePixels({
+                'expression': image,
+                'fileFormat': 'NUMPY_NDARRAY',
+                'grid': {
+                    'dimensions': {'width': width, 'height': height},
+                    'affineTransform': {
+                        'scaleX': grid.pixel_size,
+                        'shearX': 0,
+                        'translateX': grid.x0 + col * grid.pixel_size,
+                        'shearY': 0,
+                        'scaleY': -grid.pixel_size,
+                        'translateY': grid.y0 - row * grid.pixel_size
+                    },
+                    'crsCode': 'EPSG:4326'
+                }
+            })
+        for i, name in enumerate(band_names):
+            stack[i, row:row + height, col:col + width] = data[name]
+    
+    tiles = [(row, col) for row in range(0, grid.height, tile_size) for col in range(0, grid.width, tile_size)]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='compute-pixels') as pool:
+        for future in [metrics.submit(pool, _fetch, row, col) for row, col in tiles]:
+            future.result()
+    
+    return stack
+
+def criterion_masks(layers, params):
+    """Threshold each criterion layer.
+    
+    Args:
+        layers: Dictionary returned by load_criterion_layers
+        params: AnalysisParameters object with thresholds
         
-        # Calculate maximum possible suitability score for normalization
-        max_score = (weight_slope + weight_elevation + weight_wind + 
-                    weight_roads + weight_landcover + weight_natura)
+    Returns:
+        Dictionary of criterion name -> Earth Engine image that is 1 where the criterion is met
+    """
+    landcover = layers['landcover']
+    return {
+        'slope': layers['slope'].lte(params.threshold_slope),
+        'elevation': layers['elevation'].lte(params.threshold_elevation),
+        'wind_speed': layers['wind_speed'].gte(params.threshold_wind),
+        'roads': layers['roads'].gte(params.threshold_roads),
+        'landcover': landcover.eq(40).Or(landcover.eq(30)),
+        'natura_2000': layers['natura_2000'].gte(params.threshold_natura)
+    }
+
+def score_suitability(layers, params, masks=None):
+    """Scoring stage: weighted overlay of the thresholded criterion layers.
+    
+    Args:
+        layers: Dictionary returned by load_criterion_layers
+        params: AnalysisParameters object with weights and thresholds
+        masks: Optional dictionary returned by criterion_masks
         
-        # Normalize suitability to 0-100 scale for easier interpretation
-        normalized_suitability = suitability.divide(max_score).multiply(100)
+    Returns:
+        Earth Engine image with a 'suitability' band on a 0-100 scale
+    """
+    if masks is None:
+        masks = criterion_masks(layers, params)
+    
+    # Create suitability map
+    slope_suitable = masks['slope'].multiply(params.weight_slope)
+    elevation_suitable = masks['elevation'].multiply(params.weight_elevation)
+    wind_suitable = masks['wind_speed'].multiply(params.weight_wind)
+    roads_suitable = masks['roads'].multiply(params.weight_roads)
+    landcover_suitable = masks['landcover'].multiply(params.weight_landcover)
+    natura_2000_suitable = masks['natura_2000'].multiply(params.weight_natura)
+    
+    # Combine all factors
+    suitability = slope_suitable \
+        .add(elevation_suitable) \
+        .add(wind_suitable) \
+        .add(roads_suitable) \
+        .add(landcover_suitable) \
+        .add(natura_2000_suitable) \
+        .rename('suitability')
+    
+    # Calculate maximum possible suitability score for normalization
+    max_score = (params.weight_slope + params.weight_elevation + params.weight_wind + 
+                 params.weight_roads + params.weight_landcover + params.weight_natura)
+    
+    # Normalize suitability to 0-100 scale for easier interpretation
+    return suitability.divide(max_score).multiply(100)
+
+def render_maps(images, region, output_dir, max_workers=None, extent=None, reporter=None):
+    """Render several analysis layers concurrently.
+    
+    Each map needs its own Earth Engine round-trips and file write but none
+    depends on another, so they are built in a thread pool. Maps are written
+    as standalone HTML pages or as JSON layer specs, depending on
+    settings.ANALYSIS_MAP_FORMAT.
+    
+    Args:
+        images: Dictionary of MAP_LAYERS key -> Earth Engine image
+        region: Earth Engine geometry
+        output_dir: Directory to save map files
+        max_workers: Maximum number of maps built at once (defaults to
+            settings.ANALYSIS_MAP_WORKERS, 1 renders sequentially)
+        extent: Dictionary returned by region_extent, required for JSON layer specs
+        reporter: Optional ProgressReporter receiving a 'render_<key>' stage per map
         
-        # Create individual criterion maps
-        _, slope_map_path = create_map(
-            slope, 
-            region, 
-            {'min': 0, 'max': 20, 'palette': ['green', 'yellow', 'red']}, 
-            'Slope (degrees)',
-            output_dir=maps_output_dir
-        )
+    Returns:
+        Tuple of (key -> map path, key -> tile URL template, key -> render time in seconds)
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, 'ANALYSIS_MAP_WORKERS', len(MAP_LAYERS))
+    
+    as_spec = get_map_format() == 'json'
+    # The overlays are the same for every layer of the region, so they are requested once
+    overlays = get_overlays(region, extent, inline=not as_spec)
+    
+    def _render(key):
+        if reporter is None:
+            return _render_map(key)
+        with reporter.stage('render_' + key, layer=key):
+            return _render_map(key)
+    
+    def _render_map(key):
+        title, vis_params, landcover_legend = MAP_LAYERS[key]
+        start = time.perf_counter()
+        tile_url = get_tile_url(images[key], vis_params)
+        if as_spec:
+            _, map_path = create_layer_spec(
+                vis_params,
+                title,
+                tile_url,
+                extent,
+                landcover_legend=landcover_legend,
+                overlays=overlays,
+                output_dir=output_dir
+            )
+        else:
+            _, map_path = create_map(
+                images[key],
+                region,
+                vis_params,
+                title,
+                landcover_legend=landcover_legend,
+                output_dir=output_dir,
+                tile_url=tile_url,
+                overlays=overlays
+            )
+        return map_path, tile_url, round(time.perf_counter() - start, 3)
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='create-map') as pool:
+        futures = {key: metrics.submit(pool, _render, key) for key in images}
+        # result() re-raises the first failure so the analysis is reported as failed
+        rendered = {key: future.result() for key, future in futures.items()}
+    
+    map_paths = {key: path for key, (path, _, _) in rendered.items()}
+    tile_urls = {key: tile_url for key, (_, tile_url, _) in rendered.items()}
+    timings = {key: elapsed for key, (_, _, elapsed) in rendered.items()}
+    return map_paths, tile_urls, timings
+
+def compute_suitability_stats(normalized_suitability, region, masks=None, scale=100):
+    """Statistics stage: compute all suitability statistics in one Earth Engine request.
+    
+    The suitability band, one 0/1 band per criterion and the area bands are
+    stacked into a single image and reduced with one combined reducer, so the
+    whole result comes back with a single getInfo call.
+    
+    Args:
+        normalized_suitability: Image returned by score_suitability
+        region: Earth Engine geometry of the analysis area
+        masks: Optional dictionary returned by criterion_masks for per-criterion coverage
+        scale: Pixel size in meters
         
-        _, elevation_map_path = create_map(
-            elevation, 
-            region, 
-            {'min': 0, 'max': 500, 'palette': ['green', 'yellow', 'red']}, 
-            'Elevation (m)',
-            output_dir=maps_output_dir
-        )
+    Returns:
+        Dictionary with mean/min/max suitability, pixel count, per-criterion
+        coverage, the share and area at or above each of SUITABILITY_LEVELS
+        and a histogram, like stats_from_counts in raster_engine
+    """
+    suitability = normalized_suitability.rename('suitability')
+    pixel_area = ee.Image.pixelArea().divide(1e6)
+    
+    bands = [
+        suitability,
+        # fixedHistogram excludes its upper bound, so 100 is moved into the last bin
+        suitability.min(HISTOGRAM_EDGES[-1] - 1e-6).rename('histogram'),
+        pixel_area.updateMask(suitability.mask()).rename('area_km2')
+    ]
+    for level in SUITABILITY_LEVELS:
+        above = suitability.gte(level)
+        bands.append(above.rename(f'above_{level}'))
+        bands.append(pixel_area.multiply(above).rename(f'area_above_{level}'))
+    for name, mask in (masks or {}).items():
+        # Coverage is measured over the scored pixels, like the local engine
+        bands.append(mask.unmask(0).updateMask(suitability.mask()).rename(f'{name}_ok'))
+    
+    reducer = ee.Reducer.mean() \
+        .combine(ee.Reducer.minMax(), None, True) \
+        .combine(ee.Reducer.sum(), None, True) \
+        .combine(ee.Reducer.count(), None, True) \
+        .combine(ee.Reducer.fixedHistogram(HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1], len(HISTOGRAM_EDGES) - 1),
+                 None, True)
+    
+    with metrics.timer('ee.reduce_region'):
+        stats = ee.Image.cat(bands).reduceRegion(
+            reducer=reducer,
+            geometry=region,
+            scale=scale,
+            maxPixels=1e9
+        ).getInfo()
+    
+    def percent(key):
+        value = stats.get(key)
+        return round(value * 100, 2) if value is not None else None
+    
+    def rounded(key):
+        value = stats.get(key)
+        return round(value, 2) if value is not None else None
+    
+    results = {
+        'mean_suitability': round(stats.get('suitability_mean', 0), 2),
+        'min_suitability': round(stats.get('suitability_min', 0), 2),
+        'max_suitability': round(stats.get('suitability_max', 0), 2),
+        'pixel_count': int(stats.get('suitability_count') or 0),
+        'criteria_coverage': {name: percent(f'{name}_ok_mean') for name in (masks or {})}
+    }
+    for level in SUITABILITY_LEVELS:
+        results[f'percent_above_{level}'] = percent(f'above_{level}_mean')
+        results[f'area_above_{level}_km2'] = rounded(f'area_above_{level}_sum')
+    results['area_km2'] = rounded('area_km2_sum')
+    
+    # fixedHistogram returns [bucket start, count] pairs
+    histogram = stats.get('histogram_histogram') or []
+    results['histogram'] = {
+        'edges': HISTOGRAM_EDGES,
+        'counts': [int(round(count)) for _, count in histogram] or [0] * (len(HISTOGRAM_EDGES) - 1)
+    }
+    return results
+
+def get_region_maps(params, layers, region, names=None, reporter=None):
+    """Return the shared criterion maps for an analysis' region, rendering any that are missing.
+    
+    Args:
+        params: AnalysisParameters object
+        layers: Dictionary returned by load_criterion_layers
+        region: Earth Engine geometry
+        names: Layers to render if they are missing, all layers by default
+        reporter: Optional ProgressReporter passed to render_maps
         
-        _, wind_speed_map_path = create_map(
-            wind_speed, 
-            region, 
-            {'min': 0, 'max': 5, 'palette': ['blue', 'cyan', 'green', 'yellow', 'red']}, 
-            'Wind Speed (ms)',
-            output_dir=maps_output_dir
-        )
+    Returns:
+        Tuple of (RegionLayers object, key -> render time in seconds for newly rendered maps)
+    """
+    key = region_hash(params)
+    region_layers, _ = RegionLayers.objects.get_or_create(
+        region_hash=key,
+        defaults={
+            'latitude': params.latitude,
+            'longitude': params.longitude,
+            'buffer_radius': params.buffer_radius
+        }
+    )
+    
+    # Maps stored in another format than the configured one are rendered again
+    missing = [name for name in (layers if names is None else names)
+               if not is_current_map_format(getattr(region_layers, name + '_map'))]
+    timings = {}
+    update_fields = ['last_used_at']
+    if missing:
+        output_dir = os.path.join(settings.BASE_DIR, 'static', 'maps', 'regions', key)
+        static_prefix = '/static/maps/regions/' + key + '/'
+        map_paths, tile_urls, timings = render_maps(
+            {name: layers[name] for name in missing}, region, output_dir,
+            extent=region_extent(params.latitude, params.longitude, params.buffer_radius), reporter=reporter)
+        for name, path in map_paths.items():
+            setattr(region_layers, name + '_map', static_prefix + os.path.basename(path))
+        region_layers.tile_urls = {**region_layers.tile_urls, **tile_urls}
+        update_fields += [name + '_map' for name in missing] + ['tile_urls']
+    
+    # Only the rendered maps are written, so layers rendered concurrently by other
+    # requests for the same region are not overwritten. Saving refreshes last_used_at.
+    with metrics.timer('db.save_region_layers'):
+        region_layers.save(update_fields=update_fields)
+    return region_layers, timings
+
+def render_analysis_layer(params, name):
+    """Return the map URL of one criterion layer of an analysis, rendering it on first use.
+    
+    With settings.ANALYSIS_LAZY_LAYERS the analysis only renders its
+    suitability map; the results page requests each criterion map through
+    this function when its tab is first opened. The map is shared with every
+    analysis of the same region.
+    
+    Args:
+        params: AnalysisParameters object
+        name: Criterion layer key, e.g. 'slope'
         
-        _, roads_map_path = create_map(
-            distance_to_roads, 
-            region, 
-            {'min': 0, 'max': 1000, 'palette': ['green', 'yellow', 'red']}, 
-            'Distance to Roads (m)',
-            output_dir=maps_output_dir
-        )
+    Returns:
+        Tuple of (map URL, key -> render time in seconds, empty if the map already existed)
+    """
+    field = name + '_map'
+    if is_current_map_format(getattr(params, field)):
+        return getattr(params, field), {}
+    
+    region = create_region_of_interest(params.latitude, params.longitude, params.buffer_radius)
+    bounds = region_bounds(params.latitude, params.longitude, params.buffer_radius)
+    region_layers, timings = get_region_maps(params, load_criterion_layers(region, bounds), region, names=[name])
+    setattr(params, field, getattr(region_layers, field))
+    with metrics.timer('db.save_analysis'):
+        params.save(update_fields=[field])
+    return getattr(params, field), timings
+
+def run_suitability_analysis(params, reporter=None):
+    """Perform the complete wind farm suitability analysis for a given region.
+    
+    The criterion maps come from the region stage and are shared between
+    analyses of the same region; only the weighted suitability overlay and
+    its statistics are computed per analysis. Each of the progress.STAGES
+    emits progress events with its duration.
+    
+    Args:
+        params: AnalysisParameters object containing all necessary parameters
+        reporter: ProgressReporter for the events, one for params.id by default
         
-        _, landcover_map_path = create_map(
-            landcover, 
-            region, 
-            {'min': 0, 'max': 200, 'palette': ['#282828', '#ffbb22', '#ffff4c', '#f096ff', 
-                                              '#fa0000', '#b4b4b4', '#f0f0f0', '#0032c8', 
-                                              '#0096a0', '#fae6a0', '#009900', '#000080']}, 
-            'Land Cover', 
-            landcover_legend=True,
-            output_dir=maps_output_dir
-        )
+    Returns:
+        Dictionary with results and map paths
+    """
+    if reporter is None:
+        reporter = ProgressReporter(params.id)
+    reporter.plan(STAGES)
+    
+    # Create temporary directory for map files
+    maps_output_dir = os.path.join(settings.BASE_DIR, 'static', 'maps', str(params.id))
+    
+    # Create region of interest
+    region = create_region_of_interest(params.latitude, params.longitude, params.buffer_radius)
+    
+    # Dictionary to store results
+    results = {
+        'maps': {},
+        'stats': {},
+        'timings': {}
+    }
+    
+    try:
+        # Region stage: criterion layers and their (possibly cached) maps. Lazily
+        # rendered maps are made by render_analysis_layer when first viewed.
+        map_start = time.perf_counter()
+        with reporter.stage('load_layers'):
+            layers = load_criterion_layers(
+                region, region_bounds(params.latitude, params.longitude, params.buffer_radius))
+        with reporter.stage('region_maps'):
+            lazy_layers = getattr(settings, 'ANALYSIS_LAZY_LAYERS', False)
+            region_layers, map_timings = get_region_maps(params, layers, region,
+                                                         names=[] if lazy_layers else None, reporter=reporter)
         
-        _, natura_2000_map_path = create_map(
-            natura_2000_distance, 
-            region, 
-            {'min': 0, 'max': 10000, 'palette': ['red', 'yellow', 'green']}, 
-            'Distance from Natura 2000 Sites (m)',
-            output_dir=maps_output_dir
-        )
+        # Scoring stage: weighted overlay for this analysis' weights and thresholds
+        with reporter.stage('score'):
+            masks = criterion_masks(layers, params)
+            normalized_suitability = score_suitability(layers, params, masks)
         
         # Create final suitability map
-        _, suitability_map_path = create_map(
-            normalized_suitability, 
-            region, 
-            {'min': 0, 'max': 100, 'palette': ['red', 'yellow', 'green']}, 
-            'Wind Farm Suitability (%)',
-            output_dir=maps_output_dir
-        )
+        with reporter.stage('render_suitability'):
+            suitability_paths, suitability_tile_urls, suitability_timings = render_maps(
+                {'suitability': normalized_suitability}, region, maps_output_dir,
+                extent=region_extent(params.latitude, params.longitude, params.buffer_radius))
+        suitability_map_path = suitability_paths['suitability']
+        map_timings.update(suitability_timings)
+        results['timings'] = {
+            'maps': map_timings,
+            'maps_total': round(time.perf_counter() - map_start, 3)
+        }
         
         # Get statistics for suitability
         try:
-            stats = normalized_suitability.reduceRegion(
-                reducer=ee.Reducer.mean().combine(ee.Reducer.minMax(), None, True),
-                geometry=region,
-                scale=100,
-                maxPixels=1e9
-            ).getInfo()
-            
-            mean_suitability = round(stats.get('suitability_mean', 0), 2)
-            min_suitability = round(stats.get('suitability_min', 0), 2)
-            max_suitability = round(stats.get('suitability_max', 0), 2)
-            
-            # Store statistics
-            results['stats'] = {
-                'mean_suitability': mean_suitability,
-                'min_suitability': min_suitability,
-                'max_suitability': max_suitability
-            }
-            
-            # Update model with statistics
-            params.mean_suitability = mean_suitability
-            params.min_suitability = min_suitability
-            params.max_suitability = max_suitability
+            with reporter.stage('statistics'):
+                if getattr(settings, 'ANALYSIS_SCORING_ENGINE', 'earthengine') == 'local':
+                    # Score the cached criterion rasters with NumPy
+                    results['stats'] = score_params(params)
+                else:
+                    results['stats'] = compute_suitability_stats(normalized_suitability, region, masks)
+                
+                mean_suitability = results['stats']['mean_suitability']
+                min_suitability = results['stats']['min_suitability']
+                max_suitability = results['stats']['max_suitability']
+                
+                # Update model with statistics
+                params.mean_suitability = mean_suitability
+                params.min_suitability = min_suitability
+                params.max_suitability = max_suitability
+                params.statistics = results['stats']
         except Exception as e:
             print(f"Could not calculate statistics: {e}")
             results['stats'] = {'error': 'Statistics calculation failed'}
         
-        # Convert paths to relative URLs for the template
-        static_prefix = '/static/maps/' + str(params.id) + '/'
-        
-        # Update model with map paths
-        params.suitability_map = static_prefix + os.path.basename(suitability_map_path)
-        params.slope_map = static_prefix + os.path.basename(slope_map_path)
-        params.elevation_map = static_prefix + os.path.basename(elevation_map_path)
-        params.wind_speed_map = static_prefix + os.path.basename(wind_speed_map_path)
-        params.roads_map = static_prefix + os.path.basename(roads_map_path)
-        params.landcover_map = static_prefix + os.path.basename(landcover_map_path)
-        params.natura_2000_map = static_prefix + os.path.basename(natura_2000_map_path)
-        params.save()
+        with reporter.stage('persist'):
+            # Convert paths to relative URLs for the template
+            static_prefix = '/static/maps/' + str(params.id) + '/'
+            
+            # Update model with map paths
+            params.suitability_map = static_prefix + os.path.basename(suitability_map_path)
+            params.tile_urls = suitability_tile_urls
+            for name in CRITERION_BANDS:
+                # Region maps that have not been rendered yet stay empty until first viewed
+                map_url = getattr(region_layers, name + '_map')
+                setattr(params, name + '_map', map_url if is_current_map_format(map_url) else None)
+            with metrics.timer('db.save_analysis'):
+                params.save()
         
         # Add URLs to results
         results['maps'] = {
-            'suitability': static_prefix + os.path.basename(suitability_map_path),
-            'slope': static_prefix + os.path.basename(slope_map_path),
-            'elevation': static_prefix + os.path.basename(elevation_map_path),
-            'wind_speed': static_prefix + os.path.basename(wind_speed_map_path),
-            'roads': static_prefix + os.path.basename(roads_map_path),
-            'landcover': static_prefix + os.path.basename(landcover_map_path),
-            'natura_2000': static_prefix + os.path.basename(natura_2000_map_path)
+            'suitability': params.suitability_map,
+            'slope': params.slope_map,
+            'elevation': params.elevation_map,
+            'wind_speed': params.wind_speed_map,
+            'roads': params.roads_map,
+            'landcover': params.landcover_map,
+            'natura_2000': params.natura_2000_map
         }
+        results['timings']['stages'] = dict(reporter.timings)
         
         # Success
         results['success'] = True
@@ -319,6 +838,8 @@ def run_suitability_analysis(params):
     except Exception as e:
         print(f"Error in analysis: {e}")
         results['success'] = False
-        results['error_message'] = str(e)
+        # Name the stage so a failure says where the pipeline stopped
+        failed = reporter.failed_stage
+        results['error_message'] = f"{failed.replace('_', ' ').capitalize()} stage failed: {e}" if failed else str(e)
     
-    return results
\ No newline at end of file
+    return results
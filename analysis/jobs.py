@@ -0,0 +1,234 @@
+# File: analysis/jobs.py
+"""Background job queue for suitability analyses.
+
+The queue is the AnalysisParameters table itself: a row is a job and its
+``status`` field moves queued -> running -> done/failed. Jobs are claimed with
+a conditional UPDATE so several worker processes (or the in-process thread
+pool) can share the same database without an external broker.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import AnalysisParameters
+
+_executor = None
+_executor_lock = threading.Lock()
+_submitted = set()
+
+
+def _get_executor():
+    """Return the process-wide worker pool, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            max_workers = getattr(settings, 'ANALYSIS_WORKER_THREADS', 2)
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analysis-job')
+        return _executor
+
+
+def _submit(analysis_id):
+    """Hand a job to the in-process pool unless it is already pending there."""
+    with _executor_lock:
+        if analysis_id in _submitted:
+            return
+        _submitted.add(analysis_id)
+    _get_executor().submit(run_job, analysis_id)
+
+
+def enqueue_analysis(params):
+    """Queue an analysis for background execution.
+
+    Args:
+        params: AnalysisParameters object to run
+    """
+    AnalysisParameters.objects.filter(id=params.id).update(
+        status=AnalysisParameters.STATUS_QUEUED, error_message=None,
+        started_at=None, finished_at=None)
+    params.status = AnalysisParameters.STATUS_QUEUED
+
+    if getattr(settings, 'ANALYSIS_RUN_IN_PROCESS', True):
+        # Only start once the row is committed, otherwise the worker may not see it
+        transaction.on_commit(lambda: _submit(params.id))
+
+
+def ensure_scheduled(params):
+    """Make sure an unfinished job will be picked up.
+
+    Jobs held by an in-process pool are lost when the server restarts, so
+    views call this when they see an unfinished job to resubmit it. A job
+    running for longer than settings.ANALYSIS_JOB_TIMEOUT lost its worker,
+    e.g. to a restart in the middle of the job, and is queued again first.
+    """
+    if not getattr(settings, 'ANALYSIS_RUN_IN_PROCESS', True):
+        return
+    if params.status == AnalysisParameters.STATUS_RUNNING and _is_stale(params):
+        if requeue_stale_jobs(analysis_id=params.id):
+            params.status = AnalysisParameters.STATUS_QUEUED
+            params.started_at = None
+    if params.status == AnalysisParameters.STATUS_QUEUED:
+        _submit(params.id)
+
+
+def claim_job(analysis_id):
+    """Atomically move a queued job to running.
+
+    Returns:
+        The claimed AnalysisParameters object, or None if another worker got it first
+    """
+    claimed = AnalysisParameters.objects.filter(
+        id=analysis_id, status=AnalysisParameters.STATUS_QUEUED
+    ).update(status=AnalysisParameters.STATUS_RUNNING, started_at=timezone.now())
+    if not claimed:
+        return None
+    return AnalysisParameters.objects.get(id=analysis_id)
+
+
+def claim_next_job():
+    """Claim the oldest queued job, or return None if the queue is empty."""
+    queued_ids = AnalysisParameters.objects.filter(
+        status=AnalysisParameters.STATUS_QUEUED
+    ).order_by('created_at').values_list('id', flat=True)[:10]
+    for analysis_id in queued_ids:
+        params = claim_job(analysis_id)
+        if params is not None:
+            return params
+    return None
+
+
+def execute_job(params):
+    """Run the analysis for a claimed job and record the outcome."""
+    # Imported here so that importing the queue does not initialize Earth Engine
+    from .artifacts import maybe_prune
+    from .gee_utils import run_suitability_analysis
+    from .progress import clear_events
+    from .pyramids import schedule_pyramids
+    from .result_cache import params_hash, reuse_cached_result
+
+    with metrics.collect_timings() as collector:
+        # Any failure, including the cache lookup, has to mark the job failed, otherwise it
+        # stays running and its progress page polls forever
+        try:
+            # An identical analysis may have finished while this one was waiting in the queue
+            if not params.params_hash:
+                params.params_hash = params_hash(params)
+            if reuse_cached_result(params, count=False):
+                return {'success': True, 'cached': True}
+
+            # Events of an earlier run of a requeued job would confuse the progress page
+            clear_events(params.id)
+            results = run_suitability_analysis(params)
+        except Exception as e:
+            print(f"Error in analysis job {params.id}: {e}")
+            results = {'success': False, 'error_message': str(e)}
+    params.timings = {**results.get('timings', {}), 'operations': collector.summary()}
+    # A worker may exit right after its last job, so its timers are not left for the next flush
+    metrics.flush()
+
+    if results.get('success'):
+        params.status = AnalysisParameters.STATUS_DONE
+        params.error_message = None
+    else:
+        params.status = AnalysisParameters.STATUS_FAILED
+        params.error_message = results.get('error_message', 'Unknown error')
+    params.finished_at = timezone.now()
+    AnalysisParameters.objects.filter(id=params.id).update(
+        status=params.status, error_message=params.error_message, finished_at=params.finished_at,
+        timings=params.timings)
+    
+    # The finished layers never change, so their tiles are rendered once into pyramids,
+    # in the background so that the next job does not wait for them
+    if results.get('success') and getattr(settings, 'TILE_PYRAMID_ZOOMS', None):
+        schedule_pyramids(params)
+    
+    # Every job adds map files, so this is where the disk budget is enforced
+    try:
+        evicted = maybe_prune()
+        if evicted:
+            print(f"Evicted {len(evicted)} map directories to stay within ARTIFACT_MAX_BYTES")
+    except Exception as e:
+        print(f"Error pruning map files: {e}")
+    return results
+
+
+def run_job(analysis_id):
+    """Worker entry point: claim and execute a single job by ID."""
+    close_old_connections()
+    try:
+        params = claim_job(analysis_id)
+        if params is not None:
+            execute_job(params)
+    finally:
+        with _executor_lock:
+            _submitted.discard(analysis_id)
+        close_old_connections()
+
+
+def _stale_cutoff(timeout=None):
+    """Return the start time before which a running job is assumed to have lost its worker."""
+    if timeout is None:
+        timeout = getattr(settings, 'ANALYSIS_JOB_TIMEOUT', 30 * 60)
+    return timezone.now() - timedelta(seconds=timeout)
+
+
+def _is_stale(params):
+    return params.started_at is not None and params.started_at < _stale_cutoff()
+
+
+def requeue_stale_jobs(timeout=None, analysis_id=None):
+    """Put jobs that have been running for too long back on the queue.
+
+    A job stays in the running state forever if its worker dies, so workers
+    call this periodically to recover them, and ensure_scheduled for the
+    job a view is showing.
+
+    Args:
+        timeout: Seconds after which a running job is stale (defaults to settings.ANALYSIS_JOB_TIMEOUT)
+        analysis_id: Only requeue this job
+
+    Returns:
+        Number of requeued jobs
+    """
+    cutoff = _stale_cutoff(timeout)
+    stale = AnalysisParameters.objects.filter(status=AnalysisParameters.STATUS_RUNNING, started_at__lt=cutoff)
+    if analysis_id is not None:
+        stale = stale.filter(id=analysis_id)
+    return stale.update(status=AnalysisParameters.STATUS_QUEUED, started_at=None)
+
+
+def run_worker(threads=1, poll_interval=2.0, once=False):
+    """Poll the database for queued jobs and run them with a local thread pool.
+
+    Args:
+        threads: Number of jobs to run concurrently
+        poll_interval: Seconds to wait when the queue is empty
+        once: Stop as soon as the queue is drained
+    """
+    slots = threading.BoundedSemaphore(threads)
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='analysis-worker') as pool:
+        while True:
+            requeue_stale_jobs()
+            slots.acquire()
+            params = claim_next_job()
+            if params is None:
+                slots.release()
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            def _run(job=params):
+                close_old_connections()
+                try:
+                    execute_job(job)
+                finally:
+                    close_old_connections()
+                    slots.release()
+
+            pool.submit(_run)
@@ -0,0 +1,41 @@
+# File: analysis/management/commands/build_tile_pyramids.py
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.models import AnalysisParameters
+from analysis.pyramids import build_pyramids
+
+
+class Command(BaseCommand):
+    help = 'Render the map layers of finished analyses into MBTiles tile pyramids served by the tile proxy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('analysis_ids', nargs='*', help='Analyses to build (default: every finished analysis)')
+        parser.add_argument('--zoom', type=int, nargs=2, metavar=('MIN', 'MAX'),
+                            help='Zoom levels to build (defaults to TILE_PYRAMID_ZOOMS, or 7 11 when it is off)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Worker processes fetching tiles (defaults to TILE_PYRAMID_WORKERS)')
+
+    def handle(self, *args, **options):
+        zooms = options['zoom']
+        if zooms is not None and not 0 <= zooms[0] <= zooms[1]:
+            raise CommandError('--zoom expects MIN <= MAX, both at least 0')
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        analyses = AnalysisParameters.objects.filter(status=AnalysisParameters.STATUS_DONE)
+        if options['analysis_ids']:
+            analyses = analyses.filter(id__in=options['analysis_ids'])
+
+        total = 0
+        for params in analyses.order_by('created_at'):
+            try:
+                written = build_pyramids(params, zooms=zooms, workers=options['workers'])
+            except Exception as e:
+                self.stderr.write(f"Analysis {params.id}: {e}")
+                continue
+            total += sum(count for count in written.values() if count is not None)
+            # Levels built earlier are skipped, so layers already complete write no tiles
+            layers = ', '.join(f"{name} {'failed' if count is None else count}" for name, count in written.items()) \
+                or 'no proxied layers'
+            self.stdout.write(f"Analysis {params.id}: {layers}")
+        self.stdout.write(self.style.SUCCESS(f"Wrote {total} tiles"))
@@ -0,0 +1,47 @@
+# File: analysis/management/commands/check_local_scoring.py
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.gee_utils import (compute_suitability_stats, create_region_of_interest, criterion_masks,
+                                load_criterion_layers, region_bounds, score_suitability)
+from analysis.models import AnalysisParameters
+from analysis.raster_engine import SUITABILITY_LEVELS, score_params
+
+# Statistics given in percent, compared against the tolerance
+COMPARED_FIELDS = ['mean_suitability', 'min_suitability', 'max_suitability'] + [
+    f'percent_above_{level}' for level in SUITABILITY_LEVELS]
+
+
+class Command(BaseCommand):
+    help = 'Compare the local NumPy suitability statistics with Earth Engine reduceRegion for an analysis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('analysis_id', help='ID of the analysis to compare')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Maximum allowed difference in percentage points')
+
+    def handle(self, *args, **options):
+        try:
+            params = AnalysisParameters.objects.get(id=options['analysis_id'])
+        except (AnalysisParameters.DoesNotExist, ValueError):
+            raise CommandError(f"Analysis {options['analysis_id']} does not exist")
+
+        region = create_region_of_interest(params.latitude, params.longitude, params.buffer_radius)
+        layers = load_criterion_layers(
+            region, region_bounds(params.latitude, params.longitude, params.buffer_radius))
+        masks = criterion_masks(layers, params)
+        remote = compute_suitability_stats(score_suitability(layers, params, masks), region, masks)
+        local = score_params(params)
+
+        failed = False
+        for key in COMPARED_FIELDS:
+            remote_value = remote[key]
+            if remote_value is None or local[key] is None:
+                difference = float('inf')
+            else:
+                difference = abs(remote_value - local[key])
+            failed = failed or difference > options['tolerance']
+            self.stdout.write(f"{key}: earthengine={remote_value} local={local[key]} difference={difference:.2f}")
+
+        if failed:
+            raise CommandError(f"Local statistics differ by more than {options['tolerance']} points")
+        self.stdout.write(self.style.SUCCESS('Local statistics match Earth Engine'))
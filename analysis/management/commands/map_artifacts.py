@@ -0,0 +1,58 @@
+# File: analysis/management/commands/map_artifacts.py
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.artifacts import prune, usage
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(text):
+    """Parse a size such as 500M or 2G into bytes."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', text.upper())
+    if match is None:
+        raise CommandError(f"Invalid size '{text}', expected e.g. 500M or 2G")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+
+
+class Command(BaseCommand):
+    help = 'Report the disk usage of the generated maps in static/maps and evict them to a budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', action='store_true',
+                            help='Evict the least recently viewed maps until they fit the budget')
+        parser.add_argument('--max-size', type=parse_size,
+                            help='Budget such as 2G (defaults to ARTIFACT_MAX_BYTES)')
+        parser.add_argument('--dry-run', action='store_true', help='List what --prune would evict')
+
+    def handle(self, *args, **options):
+        report = usage()
+        budget = options['max_size'] if options['max_size'] is not None else report['budget_bytes']
+        self.stdout.write(f"Total:     {format_size(report['total_bytes'])}"
+                          f" of {format_size(budget) if budget is not None else 'unlimited'}")
+        for kind, label in (('analysis', 'Analyses'), ('region', 'Regions')):
+            self.stdout.write(f"{label + ':':<10} {report[kind]['count']} directories,"
+                              f" {format_size(report[kind]['bytes'])}")
+        self.stdout.write(f"Overlays:  {format_size(report['overlay_bytes'])} (never evicted)")
+        self.stdout.write(f"{report['unreferenced']} directories are not referenced by any analysis,"
+                          f" {report['protected']} are in use")
+
+        if not options['prune'] and not options['dry_run']:
+            return
+        if budget is None:
+            raise CommandError('No budget: set ARTIFACT_MAX_BYTES or pass --max-size')
+
+        evicted, total = prune(budget, dry_run=options['dry_run'])
+        for artifact in evicted:
+            last_used = artifact.last_used.strftime('%Y-%m-%d %H:%M') if artifact.last_used else 'unreferenced'
+            self.stdout.write(f"{artifact.kind:<9} {artifact.key}  {format_size(artifact.size):>10}  {last_used}")
+        verb = 'Would evict' if options['dry_run'] else 'Evicted'
+        self.stdout.write(self.style.SUCCESS(f"{verb} {len(evicted)} directories, {format_size(total)} remaining"))
@@ -0,0 +1,51 @@
+# File: analysis/management/commands/precompute_road_distance.py
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.roads import ROAD_SOURCES, create_road_source, get_road_source, get_road_tiles, precompute_road_tiles
+
+
+class Command(BaseCommand):
+    help = 'Precompute distance-to-roads tiles for the configured area so local scoring does not rasterize roads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bounds', type=float, nargs=4, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                            help='Area to cover in degrees (defaults to settings.ROAD_DISTANCE_BOUNDS)')
+        parser.add_argument('--source', choices=sorted(ROAD_SOURCES),
+                            help='Road source to compute from (defaults to settings.ROAD_SOURCE)')
+        parser.add_argument('--dataset', help='Road dataset file for the local source '
+                                              '(defaults to settings.ROAD_DATASET_PATH)')
+        parser.add_argument('--overwrite', action='store_true', help='Recompute tiles that are already stored')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Maximum number of tiles computed at once')
+
+    def handle(self, *args, **options):
+        bounds = options['bounds'] or getattr(settings, 'ROAD_DISTANCE_BOUNDS', None)
+        if not bounds:
+            raise CommandError('No area given; pass --bounds or set ROAD_DISTANCE_BOUNDS')
+        west, south, east, north = bounds
+        if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+            raise CommandError(f"Invalid bounds {bounds}")
+
+        try:
+            if options['source'] or options['dataset']:
+                source = create_road_source(options['source'] or 'local',
+                                            options['dataset'] or getattr(settings, 'ROAD_DATASET_PATH', None),
+                                            getattr(settings, 'ROAD_DATASET_LAYER', None))
+            else:
+                source = get_road_source()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        tiles = get_road_tiles()
+        self.stdout.write(f"Covering {len(tiles.tiles_for_bounds(*bounds))} tiles of {tiles.tile_size} px "
+                          f"at {tiles.scale} m in {tiles.store.root} from the {source.name} road source")
+
+        def _progress(done, total):
+            self.stderr.write(f"\r{done}/{total} tiles", ending='')
+
+        computed = precompute_road_tiles(bounds, overwrite=options['overwrite'], max_workers=options['workers'],
+                                         progress=_progress, source=source)
+        self.stderr.write('')
+        self.stdout.write(self.style.SUCCESS(f"Computed {computed} tile(s)"))
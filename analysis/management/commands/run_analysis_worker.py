@@ -0,0 +1,20 @@
+# File: analysis/management/commands/run_analysis_worker.py
+from django.core.management.base import BaseCommand
+
+from analysis.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Run queued wind farm suitability analyses from the database job queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=2,
+                            help='Number of analyses to run concurrently')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait between polls when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of polling forever')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Starting analysis worker with {options['threads']} thread(s)")
+        run_worker(threads=options['threads'], poll_interval=options['poll_interval'], once=options['once'])
@@ -0,0 +1,59 @@
+# File: analysis/management/commands/run_batch_analysis.py
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.batch import format_rows, load_sites, prepare_batch, run_batch, write_rows
+
+
+class Command(BaseCommand):
+    help = 'Screen many candidate sites from a CSV or JSON file with shared weights and thresholds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sites', help='CSV or JSON file with latitude, longitude and optional name/buffer_radius')
+        parser.add_argument('--output', '-o', help='CSV or JSON file to write (defaults to CSV on stdout)')
+        parser.add_argument('--params', help='JSON object or file with weight_*/threshold_* values and '
+                                             'a default buffer_radius; missing values use the form defaults')
+        parser.add_argument('--render-maps', action='store_true',
+                            help='Run the full analysis with maps for every site and store it')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Maximum number of regions processed at once')
+
+    def handle(self, *args, **options):
+        try:
+            sites = load_sites(options['sites'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read sites: {e}")
+
+        shared = {}
+        if options['params']:
+            try:
+                text = options['params']
+                if not text.lstrip().startswith('{'):
+                    with open(text, encoding='utf-8') as f:
+                        text = f.read()
+                shared = json.loads(text)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read parameters: {e}")
+        try:
+            prepare_batch(sites, shared)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        def _progress(done, total):
+            self.stderr.write(f"\r{done}/{total} sites", ending='')
+
+        rows = run_batch(sites, shared, render_maps=options['render_maps'],
+                         max_workers=options['workers'], progress=_progress)
+        self.stderr.write('')
+
+        if options['output']:
+            write_rows(rows, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Wrote {len(rows)} rows to {options['output']}"))
+        else:
+            sys.stdout.write(format_rows(rows, 'csv'))
+
+        failed = sum(1 for row in rows if row['error'])
+        if failed:
+            self.stderr.write(self.style.WARNING(f"{failed} site(s) failed"))
@@ -0,0 +1,72 @@
+# File: analysis/management/commands/run_benchmarks.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.benchmarks.runner import (BASELINE_PATH, DEFAULT_CONCURRENCY, DEFAULT_ITERATIONS, DEFAULT_RADII,
+                                        SCENARIOS, compare, load_baseline, run_benchmarks, save_baseline)
+
+COLUMNS = ['scenario', 'radius_km', 'concurrency', 'p50_ms', 'p90_ms', 'p99_ms', 'throughput_per_s',
+           'peak_memory_kb', 'ee_requests']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the analysis pipeline against an offline Earth Engine stand-in and compare with the baseline'
+
+    # The URL checks would import the views, and with them the real Earth Engine client,
+    # before the offline stand-in is installed
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', nargs='+', choices=sorted(SCENARIOS), help='Scenarios to run (default: all)')
+        parser.add_argument('--radius', type=int, nargs='+', default=DEFAULT_RADII, help='Buffer radii in km')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY,
+                            help='Numbers of calls in flight')
+        parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                            help='Calls per scenario, radius and concurrency level')
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Simulated Earth Engine round-trip latency in seconds')
+        parser.add_argument('--seconds-per-km2', type=float, default=2e-5,
+                            help='Simulated additional latency per square kilometer reduced')
+        parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file to compare with')
+        parser.add_argument('--save-baseline', action='store_true', help='Store this run as the baseline')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed relative increase of latencies and memory over the baseline')
+        parser.add_argument('--output', '-o', help='JSON file to write the results to')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1 or min(options['concurrency']) < 1:
+            raise CommandError('--iterations and --concurrency must be at least 1')
+
+        self.stdout.write('  '.join(f"{column:>16}" for column in COLUMNS))
+
+        def _progress(result):
+            self.stdout.write('  '.join(f"{result[column]:>16}" for column in COLUMNS))
+
+        run = run_benchmarks(scenarios=options['scenario'], radii=options['radius'],
+                             concurrency=options['concurrency'], iterations=options['iterations'],
+                             latency=options['latency'], seconds_per_km2=options['seconds_per_km2'],
+                             progress=_progress)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(run, f, indent=2)
+
+        if options['save_baseline']:
+            save_baseline(run, options['baseline'])
+            self.stdout.write(self.style.SUCCESS(f"Saved the baseline to {options['baseline']}"))
+            return
+
+        baseline = load_baseline(options['baseline'])
+        if baseline is None:
+            self.stdout.write(f"No baseline at {options['baseline']}, run with --save-baseline to store one")
+            return
+        try:
+            regressions = compare(run, baseline, options['tolerance'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        for scenario, radius, concurrency, field, before, after in regressions:
+            self.stderr.write(f"{scenario} radius={radius} concurrency={concurrency}: {field} {before} -> {after}")
+        if regressions:
+            raise CommandError(f"{len(regressions)} regressions against the baseline")
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
@@ -0,0 +1,64 @@
+# File: analysis/management/commands/screen_area.py
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.batch import format_rows, run_batch, write_rows
+from analysis.screening import ENGINES, OUTPUT_FIELDS, RANK_FIELDS, cells_to_sites, screen_area
+
+
+class Command(BaseCommand):
+    help = 'Screen a whole area on a grid of cells and list the most suitable cells'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bounds', type=float, nargs=4, required=True,
+                            metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'), help='Area to screen in degrees')
+        parser.add_argument('--cell-km', type=float, default=None,
+                            help='Cell size in kilometers (defaults to SCREENING_CELL_KM)')
+        parser.add_argument('--top', type=int, default=20, help='Number of best cells to list (0 lists all)')
+        parser.add_argument('--engine', choices=ENGINES, default=None,
+                            help='Scoring engine (defaults to SCREENING_ENGINE)')
+        parser.add_argument('--scale', type=int, default=None,
+                            help='Pixel size in meters (defaults to SCREENING_SCALE)')
+        parser.add_argument('--rank-by', choices=RANK_FIELDS, default='mean_suitability')
+        parser.add_argument('--params', help='JSON object or file with weight_*/threshold_* values; '
+                                             'missing values use the form defaults')
+        parser.add_argument('--output', '-o', help='CSV or JSON file to write (defaults to CSV on stdout)')
+        parser.add_argument('--analyze', action='store_true',
+                            help='Run the full analysis with maps for each listed cell and store it')
+
+    def handle(self, *args, **options):
+        shared = {}
+        if options['params']:
+            try:
+                text = options['params']
+                if not text.lstrip().startswith('{'):
+                    with open(text, encoding='utf-8') as f:
+                        text = f.read()
+                shared = json.loads(text)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read parameters: {e}")
+
+        try:
+            rows = screen_area(options['bounds'], cell_km=options['cell_km'], shared=shared,
+                               top=options['top'] or None, engine=options['engine'], scale=options['scale'],
+                               rank_by=options['rank_by'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            write_rows(rows, options['output'], OUTPUT_FIELDS)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {len(rows)} cells to {options['output']}"))
+        else:
+            sys.stdout.write(format_rows(rows, 'csv', OUTPUT_FIELDS))
+
+        if options['analyze'] and rows:
+            def _progress(done, total):
+                self.stderr.write(f"\r{done}/{total} cells analyzed", ending='')
+
+            results = run_batch(cells_to_sites(rows), shared, render_maps=True, progress=_progress)
+            self.stderr.write('')
+            for result in results:
+                status = result['error'] or f"analysis {result['analysis_id']}"
+                self.stderr.write(f"{result['name']}: {status}")
@@ -0,0 +1,258 @@
+# File: analysis/metrics.py
+"""Process-independent counters and timers.
+
+Background workers run in separate processes from the web server, so counters
+live in the database (MetricCounter) instead of module globals. Counting is
+on the request path of every tile and map ID lookup, so an increment only
+adds to an in-process total. A background thread of each process adds the
+totals to the database every settings.METRICS_FLUSH_INTERVAL seconds, and
+they are flushed when a job or the process ends, in one transaction of
+atomic UPDATEs, so counts are not lost when several processes flush the
+same counter at once. get_counters includes this process' unflushed totals.
+
+Timers record how long Earth Engine requests, map renders and database
+writes take. Each observation only updates an in-process histogram, which
+is flushed with the counters into counters of the same kind (one per
+bucket and one for the sum). Observations are also added to the collector
+of the analysis being run (see collect_timings), which gives the
+per-analysis breakdown.
+"""
+import atexit
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+
+# Timer histograms are stored as the counters timer:<operation>:<index into the histogram list>
+TIMER_PREFIX = 'timer:'
+
+# Upper bounds in seconds of the timer histogram buckets; slower calls fall in the +Inf bucket
+TIMER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# operation -> [count per bucket..., count above the last bucket, sum in microseconds]
+_pending = {}
+# counter name -> amount not yet added to the database
+_pending_counters = {}
+_pending_lock = threading.Lock()
+# Process ID -> flusher thread; a forked process starts its own
+_flushers = {}
+_collector = contextvars.ContextVar('timing_collector', default=None)
+
+
+def increment(name, amount=1):
+    """Increase a named counter, creating it on first use.
+
+    The amount is added to the database by the next flush.
+    """
+    with _pending_lock:
+        _pending_counters[name] = _pending_counters.get(name, 0) + amount
+        _start_flusher()
+
+
+def _start_flusher():
+    """Start this process' flusher thread unless it runs or flushing is off. Called with _pending_lock held."""
+    pid = os.getpid()
+    if pid in _flushers or getattr(settings, 'METRICS_FLUSH_INTERVAL', 10) is None:
+        return
+    if not _flushers:
+        # Whatever is left when the process exits is flushed then
+        atexit.register(flush)
+    _flushers[pid] = threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True)
+    _flushers[pid].start()
+
+
+def _flush_periodically():
+    from django.db import connection
+
+    while True:
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+        if interval is None:
+            break
+        time.sleep(interval)
+        flush()
+        # The thread sleeps far longer than connections should stay open
+        connection.close()
+    with _pending_lock:
+        _flushers.pop(os.getpid(), None)
+
+
+def _add(name, amount):
+    # Imported here so that spawned worker processes can import this module before django.setup()
+    from .models import MetricCounter
+
+    # The addition happens in the database, so concurrent increments cannot overwrite each other
+    if MetricCounter.objects.filter(name=name).update(value=F('value') + amount):
+        return
+    try:
+        with transaction.atomic():
+            MetricCounter.objects.create(name=name, value=amount)
+    except IntegrityError:
+        # Another process created the counter in between
+        MetricCounter.objects.filter(name=name).update(value=F('value') + amount)
+
+
+def get_counter(name):
+    """Return the current value of a named counter."""
+    return get_counters([name])[name]
+
+
+def get_counters(names):
+    """Return a dictionary of counter name -> value, including this process' unflushed counts."""
+    from .models import MetricCounter
+
+    values = dict(MetricCounter.objects.filter(name__in=names).values_list('name', 'value'))
+    with _pending_lock:
+        return {name: values.get(name, 0) + _pending_counters.get(name, 0) for name in names}
+
+
+def hit_rate(hits, misses):
+    """Fraction of lookups that were hits, or None before the first lookup."""
+    total = hits + misses
+    return round(hits / total, 4) if total else None
+
+
+class TimingCollector:
+    """Totals of the operations timed while one analysis runs."""
+
+    def __init__(self):
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    def add(self, operation, seconds):
+        with self._lock:
+            entry = self.operations.setdefault(operation, {'count': 0, 'total_s': 0.0, 'max_s': 0.0})
+            entry['count'] += 1
+            entry['total_s'] += seconds
+            entry['max_s'] = max(entry['max_s'], seconds)
+
+    def summary(self):
+        """Return operation -> {'count', 'total_s', 'max_s'}, slowest total first."""
+        with self._lock:
+            items = sorted(self.operations.items(), key=lambda item: -item[1]['total_s'])
+            return {operation: {'count': entry['count'],
+                                'total_s': round(entry['total_s'], 4),
+                                'max_s': round(entry['max_s'], 4)}
+                    for operation, entry in items}
+
+
+@contextmanager
+def collect_timings():
+    """Collect the timers observed in this context, e.g. while running one analysis.
+
+    Worker threads started inside the context only contribute when their
+    tasks are submitted with submit().
+    """
+    collector = TimingCollector()
+    token = _collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _collector.reset(token)
+
+
+def submit(pool, func, *args):
+    """Submit a task to a thread pool in the current context, so its timers reach the collector."""
+    return pool.submit(contextvars.copy_context().run, func, *args)
+
+
+def observe(operation, seconds):
+    """Record the duration of one call of an operation."""
+    with _pending_lock:
+        histogram = _pending.get(operation)
+        if histogram is None:
+            histogram = _pending[operation] = [0] * (len(TIMER_BUCKETS) + 2)
+        histogram[bisect.bisect_left(TIMER_BUCKETS, seconds)] += 1
+        histogram[-1] += int(seconds * 1e6)
+        _start_flusher()
+
+    collector = _collector.get()
+    if collector is not None:
+        collector.add(operation, seconds)
+
+
+@contextmanager
+def timer(operation):
+    """Time a block or, used as a decorator, every call of a function.
+
+    Failed calls are timed as well, since slow failures are as costly as slow successes.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(operation, time.perf_counter() - start)
+
+
+def flush():
+    """Add the counts and histograms of this process since the last flush to the shared counters."""
+    with _pending_lock:
+        amounts = dict(_pending_counters)
+        for operation, histogram in _pending.items():
+            for i, count in enumerate(histogram):
+                if count:
+                    amounts[f"{TIMER_PREFIX}{operation}:{i}"] = count
+        _pending_counters.clear()
+        _pending.clear()
+    if not amounts:
+        return
+
+    try:
+        # One transaction, so a flush is a single write to the database
+        with transaction.atomic():
+            for name, amount in amounts.items():
+                _add(name, amount)
+    except DatabaseError as e:
+        # Kept for the next flush; a failed flush must not fail the request that triggered it
+        print(f"Error flushing metrics: {e}")
+        with _pending_lock:
+            for name, amount in amounts.items():
+                _pending_counters[name] = _pending_counters.get(name, 0) + amount
+
+
+def get_timers():
+    """Return operation -> {'buckets': cumulative counts per TIMER_BUCKETS and +Inf, 'sum', 'count'}."""
+    from .models import MetricCounter
+
+    size = len(TIMER_BUCKETS) + 2
+    histograms = {}
+    for name, value in MetricCounter.objects.filter(name__startswith=TIMER_PREFIX).values_list('name', 'value'):
+        operation, _, index = name[len(TIMER_PREFIX):].rpartition(':')
+        histograms.setdefault(operation, [0] * size)[int(index)] = value
+    timers = {}
+    for name, histogram in histograms.items():
+        cumulative = []
+        for count in histogram[:-1]:
+            cumulative.append((cumulative[-1] if cumulative else 0) + count)
+        timers[name] = {'buckets': cumulative, 'sum': histogram[-1] / 1e6, 'count': cumulative[-1]}
+    return timers
+
+
+def prometheus_text(counters, namespace='windfarm'):
+    """Render counters and timer histograms in the Prometheus text exposition format.
+
+    Args:
+        counters: Dictionary of counter name -> value, e.g. from get_counters
+        namespace: Prefix of every metric name
+    """
+    lines = []
+    for name, value in counters.items():
+        metric = f"{namespace}_{name}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+    metric = f"{namespace}_operation_duration_seconds"
+    lines += [f"# HELP {metric} Duration of Earth Engine requests, map renders and database writes",
+              f"# TYPE {metric} histogram"]
+    bounds = [repr(float(bound)) for bound in TIMER_BUCKETS] + ['+Inf']
+    for operation, timer_values in sorted(get_timers().items()):
+        labels = f'operation="{operation}"'
+        for bound, count in zip(bounds, timer_values['buckets']):
+            lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f"{metric}_sum{{{labels}}} {timer_values['sum']}")
+        lines.append(f"{metric}_count{{{labels}}} {timer_values['count']}")
+    return '\n'.join(lines) + '\n'
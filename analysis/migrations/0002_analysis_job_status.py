@@ -0,0 +1,41 @@
+# Generated by Django 4.2.19 on 2026-10-17 11:02
+
+from django.db import migrations, models
+
+
+def mark_existing_analyses_done(apps, schema_editor):
+    """Analyses that already rendered their maps ran synchronously and are finished"""
+    AnalysisParameters = apps.get_model('analysis', 'AnalysisParameters')
+    AnalysisParameters.objects.exclude(suitability_map__isnull=True).exclude(
+        suitability_map='').update(status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='error_message',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=10),
+        ),
+        migrations.RunPython(mark_existing_analyses_done, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.19 on 2026-10-17 11:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0002_analysis_job_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='params_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.19 on 2026-10-17 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0003_analysisparameters_params_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegionLayers',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region_hash', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now=True)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('buffer_radius', models.IntegerField()),
+                ('slope_map', models.TextField(blank=True, null=True)),
+                ('elevation_map', models.TextField(blank=True, null=True)),
+                ('wind_speed_map', models.TextField(blank=True, null=True)),
+                ('roads_map', models.TextField(blank=True, null=True)),
+                ('landcover_map', models.TextField(blank=True, null=True)),
+                ('natura_2000_map', models.TextField(blank=True, null=True)),
+                ('tile_urls', models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.19 on 2026-10-17 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0005_analysisparameters_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.19 on 2026-10-17 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0006_analysisparameters_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='last_viewed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.19 on 2026-10-17 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0007_analysisparameters_last_viewed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TileLayer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expression', models.TextField()),
+                ('vis_params', models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+    ]
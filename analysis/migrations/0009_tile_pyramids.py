@@ -0,0 +1,23 @@
+# Generated by Django 4.2.19 on 2026-10-17 11:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0008_tilelayer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisparameters',
+            name='tile_urls',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='tilelayer',
+            name='pyramid',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.19 on 2026-10-17 12:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0009_tile_pyramids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
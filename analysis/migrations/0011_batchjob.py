@@ -0,0 +1,28 @@
+# Generated by Django 4.2.19 on 2026-10-17 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0010_metriccounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchJob',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('status', models.CharField(default='queued', max_length=10)),
+                ('done', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0)),
+                ('fields', models.JSONField(default=list)),
+                ('rows', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('elapsed_seconds', models.FloatField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.19 on 2026-10-17 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0011_batchjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tilelayer',
+            name='pyramid_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
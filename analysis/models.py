@@ -9,9 +9,31 @@ import datetime
 
 class AnalysisParameters(models.Model):
     """Store analysis parameters and results for revisiting later"""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    # Job status - the analysis itself runs in a background worker (see jobs.py)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    error_message = models.TextField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Last time the results page was opened, used to evict the maps of unviewed analyses (see artifacts.py)
+    last_viewed_at = models.DateTimeField(null=True, blank=True)
+    
+    # Hash of the normalized form parameters, used to reuse earlier results (see result_cache.py)
+    params_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    
     # Region parameters
     latitude = models.FloatField()
     longitude = models.FloatField()
@@ -36,6 +58,10 @@ class AnalysisParameters(models.Model):
     mean_suitability = models.FloatField(null=True, blank=True)
     min_suitability = models.FloatField(null=True, blank=True)
     max_suitability = models.FloatField(null=True, blank=True)
+    # Full statistics: pixel count, criterion coverage, area above suitability levels, histogram
+    statistics = models.JSONField(null=True, blank=True)
+    # Time spent per pipeline stage, map and timed operation (Earth Engine requests, file and database writes)
+    timings = models.JSONField(null=True, blank=True)
     
     # Map URLs - these would be links to saved map images or folium HTML files
     suitability_map = models.TextField(null=True, blank=True)
@@ -46,5 +72,120 @@ class AnalysisParameters(models.Model):
     landcover_map = models.TextField(null=True, blank=True)
     natura_2000_map = models.TextField(null=True, blank=True)
     
+    # Layer key -> tile URL template of the layers rendered for this analysis (the suitability map)
+    tile_urls = models.JSONField(default=dict, blank=True)
+    
+    @property
+    def is_finished(self):
+        """True once the background job has either succeeded or failed"""
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+    
     def __str__(self):
         return f"Analysis at ({self.latitude}, {self.longitude}) on {self.created_at.strftime('%Y-%m-%d')}"
+
+
+class RegionLayers(models.Model):
+    """Criterion maps shared by every analysis of the same region.
+    
+    Slope, elevation, wind speed, roads, land cover and Natura 2000 distance
+    only depend on the analysis region, not on weights or thresholds, so
+    their maps and Earth Engine tile URLs are rendered once per region.
+    """
+    region_hash = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
+    
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    buffer_radius = models.IntegerField()
+    
+    # Map URLs, same naming as on AnalysisParameters
+    slope_map = models.TextField(null=True, blank=True)
+    elevation_map = models.TextField(null=True, blank=True)
+    wind_speed_map = models.TextField(null=True, blank=True)
+    roads_map = models.TextField(null=True, blank=True)
+    landcover_map = models.TextField(null=True, blank=True)
+    natura_2000_map = models.TextField(null=True, blank=True)
+    
+    # Layer key -> tile URL template (the tile proxy's when settings.TILE_PROXY is set)
+    tile_urls = models.JSONField(default=dict, blank=True)
+    
+    def __str__(self):
+        return f"Region layers at ({self.latitude}, {self.longitude}) radius {self.buffer_radius} km"
+
+
+class TileLayer(models.Model):
+    """Earth Engine image served through the tile proxy (see tiles.py).
+    
+    Maps reference /tiles/<key>/{z}/{x}/{y}.png instead of an Earth Engine
+    tile URL, which stops working when its map ID expires. The serialized
+    expression lets the proxy request a new map ID whenever it needs one.
+    """
+    key = models.CharField(max_length=32, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    # ee.Image.serialize() output and the visualization parameters passed to getMapId
+    expression = models.TextField()
+    vis_params = models.JSONField(default=dict, blank=True)
+    
+    # MBTiles file with the prebuilt tiles of the layer, relative to static/maps (see pyramids.py)
+    pyramid = models.TextField(null=True, blank=True)
+    # Error of the last pyramid build that failed, cleared when a build succeeds
+    pyramid_error = models.TextField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Tile layer {self.key}"
+
+
+class MetricCounter(models.Model):
+    """Counter shared by the web and worker processes (see metrics.py).
+    
+    Increments are single UPDATE ... SET value = value + n statements, so
+    concurrent requests and workers never lose a count.
+    """
+    name = models.CharField(max_length=200, unique=True)
+    value = models.BigIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class BatchJob(models.Model):
+    """State and result rows of a batch or screening job run in the background (see batch.py).
+    
+    Kept in the database rather than the cache, so a job interrupted by a
+    restart can be reported as failed instead of running forever.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    
+    id = models.CharField(max_length=32, primary_key=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Refreshed with every progress update; jobs not updated for settings.BATCH_JOB_TIMEOUT lost their process
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    
+    status = models.CharField(max_length=10, default=STATUS_QUEUED)
+    done = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    # Columns of the rows, used for CSV downloads
+    fields = models.JSONField(default=list)
+    rows = models.JSONField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    elapsed_seconds = models.FloatField(null=True, blank=True)
+    
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+    
+    def as_state(self):
+        """Return the job as the dictionary served by the batch status view."""
+        state = {'id': self.id, 'status': self.status, 'done': self.done, 'total': self.total,
+                 'rows': self.rows, 'error': self.error, 'fields': self.fields}
+        if self.elapsed_seconds is not None:
+            state['elapsed_seconds'] = self.elapsed_seconds
+        return state
+    
+    def __str__(self):
+        return f"Batch {self.id} ({self.status})"
@@ -0,0 +1,114 @@
+# File: analysis/natura.py
+"""Natura 2000 protected sites for the natura_2000 criterion and map overlays.
+
+Sites come from a source (settings.NATURA_2000_SOURCE):
+
+- ``earthengine`` filters the Earth Engine asset for every analysis.
+- ``local`` reads the site polygons once per process from a local file into
+  a spatial index (see vector_index.py). Distance rasters for local scoring
+  are computed from the index and cached per region and scale in the raster
+  store. The map overlays and the site collection used by Earth Engine are
+  taken from the same index.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .compression import precompress
+from .vector_index import GeometryIndex, cached_distance_raster
+
+NATURA_2000_ASSET = 'projects/ee-chmilew/assets/sic'
+SOURCES = ('earthengine', 'local')
+
+# Search distance in meters. Pixels farther from every site get this distance,
+# which passes every threshold the analysis form allows.
+NATURA_MAX_DISTANCE = 50000
+# Simplification tolerance in meters for overlays and the collections sent to Earth Engine
+SIMPLIFY_TOLERANCE = 20
+LAYER_NAME = 'natura_2000_distance'
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_natura_source():
+    """Return the configured Natura 2000 source name."""
+    source = getattr(settings, 'NATURA_2000_SOURCE', 'earthengine')
+    if source not in SOURCES:
+        raise ImproperlyConfigured(f"Unknown Natura 2000 source '{source}', expected one of {list(SOURCES)}")
+    return source
+
+
+def get_natura_index():
+    """Return the process-wide index of the local Natura 2000 dataset."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            path = getattr(settings, 'NATURA_2000_DATASET_PATH', None)
+            if not path:
+                raise ImproperlyConfigured("The local Natura 2000 source needs NATURA_2000_DATASET_PATH")
+            _index = GeometryIndex(path, getattr(settings, 'NATURA_2000_DATASET_LAYER', None), label='Natura 2000')
+    return _index
+
+
+def natura_distance_for_grid(grid):
+    """Return distances to the nearest Natura 2000 site on a grid.
+
+    Returns None for the Earth Engine source, so the distances are
+    downloaded together with the other criterion bands.
+    """
+    if get_natura_source() != 'local':
+        return None
+    return cached_distance_raster(_FilledDistances(get_natura_index()), LAYER_NAME, grid, NATURA_MAX_DISTANCE)
+
+
+def natura_sites_geojson(bounds, margin=0):
+    """Return the simplified sites near a bounding box as a GeoJSON FeatureCollection.
+
+    Args:
+        bounds: (west, south, east, north) in degrees
+        margin: Distance in meters added around the bounding box
+    """
+    return get_natura_index().geojson(bounds, margin=margin, tolerance=SIMPLIFY_TOLERANCE)
+
+
+def natura_overlay_url(bounds):
+    """Write the sites near a bounding box to a static GeoJSON file once and return its URL.
+
+    The file name is derived from the dataset and the bounds, so every map
+    of a region, and every analysis of it, shares one file.
+    """
+    index = get_natura_index()
+    key = hashlib.sha256(repr((index.cache_key(), tuple(round(b, 6) for b in bounds))).encode('utf-8')).hexdigest()
+    filename = key[:32] + '.geojson'
+    output_dir = os.path.join(settings.BASE_DIR, 'static', 'maps', 'natura')
+    path = os.path.join(output_dir, filename)
+    if not os.path.exists(path):
+        os.makedirs(output_dir, exist_ok=True)
+        # Written to a temporary name first so concurrent renders never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(natura_sites_geojson(bounds), f)
+        os.replace(tmp_path, path)
+        precompress(path)
+    return '/static/maps/natura/' + filename
+
+
+class _FilledDistances:
+    """Distance source that reports pixels beyond the search distance as the search distance."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def cache_key(self):
+        return f"natura:{self.index.cache_key()}"
+
+    def distance_raster(self, grid, max_distance):
+        distances = self.index.distance_raster(grid, max_distance)
+        distances[np.isnan(distances)] = max_distance
+        return distances
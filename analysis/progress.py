@@ -0,0 +1,102 @@
+# File: analysis/progress.py
+"""Progress events of the analysis pipeline.
+
+run_suitability_analysis is split into named stages; every stage emits a
+'started' event and a 'finished' (or 'failed') event with its duration.
+Events are kept in Django's cache framework, like the job state, so the
+web process can stream them to the browser (see views.analysis_events)
+while a background worker process runs the analysis.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = 'analysis:progress:'
+
+# Pipeline stages in the order they run; map renders add one 'render' stage per map
+STAGES = ['load_layers', 'region_maps', 'score', 'render_suitability', 'statistics', 'persist']
+
+# Event statuses
+STARTED = 'started'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+# One process runs a given analysis, but its maps are rendered by several threads
+_lock = threading.Lock()
+
+
+def _key(analysis_id):
+    return KEY_PREFIX + str(analysis_id)
+
+
+def get_events(analysis_id, after=0):
+    """Return the events of an analysis with a sequence number greater than after."""
+    return [event for event in cache.get(_key(analysis_id), []) if event['seq'] > after]
+
+
+def clear_events(analysis_id):
+    """Forget the events of an earlier run of an analysis."""
+    cache.delete(_key(analysis_id))
+
+
+class ProgressReporter:
+    """Records the progress events and stage timings of one analysis run."""
+
+    def __init__(self, analysis_id=None):
+        """
+        Args:
+            analysis_id: ID of the analysis, or None to only collect timings
+        """
+        self.analysis_id = analysis_id
+        self.start = time.perf_counter()
+        self.timings = {}
+        # Name of the last stage that raised an exception
+        self.failed_stage = None
+
+    def emit(self, stage, status, **detail):
+        """Append an event to the analysis' event list.
+
+        Returns:
+            The event dictionary
+        """
+        event = {
+            'stage': stage,
+            'status': status,
+            'elapsed_s': round(time.perf_counter() - self.start, 3),
+            **detail
+        }
+        if self.analysis_id is None:
+            return event
+
+        timeout = getattr(settings, 'ANALYSIS_PROGRESS_TIMEOUT', 24 * 60 * 60)
+        with _lock:
+            events = cache.get(_key(self.analysis_id), [])
+            event['seq'] = events[-1]['seq'] + 1 if events else 1
+            events.append(event)
+            cache.set(_key(self.analysis_id), events, timeout)
+        return event
+
+    def plan(self, stages):
+        """Announce the stages this run will go through, so progress can be shown as a fraction."""
+        return self.emit('plan', STARTED, stages=list(stages))
+
+    @contextmanager
+    def stage(self, name, **detail):
+        """Emit started/finished events around a stage and record its duration.
+
+        Failures are emitted with the error message and re-raised.
+        """
+        self.emit(name, STARTED, **detail)
+        stage_start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.timings[name] = round(time.perf_counter() - stage_start, 3)
+            self.failed_stage = name
+            self.emit(name, FAILED, duration_s=self.timings[name], message=str(e), **detail)
+            raise
+        self.timings[name] = round(time.perf_counter() - stage_start, 3)
+        self.emit(name, FINISHED, duration_s=self.timings[name], **detail)
@@ -0,0 +1,394 @@
+# File: analysis/pyramids.py
+"""Prebuilt tile pyramids of finished analyses.
+
+The layers of a finished analysis never change, yet every pan and zoom of
+its maps asks the tile proxy for tiles it may not hold, and so Earth
+Engine for a server-side render. build_pyramids renders every tile of the
+region for the zoom levels around the maps' initial view
+(settings.TILE_PYRAMID_ZOOMS) into one MBTiles file per layer. The tile
+proxy then serves these tiles without going upstream (see tiles.fetch_tile).
+Finished jobs only build them when TILE_PYRAMID_ZOOMS is set.
+
+Pyramids live next to the maps they belong to, so the artifact store counts
+and evicts them with the maps:
+
+    static/maps/<analysis id>/tiles/<layer key>.mbtiles        suitability
+    static/maps/regions/<region hash>/tiles/<layer key>.mbtiles criterion layers
+
+Finished jobs hand their analysis to schedule_pyramids, which builds the
+pyramids one analysis at a time on a background thread, so the build never
+holds a job slot. Tiles are fetched by one long-lived pool of low-priority
+worker processes and written by the building thread. A zoom level is
+recorded in the file's metadata once all its tiles are written, so running
+the build again only renders the levels (and, in an interrupted level, the
+tiles) that are missing. A layer whose build fails keeps the error in
+TileLayer.pyramid_error and counts towards FAILURE_COUNTER.
+"""
+import json
+import math
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+
+from django.conf import settings
+
+from . import metrics
+from .raster_engine import region_grid
+
+PYRAMID_DIR = 'tiles'
+FILE_EXTENSION = '.mbtiles'
+# Zoom levels around the centerObject(region, 9) view of the maps
+DEFAULT_ZOOMS = (7, 11)
+# Tiles fetched per task sent to a worker process. Fetching is mostly waiting for
+# Earth Engine to render, so small batches keep every worker busy.
+BATCH_SIZE = 8
+# Custom metadata entry listing the complete zoom levels
+BUILT_ZOOMS_KEY = 'built_zooms'
+
+# Settings a worker process needs to fetch tiles the way its parent does
+WORKER_SETTINGS = ('TILE_UPSTREAM', 'TILE_UPSTREAM_TIMEOUT', 'TILE_URL_CACHE_TTL', 'EARTH_ENGINE_PROJECT', 'CACHES')
+
+FAILURE_COUNTER = 'tile_pyramid_failures'
+COUNTERS = [FAILURE_COUNTER]
+
+TILE_URL_PATTERN = re.compile(r'/tiles/([0-9a-f]{32})/\{z\}/\{x\}/\{y\}\.png$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+"""
+
+
+def tile_range(bounds, z):
+    """Return the XYZ tile columns and rows covering a bounding box at a zoom level.
+
+    Args:
+        bounds: (west, south, east, north) in degrees
+        z: Zoom level
+
+    Returns:
+        Tuple of (range of x, range of y)
+    """
+    west, south, east, north = bounds
+    n = 2 ** z
+
+    def _x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+
+    def _y(lat):
+        lat = math.radians(max(-85.0511, min(85.0511, lat)))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)))
+
+    # Rows count from the north
+    return range(_x(west), _x(east) + 1), range(_y(north), _y(south) + 1)
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _metadata(connection):
+    return dict(connection.execute('SELECT name, value FROM metadata'))
+
+
+def read_tile(path, z, x, y):
+    """Return the PNG data of a tile from an MBTiles file, or None if it holds no such tile."""
+    try:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return None
+    try:
+        # MBTiles rows count from the south (TMS), XYZ rows from the north
+        row = connection.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (z, x, 2 ** z - 1 - y)).fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        connection.close()
+    return row[0] if row else None
+
+
+def built_zooms(path):
+    """Return the complete zoom levels of an MBTiles file."""
+    if not os.path.exists(path):
+        return []
+    connection = _connect(path)
+    try:
+        return json.loads(_metadata(connection).get(BUILT_ZOOMS_KEY, '[]'))
+    finally:
+        connection.close()
+
+
+def _init_worker(overrides, setup=None):
+    """Initializer of a spawned worker process.
+
+    Spawned workers start a new interpreter, so they set up Django and Earth
+    Engine themselves. Settings the parent overrode (e.g. with
+    override_settings) are not inherited, so WORKER_SETTINGS are passed along.
+
+    Args:
+        overrides: Dictionary of setting name -> the parent's value
+        setup: Optional callable run before anything else, e.g. to install stand-in modules
+    """
+    if setup is not None:
+        setup()
+    import django
+
+    django.setup()
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    # Prebuilding tiles can wait; requests and analyses in the parent go first
+    niceness = getattr(settings, 'TILE_PYRAMID_NICENESS', 10)
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+    from .tiles import get_upstream
+
+    # Earth Engine is initialized with settings.EARTH_ENGINE_PROJECT; gee_utils, which does
+    # that in the web process, is never imported here
+    get_upstream().initialize()
+
+
+def create_pool(workers, setup=None):
+    """Start a pool of spawned worker processes fetching pyramid tiles.
+
+    Spawned rather than forked: the web process runs job and executor
+    threads, whose locks a forked child could inherit in a held state.
+
+    Args:
+        workers: Number of worker processes
+        setup: Optional picklable callable each worker runs before setting up Django
+    """
+    overrides = {name: getattr(settings, name) for name in WORKER_SETTINGS if hasattr(settings, name)}
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(overrides, setup))
+
+
+_pool = None
+_scheduler = None
+_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool of settings.TILE_PYRAMID_WORKERS workers, started on first use.
+
+    Returns:
+        The pool, or None when a single worker is configured and tiles are fetched in-process
+    """
+    global _pool
+    with _lock:
+        if _pool is None and getattr(settings, 'TILE_PYRAMID_WORKERS', 4) > 1:
+            _pool = create_pool(getattr(settings, 'TILE_PYRAMID_WORKERS', 4))
+        return _pool
+
+
+def _discard_pool(pool):
+    """Drop the shared pool after a worker died, so the next build starts a new one."""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def schedule_pyramids(params):
+    """Queue the pyramid build of a finished analysis on the background builder thread.
+
+    Builds run one at a time, in the order they were scheduled.
+
+    Args:
+        params: AnalysisParameters object
+    """
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tile-pyramid')
+    _scheduler.submit(_run_scheduled, params.id)
+
+
+def _run_scheduled(analysis_id):
+    """Builder thread entry point: build the pyramids of an analysis by ID."""
+    from django.db import close_old_connections
+
+    from .models import AnalysisParameters
+
+    close_old_connections()
+    try:
+        params = AnalysisParameters.objects.filter(id=analysis_id).first()
+        if params is not None:
+            build_pyramids(params)
+    except Exception as e:
+        # Failures of a single layer are recorded by build_pyramids; this is anything else
+        metrics.increment(FAILURE_COUNTER)
+        print(f"Error building tile pyramids of analysis {analysis_id}: {e}")
+    finally:
+        close_old_connections()
+
+
+def _fetch_tiles(layer, coords):
+    """Worker task: fetch tiles of a layer from the tile proxy's upstream.
+
+    Returns:
+        List of (z, x, y, PNG data or None where the upstream has no tile)
+    """
+    from .tiles import TileNotFound, get_upstream
+
+    upstream = get_upstream()
+    fetched = []
+    for z, x, y in coords:
+        try:
+            fetched.append((z, x, y, upstream.fetch(layer, z, x, y)))
+        except TileNotFound:
+            fetched.append((z, x, y, None))
+    return fetched
+
+
+def build_layer_pyramid(layer, path, bounds, zooms, pool=None):
+    """Render the missing zoom levels of one layer into an MBTiles file.
+
+    Args:
+        layer: TileLayer to render
+        path: MBTiles file, created if it does not exist
+        bounds: (west, south, east, north) of the region in degrees
+        zooms: (lowest, highest) zoom level
+        pool: Executor fetching the tiles, or None to fetch them in this process
+
+    Returns:
+        Number of tiles written
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = _connect(path)
+    written = 0
+    try:
+        built = set(json.loads(_metadata(connection).get(BUILT_ZOOMS_KEY, '[]')))
+        for z in range(zooms[0], zooms[1] + 1):
+            if z in built:
+                continue
+            # Tiles of a level that was interrupted are kept
+            stored = set(connection.execute('SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?', (z,)))
+            xs, ys = tile_range(bounds, z)
+            coords = [(z, x, y) for x in xs for y in ys if (x, 2 ** z - 1 - y) not in stored]
+            batches = [coords[i:i + BATCH_SIZE] for i in range(0, len(coords), BATCH_SIZE)]
+            results = pool.map(_fetch_tiles, [layer] * len(batches), batches) if pool is not None \
+                else map(_fetch_tiles, [layer] * len(batches), batches)
+            for fetched in results:
+                rows = [(z, x, 2 ** z - 1 - y, data) for _, x, y, data in fetched if data is not None]
+                connection.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', rows)
+                connection.commit()
+                written += len(rows)
+
+            built.add(z)
+            west, south, east, north = bounds
+            connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', [
+                ('name', layer.key),
+                ('format', 'png'),
+                ('type', 'overlay'),
+                ('bounds', f"{west},{south},{east},{north}"),
+                ('center', f"{(west + east) / 2},{(south + north) / 2},{min(max(9, min(built)), max(built))}"),
+                ('minzoom', str(min(built))),
+                ('maxzoom', str(max(built))),
+                (BUILT_ZOOMS_KEY, json.dumps(sorted(built))),
+            ])
+            connection.commit()
+    finally:
+        connection.close()
+    return written
+
+
+def pyramid_sources(params):
+    """Return the layers of an analysis that can be prebuilt.
+
+    Only layers served through the tile proxy, with their map still on disk,
+    are included; criterion layers that have not been rendered yet are
+    added by a later build.
+
+    Returns:
+        List of (layer name, TileLayer key, directory of its pyramid)
+    """
+    from .artifacts import REGIONS_DIR, artifact_root, url_path
+    from .models import RegionLayers
+    from .result_cache import region_hash
+
+    candidates = []
+    # The suitability map may be another analysis' when the result was reused
+    suitability_path = url_path(params.suitability_map)
+    if suitability_path and os.path.exists(suitability_path):
+        for name, tile_url in (params.tile_urls or {}).items():
+            candidates.append((name, tile_url, os.path.dirname(suitability_path)))
+    region_layers = RegionLayers.objects.filter(region_hash=region_hash(params)).first()
+    if region_layers is not None:
+        region_dir = os.path.join(artifact_root(), REGIONS_DIR, region_layers.region_hash)
+        if os.path.isdir(region_dir):
+            for name, tile_url in region_layers.tile_urls.items():
+                candidates.append((name, tile_url, region_dir))
+
+    sources = []
+    for name, tile_url, directory in candidates:
+        match = TILE_URL_PATTERN.search(tile_url or '')
+        if match:
+            sources.append((name, match.group(1), os.path.join(directory, PYRAMID_DIR)))
+    return sources
+
+
+def build_pyramids(params, zooms=None, workers=None, pool=None):
+    """Prebuild the tile pyramids of a finished analysis.
+
+    Args:
+        params: AnalysisParameters object
+        zooms: (lowest, highest) zoom level (defaults to settings.TILE_PYRAMID_ZOOMS, or
+            DEFAULT_ZOOMS when it is None)
+        workers: Worker processes of a pool started for this build; by default the shared
+            pool of get_pool() is used, 1 fetches the tiles in this process
+        pool: Pool from create_pool to fetch the tiles with instead
+
+    Returns:
+        Dictionary of layer name -> number of tiles written, or None for a layer that failed
+    """
+    from .artifacts import artifact_root
+    from .models import TileLayer
+
+    if zooms is None:
+        zooms = getattr(settings, 'TILE_PYRAMID_ZOOMS', None) or DEFAULT_ZOOMS
+    sources = pyramid_sources(params)
+    layers = TileLayer.objects.in_bulk([key for _, key, _ in sources], field_name='key')
+    sources = [source for source in sources if source[1] in layers]
+    if not sources:
+        return {}
+
+    bounds = region_grid(params.latitude, params.longitude, params.buffer_radius).bounds
+    written = {}
+    shared = pool is None and workers is None
+    if shared:
+        pool = get_pool()
+    if pool is None and workers is not None and workers > 1:
+        owned = pool = create_pool(workers)
+    else:
+        owned = nullcontext()
+    with owned, metrics.timer('map.build_pyramids'):
+        for name, key, directory in sources:
+            path = os.path.join(directory, key + FILE_EXTENSION)
+            try:
+                written[name] = build_layer_pyramid(layers[key], path, bounds, zooms, pool=pool)
+            except Exception as e:
+                written[name] = None
+                TileLayer.objects.filter(key=key).update(pyramid_error=str(e) or type(e).__name__)
+                metrics.increment(FAILURE_COUNTER)
+                print(f"Error building the {name} tile pyramid of analysis {params.id}: {e}")
+                if isinstance(e, BrokenProcessPool):
+                    # Every later layer would fail the same way
+                    if shared:
+                        _discard_pool(pool)
+                    break
+                continue
+            TileLayer.objects.filter(key=key).update(
+                pyramid=os.path.relpath(path, artifact_root()), pyramid_error=None)
+    return written
@@ -0,0 +1,396 @@
+# File: analysis/raster_engine.py
+"""Local NumPy implementation of the weighted-overlay suitability score.
+
+The six criterion layers of a region are downloaded from Earth Engine once,
+on the same EPSG:4326 grid that ``reduceRegion(scale=100)`` uses, and kept
+in the memory-mapped raster store (see raster_store.py). Scoring new weights
+or thresholds is then a vectorized NumPy operation that needs no Earth
+Engine call.
+"""
+import math
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from .raster_store import get_raster_store
+
+# Bands of a criterion stack, in order. 'valid' is 1 where every criterion
+# has data inside the region, which is where Earth Engine's score is unmasked.
+CRITERION_BANDS = ['slope', 'elevation', 'wind_speed', 'roads', 'landcover', 'natura_2000']
+STACK_BANDS = CRITERION_BANDS + ['valid']
+
+# Earth Engine converts a scale in meters to degrees with this factor for EPSG:4326
+METERS_PER_DEGREE = 2 * math.pi * 6378137 / 360
+
+DEFAULT_SCALE = 100
+
+# Every pixel meets some subset of the six criteria, so its suitability is one
+# of 2**6 values. Scoring counts pixels per subset and derives all statistics
+# from those 64 counts.
+COMBINATIONS = 2 ** len(CRITERION_BANDS)
+
+# Histogram bin edges of the suitability distribution (percent)
+HISTOGRAM_EDGES = list(range(0, 101, 10))
+
+# Suitability levels (percent) for which the share and area of the region at
+# or above the level are reported
+SUITABILITY_LEVELS = (50, 75)
+
+# Per-process cache of combination counts keyed by (region, scale, thresholds)
+COUNTS_CACHE_SIZE = 256
+_counts_cache = OrderedDict()
+_counts_lock = threading.Lock()
+
+
+class RasterGrid(namedtuple('RasterGrid', ['x0', 'y0', 'pixel_size', 'width', 'height'])):
+    """North-up EPSG:4326 pixel grid; (x0, y0) is the top-left corner in degrees."""
+
+    @property
+    def geotransform(self):
+        """GDAL-style geotransform (x0, pixel width, 0, y0, 0, -pixel height)."""
+        return (self.x0, self.pixel_size, 0.0, self.y0, 0.0, -self.pixel_size)
+
+    @property
+    def bounds(self):
+        """Bounding box (west, south, east, north) in degrees."""
+        return (self.x0, self.y0 - self.height * self.pixel_size,
+                self.x0 + self.width * self.pixel_size, self.y0)
+
+    def pixel_centers(self):
+        """Return (lon, lat) arrays of pixel center coordinates, shaped (height, width)."""
+        lons = self.x0 + (np.arange(self.width) + 0.5) * self.pixel_size
+        lats = self.y0 - (np.arange(self.height) + 0.5) * self.pixel_size
+        return np.meshgrid(lons, lats)
+
+
+def region_grid(lat, lon, buffer_km, scale=DEFAULT_SCALE):
+    """Return the grid covering a circular region at ``scale`` meters per pixel.
+
+    Pixels are aligned to multiples of the pixel size, like the default grid
+    Earth Engine reduces over when only a scale is given.
+    """
+    pixel_size = scale / METERS_PER_DEGREE
+    buffer_m = buffer_km * 1000
+    half_height = buffer_m / METERS_PER_DEGREE
+    half_width = half_height / max(math.cos(math.radians(lat)), 1e-6)
+
+    west = math.floor((lon - half_width) / pixel_size) * pixel_size
+    east = math.ceil((lon + half_width) / pixel_size) * pixel_size
+    south = math.floor((lat - half_height) / pixel_size) * pixel_size
+    north = math.ceil((lat + half_height) / pixel_size) * pixel_size
+
+    return RasterGrid(
+        x0=west,
+        y0=north,
+        pixel_size=pixel_size,
+        width=int(round((east - west) / pixel_size)),
+        height=int(round((north - south) / pixel_size))
+    )
+
+
+def pixel_area_km2(lat, scale=DEFAULT_SCALE):
+    """Approximate area in km² of one grid pixel at a latitude."""
+    return (scale / 1000) ** 2 * math.cos(math.radians(lat))
+
+
+def weights_from_params(params):
+    """Return the criterion weights of an AnalysisParameters object as a dictionary."""
+    return {
+        'slope': params.weight_slope,
+        'elevation': params.weight_elevation,
+        'wind_speed': params.weight_wind,
+        'roads': params.weight_roads,
+        'landcover': params.weight_landcover,
+        'natura_2000': params.weight_natura
+    }
+
+
+def thresholds_from_params(params):
+    """Return the criterion thresholds of an AnalysisParameters object as a dictionary."""
+    return {
+        'slope': params.threshold_slope,
+        'elevation': params.threshold_elevation,
+        'wind_speed': params.threshold_wind,
+        'roads': params.threshold_roads,
+        'natura_2000': params.threshold_natura
+    }
+
+
+def load_criterion_stack(params, scale=DEFAULT_SCALE):
+    """Return the criterion rasters for an analysis' region.
+
+    The rasters are downloaded from Earth Engine the first time a region is
+    scored and memory-mapped from the raster store afterwards.
+
+    Args:
+        params: AnalysisParameters object (only the region fields are used)
+        scale: Pixel size in meters
+
+    Returns:
+        Dictionary of STACK_BANDS name -> read-only 2-D float32 array
+    """
+    from .result_cache import region_hash
+
+    store = get_raster_store()
+    region_key = region_hash(params)
+    layers = {name: store.open(name, region_key, scale) for name in STACK_BANDS}
+    if all(layer is not None for layer in layers.values()):
+        return {name: layer.array for name, layer in layers.items()}
+
+    # Imported here so that scoring stored rasters does not need Earth Engine
+    from .gee_utils import create_region_of_interest
+
+    region = create_region_of_interest(params.latitude, params.longitude, params.buffer_radius)
+    grid = region_grid(params.latitude, params.longitude, params.buffer_radius, scale)
+    stack = fetch_criterion_stack(region, grid)
+
+    for i, name in enumerate(STACK_BANDS):
+        store.write(name, region_key, scale, stack[i], grid.geotransform)
+    return {name: stack[i] for i, name in enumerate(STACK_BANDS)}
+
+
+def fetch_criterion_stack(region, grid):
+    """Download the criterion rasters of a grid from Earth Engine.
+
+    Distance to roads is read from the precomputed road tiles (see roads.py)
+    when they cover the grid, and distance to Natura 2000 sites from the
+    local site index (see natura.py) when it is configured. Those bands are
+    left out of the Earth Engine request.
+
+    Args:
+        region: Earth Engine geometry of the area to score
+        grid: RasterGrid to sample
+
+    Returns:
+        float32 array shaped (len(STACK_BANDS), grid.height, grid.width)
+    """
+    from .gee_utils import download_criterion_rasters, load_criterion_layers
+    from .natura import natura_distance_for_grid
+    from .roads import road_distance_for_grid
+
+    layers = load_criterion_layers(region, grid.bounds)
+    local = {'roads': road_distance_for_grid(grid), 'natura_2000': natura_distance_for_grid(grid)}
+    local = {name: distances for name, distances in local.items() if distances is not None}
+    if not local:
+        return download_criterion_rasters(layers, region, grid)
+
+    bands = [name for name in CRITERION_BANDS if name not in local]
+    downloaded = download_criterion_rasters(layers, region, grid, bands=bands)
+    stack = np.empty((len(STACK_BANDS), grid.height, grid.width), dtype=np.float32)
+    for i, name in enumerate(bands + ['valid']):
+        stack[STACK_BANDS.index(name)] = downloaded[i]
+    if 'natura_2000' in local:
+        stack[STACK_BANDS.index('natura_2000')] = local['natura_2000']
+
+    if 'roads' in local:
+        # Pixels beyond the road search distance have no data, as in Earth Engine
+        roads = local['roads']
+        no_road = np.isnan(roads)
+        stack[STACK_BANDS.index('roads')] = np.where(no_road, 0, roads)
+        stack[STACK_BANDS.index('valid')][no_road] = 0
+    return stack
+
+
+def compact_stack(stack):
+    """Reduce a criterion stack to 1-D arrays of its valid pixels.
+
+    Land cover does not depend on any threshold, so it is stored directly as
+    its 0/1 suitability.
+
+    Returns:
+        Dictionary of CRITERION_BANDS name -> 1-D float32 array
+    """
+    valid = stack['valid'] > 0
+    compact = {name: np.ascontiguousarray(stack[name][valid]) for name in CRITERION_BANDS}
+    landcover = compact['landcover']
+    compact['landcover'] = ((landcover == 40) | (landcover == 30)).astype(np.float32)
+    return compact
+
+
+def load_compact_stack(params, scale=DEFAULT_SCALE):
+    """Return the valid-pixel arrays of an analysis' region from the raster store.
+
+    Returns:
+        Dictionary of CRITERION_BANDS name -> read-only 1-D float32 array
+    """
+    from .result_cache import region_hash
+
+    store = get_raster_store()
+    region_key = region_hash(params)
+    layers = {name: store.open(name + '_compact', region_key, scale) for name in CRITERION_BANDS}
+    if all(layer is not None for layer in layers.values()):
+        return {name: layer.array for name, layer in layers.items()}
+
+    compact = compact_stack(load_criterion_stack(params, scale))
+    for name, array in compact.items():
+        store.write(name + '_compact', region_key, scale, array, ())
+    return compact
+
+
+def combination_codes(compact, thresholds):
+    """Return, for every valid pixel, the bit set of criteria it meets (bit i = CRITERION_BANDS[i])."""
+    codes = (compact['slope'] <= thresholds['slope']).view(np.uint8).copy()
+    codes |= (compact['elevation'] <= thresholds['elevation']).view(np.uint8) << 1
+    codes |= (compact['wind_speed'] >= thresholds['wind_speed']).view(np.uint8) << 2
+    codes |= (compact['roads'] >= thresholds['roads']).view(np.uint8) << 3
+    codes |= compact['landcover'].astype(np.uint8) << 4
+    codes |= (compact['natura_2000'] >= thresholds['natura_2000']).view(np.uint8) << 5
+    return codes
+
+
+def combination_counts(params, thresholds, scale=DEFAULT_SCALE):
+    """Return the number of pixels meeting each subset of criteria.
+
+    Counts only depend on the thresholds, so they are cached per process and
+    a weight-only change needs no pass over the pixels.
+
+    Returns:
+        int64 array of length COMBINATIONS
+    """
+    from .result_cache import region_hash
+
+    key = (region_hash(params), scale, tuple(float(thresholds[name]) for name in sorted(thresholds)))
+    with _counts_lock:
+        if key in _counts_cache:
+            _counts_cache.move_to_end(key)
+            return _counts_cache[key]
+
+    codes = combination_codes(load_compact_stack(params, scale), thresholds)
+    counts = np.bincount(codes, minlength=COMBINATIONS)
+
+    with _counts_lock:
+        _counts_cache[key] = counts
+        while len(_counts_cache) > COUNTS_CACHE_SIZE:
+            _counts_cache.popitem(last=False)
+    return counts
+
+
+def combination_scores(weights):
+    """Return the normalized suitability (0-100) of each subset of criteria."""
+    max_score = sum(weights[name] for name in CRITERION_BANDS)
+    if max_score <= 0:
+        raise ValueError("At least one weight must be greater than zero")
+
+    weight_vector = np.array([weights[name] for name in CRITERION_BANDS], dtype=np.float64)
+    bits = (np.arange(COMBINATIONS)[:, None] >> np.arange(len(CRITERION_BANDS))) & 1
+    return bits @ weight_vector / max_score * 100
+
+
+def stats_from_counts(counts, weights, pixel_area=None):
+    """Suitability statistics and histogram from combination counts.
+
+    Args:
+        counts: Array returned by combination_counts
+        weights: Dictionary of criterion -> weight
+        pixel_area: Area of one pixel in km²; area statistics are left out if None
+
+    Returns:
+        Dictionary with mean/min/max suitability, pixel count, the share of
+        pixels meeting each criterion and reaching each of SUITABILITY_LEVELS,
+        and a histogram using HISTOGRAM_EDGES
+    """
+    scores = combination_scores(weights)
+    total = int(counts.sum())
+    present = counts > 0
+
+    # Values on an inner edge fall in the upper bin and 100 belongs to the last bin, like
+    # np.histogram. Rounding first keeps e.g. 89.99999999999999 out of the lower bin.
+    rounded = np.round(scores, 6)
+    bins = np.searchsorted(HISTOGRAM_EDGES, rounded, side='right') - 1
+    bins = np.clip(bins, 0, len(HISTOGRAM_EDGES) - 2)
+    histogram = np.bincount(bins, weights=counts, minlength=len(HISTOGRAM_EDGES) - 1)
+
+    def percent(count):
+        return round(100 * float(count) / total, 2) if total else None
+
+    if not total:
+        stats = {'mean_suitability': None, 'min_suitability': None, 'max_suitability': None}
+    else:
+        stats = {
+            'mean_suitability': round(float(counts @ scores / total), 2),
+            'min_suitability': round(float(scores[present].min()), 2),
+            'max_suitability': round(float(scores[present].max()), 2)
+        }
+    stats['pixel_count'] = total
+
+    # Bit i of a combination index is set when the pixels meet CRITERION_BANDS[i]
+    combinations = np.arange(COMBINATIONS)
+    stats['criteria_coverage'] = {
+        name: percent(counts[(combinations >> i) & 1 == 1].sum())
+        for i, name in enumerate(CRITERION_BANDS)
+    }
+    for level in SUITABILITY_LEVELS:
+        above = counts[rounded >= level].sum()
+        stats[f'percent_above_{level}'] = percent(above)
+        if pixel_area is not None:
+            stats[f'area_above_{level}_km2'] = round(float(above) * pixel_area, 2)
+    if pixel_area is not None:
+        stats['area_km2'] = round(total * pixel_area, 2)
+
+    stats['histogram'] = {
+        'edges': HISTOGRAM_EDGES,
+        'counts': [int(c) for c in histogram]
+    }
+    return stats
+
+
+def rescore(params, weights, thresholds, scale=DEFAULT_SCALE):
+    """Score an analysis' region with new weights and thresholds.
+
+    Returns:
+        Dictionary as returned by stats_from_counts
+    """
+    return stats_from_counts(combination_counts(params, thresholds, scale), weights,
+                             pixel_area_km2(params.latitude, scale))
+
+
+def score_stack(stack, weights, thresholds):
+    """Compute the normalized suitability of the valid pixels of a criterion stack.
+
+    Mirrors score_suitability in gee_utils: each criterion that meets its
+    threshold contributes its weight, and the sum is scaled to 0-100.
+
+    Args:
+        stack: Dictionary returned by load_criterion_stack
+        weights: Dictionary of criterion -> weight
+        thresholds: Dictionary of criterion -> threshold
+
+    Returns:
+        1-D float32 array of suitability values for the valid pixels
+    """
+    max_score = sum(weights[name] for name in CRITERION_BANDS)
+    if max_score <= 0:
+        raise ValueError("At least one weight must be greater than zero")
+
+    valid = stack['valid'] > 0
+    band = {name: stack[name][valid] for name in CRITERION_BANDS}
+
+    score = (band['slope'] <= thresholds['slope']) * np.float32(weights['slope'])
+    score += (band['elevation'] <= thresholds['elevation']) * np.float32(weights['elevation'])
+    score += (band['wind_speed'] >= thresholds['wind_speed']) * np.float32(weights['wind_speed'])
+    score += (band['roads'] >= thresholds['roads']) * np.float32(weights['roads'])
+    score += ((band['landcover'] == 40) | (band['landcover'] == 30)) * np.float32(weights['landcover'])
+    score += (band['natura_2000'] >= thresholds['natura_2000']) * np.float32(weights['natura_2000'])
+
+    return score * np.float32(100.0 / max_score)
+
+
+def suitability_stats(suitability):
+    """Return mean/min/max of suitability values, rounded like the Earth Engine statistics."""
+    if suitability.size == 0:
+        return {'mean_suitability': None, 'min_suitability': None, 'max_suitability': None}
+    return {
+        'mean_suitability': round(float(suitability.mean(dtype=np.float64)), 2),
+        'min_suitability': round(float(suitability.min()), 2),
+        'max_suitability': round(float(suitability.max()), 2)
+    }
+
+
+def score_params(params, scale=DEFAULT_SCALE):
+    """Score an analysis locally and return its suitability statistics.
+
+    Returns:
+        Dictionary with the same keys as compute_suitability_stats in gee_utils
+    """
+    return rescore(params, weights_from_params(params), thresholds_from_params(params), scale)
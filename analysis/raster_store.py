@@ -0,0 +1,166 @@
+# File: analysis/raster_store.py
+"""On-disk store of downloaded criterion rasters.
+
+Each (layer, region, scale) is one file: a small JSON header holding the
+shape and geotransform, followed by the raw float32 pixels. Files are opened
+as read-only memory maps, so every Django worker on a node shares the same
+page cache instead of holding its own copy of the arrays. The store is
+bounded by total size and evicts the least recently opened files.
+"""
+import json
+import os
+import struct
+import threading
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+
+MAGIC = b'WFRASTER'
+DTYPE = np.dtype('<f4')
+# Pixel data starts on a multiple of this many bytes
+HEADER_ALIGNMENT = 64
+FILE_EXTENSION = '.raster'
+
+RasterLayer = namedtuple('RasterLayer', ['array', 'geotransform', 'crs'])
+
+
+class RasterStore:
+    """Size-bounded directory of memory-mapped raster files."""
+
+    def __init__(self, root, max_bytes=None):
+        """
+        Args:
+            root: Directory holding the raster files
+            max_bytes: Total size above which the least recently used files are evicted
+        """
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, layer, region_key, scale):
+        """Path of the file holding one layer of a region at a scale."""
+        return os.path.join(self.root, f"{region_key}_{scale}m_{layer}{FILE_EXTENSION}")
+
+    def exists(self, layer, region_key, scale):
+        return os.path.exists(self.path(layer, region_key, scale))
+
+    def write(self, layer, region_key, scale, array, geotransform, crs='EPSG:4326'):
+        """Store a 2-D array and evict old files if the store is over budget.
+
+        Returns:
+            Path of the written file
+        """
+        array = np.ascontiguousarray(array, dtype=DTYPE)
+        header = json.dumps({
+            'layer': layer,
+            'region': region_key,
+            'scale': scale,
+            'dtype': DTYPE.str,
+            'shape': list(array.shape),
+            'geotransform': list(geotransform),
+            'crs': crs
+        }).encode('utf-8')
+        prefix_size = len(MAGIC) + 4 + len(header)
+        padding = -prefix_size % HEADER_ALIGNMENT
+
+        path = self.path(layer, region_key, scale)
+        os.makedirs(self.root, exist_ok=True)
+        # Write to a temporary file first so readers never map a partial raster
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header) + padding))
+            f.write(header)
+            f.write(b' ' * padding)
+            f.write(array.tobytes())
+        os.replace(tmp_path, path)
+
+        if self.max_bytes:
+            self.evict(keep={path})
+        return path
+
+    def open(self, layer, region_key, scale):
+        """Memory-map a stored layer.
+
+        Returns:
+            RasterLayer with a read-only array, or None if the layer is not stored
+        """
+        path = self.path(layer, region_key, scale)
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(f"{path} is not a raster store file")
+                (header_size,) = struct.unpack('<I', f.read(4))
+                header = json.loads(f.read(header_size).decode('utf-8'))
+        except FileNotFoundError:
+            return None
+
+        array = np.memmap(path, dtype=np.dtype(header['dtype']), mode='r',
+                          offset=len(MAGIC) + 4 + header_size, shape=tuple(header['shape']))
+
+        # The modification time doubles as the last-used time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return RasterLayer(array, tuple(header['geotransform']), header['crs'])
+
+    def _files(self):
+        """Return (mtime, size, path) for every stored file."""
+        files = []
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return files
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(FILE_EXTENSION):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def usage(self):
+        """Total size in bytes and number of stored files."""
+        files = self._files()
+        return sum(size for _, size, _ in files), len(files)
+
+    def evict(self, max_bytes=None, keep=()):
+        """Delete least recently used files until the store fits in max_bytes.
+
+        Returns:
+            List of deleted paths
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        with self._lock:
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= max_bytes:
+                    break
+                if path in keep:
+                    continue
+                try:
+                    # Existing memory maps of the file stay valid on POSIX systems
+                    os.remove(path)
+                except OSError as e:
+                    # Windows refuses to delete files that are still mapped
+                    print(f"Could not evict raster {path}: {e}")
+                    continue
+                total -= size
+                removed.append(path)
+        return removed
+
+
+_store = None
+
+
+def get_raster_store():
+    """Return the raster store configured in settings."""
+    global _store
+    if _store is None:
+        _store = RasterStore(
+            getattr(settings, 'RASTER_CACHE_DIR', os.path.join(settings.BASE_DIR, 'raster_cache')),
+            getattr(settings, 'RASTER_CACHE_MAX_BYTES', None)
+        )
+    return _store
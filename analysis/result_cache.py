@@ -0,0 +1,124 @@
+# File: analysis/result_cache.py
+"""Reuse results of earlier analyses that ran with identical parameters.
+
+Every form submission creates a new AnalysisParameters row. Submissions are
+identified by a hash of their normalized form fields, and when a finished
+analysis with the same hash exists its statistics and map artifacts are
+copied instead of running the Earth Engine pipeline again.
+"""
+import hashlib
+import json
+
+from django.utils import timezone
+
+from . import metrics
+from .forms import AnalysisForm
+from .models import AnalysisParameters
+
+# Parameters that define an analysis (the 14 form fields)
+PARAM_FIELDS = list(AnalysisForm.Meta.fields)
+
+# Parameters that define the analysis region; the criterion layers only depend on these
+REGION_FIELDS = ['latitude', 'longitude', 'buffer_radius']
+
+# Decimal places kept when normalizing float fields; everything else is compared as an integer.
+# Coordinates keep the form's 0.0001 degree step (about 11 m), weights and wind speed keep
+# two decimals so that 0.30000000000000004 and 0.3 hash the same.
+FLOAT_PRECISION = {
+    'latitude': 4,
+    'longitude': 4,
+    'weight_slope': 2,
+    'weight_elevation': 2,
+    'weight_wind': 2,
+    'weight_roads': 2,
+    'weight_landcover': 2,
+    'weight_natura': 2,
+    'threshold_wind': 2,
+}
+
+# Fields copied from a cached analysis into a new submission
+RESULT_FIELDS = [
+    'mean_suitability', 'min_suitability', 'max_suitability', 'statistics',
+    'suitability_map', 'slope_map', 'elevation_map', 'wind_speed_map',
+    'roads_map', 'landcover_map', 'natura_2000_map', 'tile_urls',
+]
+
+HIT_COUNTER = 'result_cache_hits'
+MISS_COUNTER = 'result_cache_misses'
+COUNTERS = [HIT_COUNTER, MISS_COUNTER]
+
+
+def normalize_params(params, fields=None):
+    """Return the canonical, rounded form parameters of an analysis as a dictionary."""
+    normalized = {}
+    for field in fields or PARAM_FIELDS:
+        value = getattr(params, field)
+        if field in FLOAT_PRECISION:
+            # Adding 0.0 turns -0.0 into 0.0 so both hash the same
+            normalized[field] = round(float(value), FLOAT_PRECISION[field]) + 0.0
+        else:
+            normalized[field] = int(round(float(value)))
+    return normalized
+
+
+def _digest(normalized):
+    canonical = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def params_hash(params):
+    """Return the SHA-256 hex digest identifying an analysis' parameters."""
+    return _digest(normalize_params(params))
+
+
+def region_hash(params):
+    """Return the SHA-256 hex digest identifying an analysis' region."""
+    return _digest(normalize_params(params, REGION_FIELDS))
+
+
+def find_cached_result(params):
+    """Return the most recent finished analysis with the same parameters, or None."""
+    if not params.params_hash:
+        params.params_hash = params_hash(params)
+    return AnalysisParameters.objects.filter(
+        params_hash=params.params_hash,
+        status=AnalysisParameters.STATUS_DONE,
+        suitability_map__isnull=False
+    ).exclude(id=params.id).order_by('-finished_at').first()
+
+
+def reuse_cached_result(params, count=True):
+    """Copy results from an identical finished analysis into ``params``.
+    
+    Args:
+        params: AnalysisParameters object, saved or unsaved
+        count: Whether to record the lookup in the hit/miss counters
+        
+    Returns:
+        True if a cached result was applied and saved, False otherwise
+    """
+    source = find_cached_result(params)
+    if source is None:
+        if count:
+            metrics.increment(MISS_COUNTER)
+        return False
+    
+    for field in RESULT_FIELDS:
+        setattr(params, field, getattr(source, field))
+    params.status = AnalysisParameters.STATUS_DONE
+    params.error_message = None
+    params.finished_at = timezone.now()
+    params.save()
+    if count:
+        metrics.increment(HIT_COUNTER)
+    return True
+
+
+def cache_stats():
+    """Return the result cache hit/miss counters."""
+    counters = metrics.get_counters(COUNTERS)
+    return {
+        'hits': counters[HIT_COUNTER],
+        'misses': counters[MISS_COUNTER],
+        'hit_rate': metrics.hit_rate(counters[HIT_COUNTER], counters[MISS_COUNTER])
+    }
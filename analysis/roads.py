@@ -0,0 +1,281 @@
+# File: analysis/roads.py
+"""Distance-to-roads rasters for local scoring.
+
+Road distances come from a road source (settings.ROAD_SOURCE):
+
+- ``earthengine`` rasterizes the TIGER/2016/Roads collection, which only
+  covers the US, with cumulativeCost in Earth Engine.
+- ``local`` reads a road network extract (GeoPackage, GeoJSON, shapefile)
+  once per process into a shapely STRtree (see vector_index.py) and
+  computes distances with vectorized nearest-geometry queries. Results are cached per region and
+  scale in the raster store.
+
+Either source can also be precomputed for a configured area with
+``python manage.py precompute_road_distance``, which stores square tiles on
+a global EPSG:4326 grid. Tiles use the same pixel alignment as
+raster_engine.region_grid, so a region's window is a plain array slice of
+the tiles it overlaps.
+"""
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .raster_engine import METERS_PER_DEGREE, RasterGrid
+from .raster_store import RasterStore
+from .vector_index import GeometryIndex, cached_distance_raster
+
+# Search distance in meters; pixels farther from any road have no data
+ROAD_MAX_DISTANCE = 500
+
+# Width and height of a tile in pixels
+TILE_SIZE = 1024
+LAYER_NAME = 'road_distance'
+# Tiles without any road are stored as a single no-data pixel
+EMPTY_TILE = np.full((1, 1), np.nan, dtype=np.float32)
+
+_tiles = None
+
+
+class RoadDistanceTiles:
+    """Tiled distance-to-roads raster at one scale.
+
+    Pixels farther than the maximum search distance from a road hold NaN,
+    like the masked pixels of the cumulativeCost image.
+    """
+
+    def __init__(self, root, scale, tile_size=TILE_SIZE):
+        """
+        Args:
+            root: Directory holding the tiles
+            scale: Pixel size in meters
+            tile_size: Width and height of a tile in pixels
+        """
+        self.store = RasterStore(root)
+        self.scale = scale
+        self.tile_size = tile_size
+        self.pixel_size = scale / METERS_PER_DEGREE
+
+    def tile_key(self, tx, ty):
+        return f"tile_{tx}_{ty}"
+
+    def tile_grid(self, tx, ty):
+        """Return the RasterGrid of a tile; tile (0, 0) starts at longitude 0 on the equator."""
+        return RasterGrid(
+            x0=tx * self.tile_size * self.pixel_size,
+            y0=-ty * self.tile_size * self.pixel_size,
+            pixel_size=self.pixel_size,
+            width=self.tile_size,
+            height=self.tile_size
+        )
+
+    def tiles_for_bounds(self, west, south, east, north):
+        """Return (tx, ty) of every tile overlapping a lon/lat bounding box."""
+        span = self.tile_size * self.pixel_size
+        return [(tx, ty)
+                for ty in range(math.floor(-north / span), math.ceil(-south / span))
+                for tx in range(math.floor(west / span), math.ceil(east / span))]
+
+    def has_tile(self, tx, ty):
+        return self.store.exists(LAYER_NAME, self.tile_key(tx, ty), self.scale)
+
+    def write_tile(self, tx, ty, array):
+        """Store the distances of one tile."""
+        if np.isnan(array).all():
+            array = EMPTY_TILE
+        grid = self.tile_grid(tx, ty)
+        self.store.write(LAYER_NAME, self.tile_key(tx, ty), self.scale, array, grid.geotransform)
+
+    def read(self, grid):
+        """Return the distances on a grid, or None if the tiles do not cover it.
+
+        Args:
+            grid: raster_engine.RasterGrid at the scale of the tiles
+
+        Returns:
+            float32 array shaped (grid.height, grid.width)
+        """
+        if not math.isclose(grid.pixel_size, self.pixel_size, rel_tol=1e-9):
+            return None
+
+        # Global pixel offsets of the grid's top-left corner
+        col0 = int(round(grid.x0 / self.pixel_size))
+        row0 = int(round(-grid.y0 / self.pixel_size))
+        size = self.tile_size
+
+        result = np.empty((grid.height, grid.width), dtype=np.float32)
+        for ty in range(row0 // size, (row0 + grid.height - 1) // size + 1):
+            for tx in range(col0 // size, (col0 + grid.width - 1) // size + 1):
+                tile = self.store.open(LAYER_NAME, self.tile_key(tx, ty), self.scale)
+                if tile is None:
+                    return None
+
+                # Overlap of the tile and the grid in global pixel coordinates
+                top, bottom = max(row0, ty * size), min(row0 + grid.height, (ty + 1) * size)
+                left, right = max(col0, tx * size), min(col0 + grid.width, (tx + 1) * size)
+                target = result[top - row0:bottom - row0, left - col0:right - col0]
+                if tile.array.shape == EMPTY_TILE.shape:
+                    target[:] = np.nan
+                else:
+                    target[:] = tile.array[top - ty * size:bottom - ty * size, left - tx * size:right - tx * size]
+        return result
+
+
+class RoadSource:
+    """Base class of the places distance-to-roads rasters come from."""
+
+    name = None
+    # Remote sources are downloaded together with the other criterion bands
+    remote = False
+
+    def cache_key(self):
+        """Return a string that changes whenever the source's data changes."""
+        return self.name
+
+    def distance_raster(self, grid, max_distance=ROAD_MAX_DISTANCE):
+        """Return distances in meters to the nearest road on a grid.
+
+        Args:
+            grid: raster_engine.RasterGrid to compute
+            max_distance: Search distance in meters
+
+        Returns:
+            float32 array shaped (grid.height, grid.width), NaN beyond max_distance
+        """
+        raise NotImplementedError
+
+
+class EarthEngineRoadSource(RoadSource):
+    """TIGER road collection rasterized with cumulativeCost in Earth Engine."""
+
+    name = 'earthengine'
+    remote = True
+
+    def distance_raster(self, grid, max_distance=ROAD_MAX_DISTANCE):
+        # Imported here so that local sources do not need Earth Engine
+        import ee
+        from .gee_utils import download_criterion_rasters, road_distance_image
+
+        rect = ee.Geometry.Rectangle(
+            [grid.x0, grid.y0 - grid.height * grid.pixel_size, grid.x0 + grid.width * grid.pixel_size, grid.y0],
+            'EPSG:4326', False)
+        stack = download_criterion_rasters({'roads': road_distance_image(rect, max_distance)}, rect, grid,
+                                           max_workers=1, bands=['roads'])
+        return np.where(stack[1] > 0, stack[0], np.nan).astype(np.float32)
+
+
+class LocalRoadSource(RoadSource):
+    """Road network read from a local vector file into a shapely STRtree."""
+
+    name = 'local'
+
+    def __init__(self, path, layer=None):
+        """
+        Args:
+            path: GeoPackage, GeoJSON or shapefile with road lines
+            layer: Layer to read from a multi-layer file such as a GeoPackage
+        """
+        self.index = GeometryIndex(path, layer, label='Road')
+
+    def cache_key(self):
+        return f"{self.name}:{self.index.cache_key()}"
+
+    def distance_raster(self, grid, max_distance=ROAD_MAX_DISTANCE):
+        return self.index.distance_raster(grid, max_distance)
+
+
+ROAD_SOURCES = {
+    EarthEngineRoadSource.name: EarthEngineRoadSource,
+    LocalRoadSource.name: LocalRoadSource,
+}
+
+_source = None
+
+
+def create_road_source(name, path=None, layer=None):
+    """Create a road source by name."""
+    if name not in ROAD_SOURCES:
+        raise ImproperlyConfigured(f"Unknown road source '{name}', expected one of {sorted(ROAD_SOURCES)}")
+    if name == LocalRoadSource.name:
+        if not path:
+            raise ImproperlyConfigured("The local road source needs ROAD_DATASET_PATH")
+        return LocalRoadSource(path, layer)
+    return ROAD_SOURCES[name]()
+
+
+def get_road_source():
+    """Return the road source configured in settings."""
+    global _source
+    if _source is None:
+        _source = create_road_source(
+            getattr(settings, 'ROAD_SOURCE', EarthEngineRoadSource.name),
+            getattr(settings, 'ROAD_DATASET_PATH', None),
+            getattr(settings, 'ROAD_DATASET_LAYER', None)
+        )
+    return _source
+
+
+def get_road_tiles():
+    """Return the road distance tiles configured in settings."""
+    global _tiles
+    if _tiles is None:
+        _tiles = RoadDistanceTiles(
+            getattr(settings, 'ROAD_DISTANCE_DIR', os.path.join(settings.BASE_DIR, 'road_distance')),
+            getattr(settings, 'ROAD_DISTANCE_SCALE', 100)
+        )
+    return _tiles
+
+
+def road_distance_for_grid(grid):
+    """Return distances to roads on a grid without a separate Earth Engine request.
+
+    Precomputed tiles are used when they cover the grid. Otherwise local
+    sources compute the distances (cached per region and scale in the raster
+    store), while for the Earth Engine source None is returned so the roads
+    are downloaded together with the other criterion bands.
+    """
+    distances = get_road_tiles().read(grid)
+    if distances is not None:
+        return distances
+
+    source = get_road_source()
+    if source.remote:
+        return None
+
+    return cached_distance_raster(source, 'road_distance_' + source.name, grid, ROAD_MAX_DISTANCE)
+
+
+def precompute_road_tiles(bounds, overwrite=False, max_workers=None, progress=None, source=None):
+    """Compute and store the distance-to-roads tiles covering a bounding box.
+
+    Args:
+        bounds: (west, south, east, north) in degrees
+        overwrite: Recompute tiles that are already stored
+        max_workers: Maximum number of tiles computed at once
+        progress: Optional callable receiving (tiles done, total tiles)
+        source: RoadSource to compute from, the configured source by default
+
+    Returns:
+        Number of tiles computed
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, 'RASTER_DOWNLOAD_WORKERS', 4)
+    if source is None:
+        source = get_road_source()
+    tiles = get_road_tiles()
+    todo = [tile for tile in tiles.tiles_for_bounds(*bounds) if overwrite or not tiles.has_tile(*tile)]
+
+    def _compute(tile):
+        tiles.write_tile(*tile, source.distance_raster(tiles.tile_grid(*tile)))
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='road-tiles') as pool:
+        for future in [pool.submit(_compute, tile) for tile in todo]:
+            future.result()
+            done += 1
+            if progress:
+                progress(done, len(todo))
+    return done
@@ -0,0 +1,353 @@
+# File: analysis/screening.py
+"""Grid screening of a whole area, such as a department or a country.
+
+Instead of analysing one point and buffer at a time, a bounding box is
+tiled into square cells and every cell is scored in one batched pass:
+
+- ``earthengine`` stacks the suitability and criterion bands and reduces
+  them over a FeatureCollection of all cells with a single reduceRegions
+  request.
+- ``local`` downloads the criterion rasters of the area once (kept in the
+  raster store) and computes zonal statistics for every cell at once by
+  counting criterion combinations per cell with NumPy.
+
+The ranked cells can then be analysed in detail with batch.run_batch, see
+cells_to_sites.
+"""
+import hashlib
+import math
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+from .batch import build_site_params, default_parameters
+from .raster_engine import (COMBINATIONS, CRITERION_BANDS, METERS_PER_DEGREE, STACK_BANDS, SUITABILITY_LEVELS,
+                            RasterGrid, combination_codes, combination_scores, compact_stack,
+                            fetch_criterion_stack, thresholds_from_params, weights_from_params)
+from .raster_store import get_raster_store
+
+ENGINES = ('earthengine', 'local')
+# Statistics a screening can be ranked by, best first
+RANK_FIELDS = ('mean_suitability', 'percent_above_50', 'percent_above_75')
+
+STAT_FIELDS = ['mean_suitability', 'min_suitability', 'max_suitability', 'pixel_count'] + [
+    f'percent_above_{level}' for level in SUITABILITY_LEVELS] + [
+    f'{name}_coverage' for name in CRITERION_BANDS]
+OUTPUT_FIELDS = ['rank', 'cell_id', 'latitude', 'longitude', 'west', 'south', 'east', 'north'] + STAT_FIELDS
+
+# Raster store key prefix of the criterion stacks downloaded for an area
+STACK_KEY_PREFIX = 'screening-'
+
+
+class CellLayout(namedtuple('CellLayout', ['grid', 'cell_rows', 'cell_cols', 'rows', 'cols'])):
+    """Square cells of cell_rows x cell_cols pixels covering a grid."""
+
+    @property
+    def count(self):
+        return self.rows * self.cols
+
+    def cell_bounds(self, index):
+        """Bounding box (west, south, east, north) of a cell in degrees."""
+        row, col = divmod(index, self.cols)
+        pixel = self.grid.pixel_size
+        west = self.grid.x0 + col * self.cell_cols * pixel
+        north = self.grid.y0 - row * self.cell_rows * pixel
+        return (west, north - self.cell_rows * pixel, west + self.cell_cols * pixel, north)
+
+    def cell_index(self):
+        """Cell index of every grid pixel, shaped (grid.height, grid.width)."""
+        rows = np.arange(self.grid.height) // self.cell_rows
+        cols = np.arange(self.grid.width) // self.cell_cols
+        return rows[:, None] * self.cols + cols[None, :]
+
+
+def cell_layout(bounds, cell_km, scale):
+    """Tile a bounding box into square cells.
+
+    The grid is aligned to multiples of the pixel size like
+    raster_engine.region_grid and extended to a whole number of cells.
+    Pixels are square in degrees, so a cell spans more pixels east-west than
+    north-south to be square in meters at the center latitude.
+
+    Args:
+        bounds: (west, south, east, north) in degrees
+        cell_km: Cell size in kilometers
+        scale: Pixel size in meters
+    """
+    west, south, east, north = bounds
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        raise ValueError("Bounds must be (west, south, east, north) with west < east and south < north")
+    if cell_km * 1000 < scale:
+        raise ValueError(f"Cells must be at least one pixel ({scale} m) wide")
+
+    pixel_size = scale / METERS_PER_DEGREE
+    cell_rows = max(1, int(round(cell_km * 1000 / scale)))
+    cell_cols = max(1, int(round(cell_rows / max(math.cos(math.radians((south + north) / 2)), 1e-6))))
+
+    x0 = math.floor(west / pixel_size) * pixel_size
+    y0 = math.ceil(north / pixel_size) * pixel_size
+    cols = math.ceil((east - x0) / pixel_size / cell_cols)
+    rows = math.ceil((y0 - south) / pixel_size / cell_rows)
+    grid = RasterGrid(x0=x0, y0=y0, pixel_size=pixel_size, width=cols * cell_cols, height=rows * cell_rows)
+    return CellLayout(grid, cell_rows, cell_cols, rows, cols)
+
+
+def cell_counts(stack, layout, thresholds):
+    """Count, for every cell, the pixels meeting each subset of criteria.
+
+    Args:
+        stack: Dictionary of STACK_BANDS name -> 2-D array on layout.grid
+        layout: CellLayout of the stack
+        thresholds: Dictionary of criterion -> threshold
+
+    Returns:
+        int64 array shaped (layout.count, COMBINATIONS)
+    """
+    valid = stack['valid'] > 0
+    codes = combination_codes(compact_stack(stack), thresholds).astype(np.int64)
+    cells = layout.cell_index()[valid]
+    return np.bincount(cells * COMBINATIONS + codes,
+                       minlength=layout.count * COMBINATIONS).reshape(layout.count, COMBINATIONS)
+
+
+def cell_stats(counts, weights):
+    """Suitability statistics of every cell from its combination counts.
+
+    The vectorized counterpart of raster_engine.stats_from_counts.
+
+    Returns:
+        Dictionary of STAT_FIELDS name -> float array with NaN for empty cells
+    """
+    scores = combination_scores(weights)
+    rounded = np.round(scores, 6)
+    total = counts.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = 100 / np.where(total > 0, total, np.nan)
+        present = counts > 0
+        stats = {
+            'mean_suitability': counts @ scores / np.where(total > 0, total, np.nan),
+            'min_suitability': np.where(present, scores, np.inf).min(axis=1),
+            'max_suitability': np.where(present, scores, -np.inf).max(axis=1),
+            'pixel_count': total.astype(np.float64)
+        }
+        for key in ('min_suitability', 'max_suitability'):
+            stats[key][total == 0] = np.nan
+        for level in SUITABILITY_LEVELS:
+            stats[f'percent_above_{level}'] = counts[:, rounded >= level].sum(axis=1) * share
+        combinations = np.arange(COMBINATIONS)
+        for i, name in enumerate(CRITERION_BANDS):
+            stats[f'{name}_coverage'] = counts[:, (combinations >> i) & 1 == 1].sum(axis=1) * share
+    return stats
+
+
+def load_area_stack(grid):
+    """Return the criterion rasters of a screening grid, downloading them only once.
+
+    Returns:
+        Dictionary of STACK_BANDS name -> 2-D float32 array
+    """
+    store = get_raster_store()
+    key = STACK_KEY_PREFIX + hashlib.sha256(repr(tuple(grid)).encode('utf-8')).hexdigest()
+    scale = int(round(grid.pixel_size * METERS_PER_DEGREE))
+    layers = {name: store.open(name, key, scale) for name in STACK_BANDS}
+    if all(layer is not None for layer in layers.values()):
+        return {name: layer.array for name, layer in layers.items()}
+
+    # Imported here so that screening stored areas does not need Earth Engine
+    import ee
+
+    region = ee.Geometry.Rectangle(list(grid.bounds), 'EPSG:4326', False)
+    stack = fetch_criterion_stack(region, grid)
+    for i, name in enumerate(STACK_BANDS):
+        store.write(name, key, scale, stack[i], grid.geotransform)
+    return {name: stack[i] for i, name in enumerate(STACK_BANDS)}
+
+
+def _screen_local(layout, params):
+    counts = cell_counts(load_area_stack(layout.grid), layout, thresholds_from_params(params))
+    return cell_stats(counts, weights_from_params(params))
+
+
+def _screen_earthengine(layout, params, scale):
+    # Imported here so that local screening of stored areas does not need Earth Engine
+    import ee
+    from .gee_utils import criterion_masks, load_criterion_layers, score_suitability
+
+    region = ee.Geometry.Rectangle(list(layout.grid.bounds), 'EPSG:4326', False)
+    layers = load_criterion_layers(region, layout.grid.bounds)
+    masks = criterion_masks(layers, params)
+    suitability = score_suitability(layers, params, masks).rename('suitability')
+
+    bands = [suitability]
+    for level in SUITABILITY_LEVELS:
+        bands.append(suitability.gte(level).rename(f'above_{level}'))
+    for name, mask in masks.items():
+        # Coverage is measured over the scored pixels, like the local engine
+        bands.append(mask.unmask(0).updateMask(suitability.mask()).rename(f'{name}_ok'))
+
+    cells = ee.FeatureCollection([
+        ee.Feature(ee.Geometry.Rectangle(list(layout.cell_bounds(i)), 'EPSG:4326', False), {'cell': i})
+        for i in range(layout.count)
+    ])
+    reducer = ee.Reducer.mean() \
+        .combine(ee.Reducer.minMax(), None, True) \
+        .combine(ee.Reducer.count(), None, True)
+    with metrics.timer('ee.reduce_regions'):
+        features = ee.Image.cat(bands).reduceRegions(
+            collection=cells,
+            reducer=reducer,
+            scale=scale,
+            crs='EPSG:4326',
+            tileScale=4
+        ).getInfo()['features']
+
+    stats = {field: np.full(layout.count, np.nan) for field in STAT_FIELDS}
+    sources = {
+        'mean_suitability': ('suitability_mean', 1),
+        'min_suitability': ('suitability_min', 1),
+        'max_suitability': ('suitability_max', 1),
+        'pixel_count': ('suitability_count', 1)
+    }
+    sources.update({f'percent_above_{level}': (f'above_{level}_mean', 100) for level in SUITABILITY_LEVELS})
+    sources.update({f'{name}_coverage': (f'{name}_ok_mean', 100) for name in CRITERION_BANDS})
+    for feature in features:
+        properties = feature['properties']
+        for field, (key, factor) in sources.items():
+            if properties.get(key) is not None:
+                stats[field][properties['cell']] = properties[key] * factor
+    return stats
+
+
+def screening_params(bounds, shared=None):
+    """Validate shared weights and thresholds with the analysis form.
+
+    Returns:
+        Unsaved AnalysisParameters centered on the bounding box
+    """
+    west, south, east, north = bounds
+    site = {'latitude': (south + north) / 2, 'longitude': (west + east) / 2}
+    _, params, error = build_site_params(site, {**default_parameters(), **(shared or {})}, 0)
+    if params is None:
+        raise ValueError(error)
+    return params
+
+
+ScreeningPlan = namedtuple('ScreeningPlan', ['params', 'layout', 'scale', 'engine', 'rank_by'])
+
+
+def prepare_screening(bounds, cell_km=None, shared=None, engine=None, scale=None, rank_by='mean_suitability'):
+    """Validate the options of a screening and build its cell layout.
+
+    Args:
+        bounds: (west, south, east, north) in degrees
+        cell_km: Cell size in kilometers (defaults to settings.SCREENING_CELL_KM)
+        shared: Weights and thresholds as form field names; missing values use the form defaults
+        engine: 'earthengine' or 'local' (defaults to settings.SCREENING_ENGINE)
+        scale: Pixel size in meters (defaults to settings.SCREENING_SCALE)
+        rank_by: One of RANK_FIELDS
+
+    Returns:
+        ScreeningPlan
+
+    Raises:
+        ValueError: If an option is invalid or the area has too many cells or pixels
+    """
+    if engine is None:
+        engine = getattr(settings, 'SCREENING_ENGINE', 'earthengine')
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown screening engine '{engine}', expected one of {list(ENGINES)}")
+    if rank_by not in RANK_FIELDS:
+        raise ValueError(f"Cannot rank by '{rank_by}', expected one of {list(RANK_FIELDS)}")
+    if cell_km is None:
+        cell_km = getattr(settings, 'SCREENING_CELL_KM', 10)
+    if scale is None:
+        scale = getattr(settings, 'SCREENING_SCALE', 1000)
+
+    try:
+        bounds = tuple(float(b) for b in bounds)
+        cell_km = float(cell_km)
+    except (TypeError, ValueError):
+        raise ValueError("Bounds and cell size must be numbers")
+    if len(bounds) != 4:
+        raise ValueError("Bounds must be (west, south, east, north)")
+    layout = cell_layout(bounds, cell_km, scale)
+
+    max_cells = getattr(settings, 'SCREENING_MAX_CELLS', 5000)
+    if layout.count > max_cells:
+        raise ValueError(f"The area has {layout.count} cells, at most {max_cells} are allowed; "
+                         f"use larger cells or a smaller area")
+    max_pixels = getattr(settings, 'SCREENING_MAX_PIXELS', 25_000_000)
+    if layout.grid.width * layout.grid.height > max_pixels:
+        raise ValueError(f"The area has {layout.grid.width * layout.grid.height} pixels, at most {max_pixels} "
+                         f"are allowed; use a coarser scale or a smaller area")
+    return ScreeningPlan(screening_params(bounds, shared), layout, scale, engine, rank_by)
+
+
+def screen_area(bounds, cell_km=None, shared=None, top=None, engine=None, scale=None,
+                rank_by='mean_suitability', min_coverage=0.5):
+    """Score every cell of a bounding box and rank the cells.
+
+    Args:
+        bounds, cell_km, shared, engine, scale, rank_by: See prepare_screening
+        top: Number of best cells to return, all ranked cells if None
+        min_coverage: Share of a cell's pixels that must have data for it to be ranked,
+            which leaves out cells mostly at sea or outside the datasets
+
+    Returns:
+        List of rows with the OUTPUT_FIELDS keys, best cell first
+    """
+    params, layout, scale, engine, rank_by = prepare_screening(bounds, cell_km, shared, engine, scale, rank_by)
+    if engine == 'local':
+        stats = _screen_local(layout, params)
+    else:
+        stats = _screen_earthengine(layout, params, scale)
+
+    min_pixels = min_coverage * layout.cell_rows * layout.cell_cols
+    ranked = [i for i in range(layout.count)
+              if stats['pixel_count'][i] >= min_pixels and not np.isnan(stats[rank_by][i])]
+    ranked.sort(key=lambda i: (-stats[rank_by][i], -stats['mean_suitability'][i], i))
+    if top is not None:
+        ranked = ranked[:top]
+
+    rows = []
+    for rank, i in enumerate(ranked, start=1):
+        west, south, east, north = layout.cell_bounds(i)
+        row = {
+            'rank': rank,
+            'cell_id': 'r{}c{}'.format(*divmod(i, layout.cols)),
+            'latitude': round((south + north) / 2, 6),
+            'longitude': round((west + east) / 2, 6),
+            'west': round(west, 6),
+            'south': round(south, 6),
+            'east': round(east, 6),
+            'north': round(north, 6)
+        }
+        for field in STAT_FIELDS:
+            value = float(stats[field][i])
+            row[field] = None if math.isnan(value) else (int(value) if field == 'pixel_count' else round(value, 2))
+        rows.append(row)
+    return rows
+
+
+def cells_to_sites(rows, buffer_km=None):
+    """Turn ranked cells into sites for a detailed analysis with batch.run_batch.
+
+    Args:
+        rows: Rows returned by screen_area
+        buffer_km: Buffer radius of each site, by default half the cell size
+    """
+    sites = []
+    for row in rows:
+        radius = buffer_km
+        if radius is None:
+            radius = (row['north'] - row['south']) * METERS_PER_DEGREE / 2000
+        sites.append({
+            'name': row['cell_id'],
+            'latitude': row['latitude'],
+            'longitude': row['longitude'],
+            # Clamped to the range the analysis form accepts
+            'buffer_radius': int(min(100, max(5, round(radius))))
+        })
+    return sites
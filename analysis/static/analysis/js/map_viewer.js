@@ -0,0 +1,127 @@
+// File: analysis/static/analysis/js/map_viewer.js
+// Shared Leaflet viewer for the JSON layer specs written by gee_utils.create_layer_spec.
+// One map is created per page and the displayed layer is swapped when a tab is opened,
+// so the page loads Leaflet once instead of one self-contained HTML map per layer.
+(function () {
+    'use strict';
+
+    const OUTLINE_STYLE = {color: '#FF0000', weight: 2, fill: false};
+
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }
+
+    function colorbarHtml(title, visParams) {
+        const palette = (visParams.palette || []).map(color => /^[0-9a-fA-F]{6}$/.test(color) ? `#${color}` : color);
+        return `
+            <div class="map-viewer-title">${escapeHtml(title)}</div>
+            <div style="height: 12px; width: 220px; background: linear-gradient(to right, ${palette.join(', ')});"></div>
+            <div style="display: flex; justify-content: space-between;">
+                <span>${visParams.min}</span><span>${visParams.max}</span>
+            </div>`;
+    }
+
+    function legendHtml(legend) {
+        const rows = legend.entries.map(([label, color]) => `
+            <div><span style="display: inline-block; width: 12px; height: 12px; background: ${color};
+                margin-right: 6px; border: 1px solid #999;"></span>${escapeHtml(label)}</div>`);
+        return `<div class="map-viewer-title">${escapeHtml(legend.title)}</div>${rows.join('')}`;
+    }
+
+    function infoControl(position) {
+        const control = L.control({position: position});
+        control.onAdd = function () {
+            const div = L.DomUtil.create('div', 'map-viewer-info');
+            div.style.cssText = 'background: white; padding: 6px 8px; border-radius: 4px; font-size: 12px;' +
+                'box-shadow: 0 1px 4px rgba(0, 0, 0, 0.3);';
+            return div;
+        };
+        return control;
+    }
+
+    class MapViewer {
+        constructor(element) {
+            this.map = L.map(element);
+            L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+                attribution: '&copy; OpenStreetMap contributors'
+            }).addTo(this.map);
+            this.specs = {};
+            this.layers = [];
+            this.colorbar = infoControl('bottomright').addTo(this.map);
+            this.legend = null;
+            this.current = null;
+        }
+
+        loadSpec(url) {
+            if (!this.specs[url]) {
+                this.specs[url] = fetch(url).then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Could not load map layer ${url}: ${response.status}`);
+                    }
+                    return response.json();
+                });
+            }
+            return this.specs[url];
+        }
+
+        overlayLayer(overlay) {
+            if (!overlay.geojson_url) {
+                return L.tileLayer(overlay.tile_url);
+            }
+            // Site polygons from the local index are shared by every layer of the region,
+            // so the file is fetched once and drawn by Leaflet
+            const layer = L.geoJSON(null, {style: overlay.style});
+            this.loadSpec(overlay.geojson_url)
+                .then(data => layer.addData(data))
+                .catch(error => console.error(error));
+            return layer;
+        }
+
+        show(url) {
+            this.current = url;
+            return this.loadSpec(url).then(spec => {
+                // Ignore layers that finished loading after another tab was opened
+                if (this.current === url) {
+                    this.draw(spec);
+                }
+                return spec;
+            });
+        }
+
+        draw(spec) {
+            this.layers.forEach(layer => this.map.removeLayer(layer));
+            this.layers = [
+                L.tileLayer(spec.tile_url, {attribution: spec.attribution})
+            ];
+            spec.overlays.forEach(overlay => this.layers.push(this.overlayLayer(overlay)));
+
+            const outline = L.circle(spec.region.center, {...OUTLINE_STYLE, radius: spec.region.radius_m});
+            this.layers.push(outline);
+            this.layers.forEach(layer => layer.addTo(this.map));
+
+            // Keep the view when switching layers of the same region
+            if (!this.extent) {
+                this.map.fitBounds(outline.getBounds());
+                this.extent = spec.region;
+            }
+
+            this.colorbar.getContainer().innerHTML = colorbarHtml(spec.title, spec.vis_params);
+            if (this.legend) {
+                this.map.removeControl(this.legend);
+                this.legend = null;
+            }
+            if (spec.legend) {
+                this.legend = infoControl('bottomleft').addTo(this.map);
+                this.legend.getContainer().innerHTML = legendHtml(spec.legend);
+            }
+        }
+
+        invalidateSize() {
+            this.map.invalidateSize();
+        }
+    }
+
+    window.MapViewer = MapViewer;
+})();
@@ -0,0 +1,58 @@
+# File: analysis/test_runner.py
+"""Test runner running the test suite against the offline Earth Engine stand-in.
+
+The analysis pipeline (gee_utils) imports ``ee`` and ``geemap`` and
+initializes Earth Engine when it is first used. Tests must neither need the client libraries nor make requests
+with the developer's credentials, so the benchmarks' stand-ins
+(benchmarks/offline_ee.py, offline_geemap.py, offline_tiles.py) are
+installed before any test module is imported, with no simulated latency.
+Maps, rasters and tiles are written to a temporary directory instead of
+the project's.
+"""
+import os
+import shutil
+import tempfile
+
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+TEST_SETTINGS = {
+    'TILE_UPSTREAM': 'analysis.benchmarks.offline_tiles.OfflineUpstream',
+    # Nothing cached by a development server or an earlier run is reused
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                           'LOCATION': 'analysis-tests'}},
+    # No background thread writes metrics while a test holds the database; tests flush explicitly
+    'METRICS_FLUSH_INTERVAL': None,
+}
+
+
+class OfflineTestRunner(DiscoverRunner):
+    """DiscoverRunner that installs the offline Earth Engine stand-ins first."""
+
+    def setup_test_environment(self, **kwargs):
+        from .benchmarks import offline_ee
+        from .benchmarks.runner import install
+
+        install()
+        offline_ee.configure(latency=0, jitter=0, seconds_per_km2=0)
+        self._directory = tempfile.mkdtemp(prefix='analysis-tests-')
+        self._settings = override_settings(**TEST_SETTINGS, **{
+            'BASE_DIR': self._directory,
+            'RASTER_CACHE_DIR': os.path.join(self._directory, 'raster_cache'),
+            'ROAD_DISTANCE_DIR': os.path.join(self._directory, 'road_distance'),
+            'TILE_CACHE_DIR': os.path.join(self._directory, 'tile_cache'),
+        })
+        self._settings.enable()
+        super().setup_test_environment(**kwargs)
+
+    def teardown_databases(self, old_config, **kwargs):
+        from . import metrics
+
+        # Counters left by the last tests would otherwise be flushed at exit, after the test database is gone
+        metrics.flush()
+        super().teardown_databases(old_config, **kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        super().teardown_test_environment(**kwargs)
+        self._settings.disable()
+        shutil.rmtree(self._directory, ignore_errors=True)
@@ -1,3 +1,1601 @@
-from django.test import TestCase
+# File: analysis/tests.py
+import gzip
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import artifacts, compression, jobs
+from .batch import OUTPUT_FIELDS, default_parameters
+from .models import AnalysisParameters
+from .raster_engine import (COMBINATIONS, CRITERION_BANDS, DEFAULT_SCALE, HISTOGRAM_EDGES, METERS_PER_DEGREE,
+                            STACK_BANDS, SUITABILITY_LEVELS, RasterGrid, combination_codes, compact_stack,
+                            score_stack, stats_from_counts, suitability_stats, thresholds_from_params,
+                            weights_from_params)
+from .raster_store import HEADER_ALIGNMENT, RasterStore, get_raster_store
+from .result_cache import params_hash, region_hash
+from .roads import EMPTY_TILE, LocalRoadSource, RoadDistanceTiles
+
+WEIGHTS = {'slope': 0.2, 'elevation': 0.1, 'wind_speed': 0.3, 'roads': 0.15, 'landcover': 0.1, 'natura_2000': 0.15}
+THRESHOLDS = {'slope': 15, 'elevation': 2000, 'wind_speed': 6.5, 'roads': 5000, 'natura_2000': 1000}
+
+FORM_VALUES = {
+    'latitude': 45.1234, 'longitude': 2.5678, 'buffer_radius': 25,
+    'weight_slope': 0.2, 'weight_elevation': 0.1, 'weight_wind': 0.3, 'weight_roads': 0.15,
+    'weight_landcover': 0.1, 'weight_natura': 0.15,
+    'threshold_slope': 15, 'threshold_elevation': 2000, 'threshold_wind': 6.5, 'threshold_roads': 5000,
+    'threshold_natura': 1000,
+}
+
+
+def temporary_base_dir(test, **overrides):
+    """Point BASE_DIR (static/maps, tile cache) at a temporary directory for the duration of a test.
+
+    Map eviction and tile pyramids are off unless a test turns them on.
+    """
+    base_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, base_dir, ignore_errors=True)
+    settings = override_settings(**{'BASE_DIR': base_dir, 'TILE_CACHE_DIR': os.path.join(base_dir, 'tile_cache'),
+                                    'ARTIFACT_MAX_BYTES': None, 'TILE_PYRAMID_ZOOMS': None, **overrides})
+    settings.enable()
+    test.addCleanup(settings.disable)
+    return base_dir
+
+
+def synthetic_stack(seed=0, size=40):
+    """Return a criterion stack with no-data pixels and values on every threshold.
+
+    No-data pixels hold NaN in one criterion and 0 in 'valid', as downloaded
+    from Earth Engine (see fetch_criterion_stack).
+    """
+    rng = np.random.default_rng(seed)
+    shape = (size, size)
+    stack = {
+        'slope': rng.uniform(0, 30, shape),
+        'elevation': rng.uniform(0, 4000, shape),
+        'wind_speed': rng.uniform(3, 10, shape),
+        'roads': rng.uniform(0, 10000, shape),
+        'landcover': rng.choice([10, 20, 30, 40, 50], shape).astype(float),
+        'natura_2000': rng.uniform(0, 2000, shape),
+    }
+    # Pixels exactly on a threshold meet it (lte/gte)
+    for name, threshold in THRESHOLDS.items():
+        stack[name][rng.random(shape) < 0.1] = threshold
+    stack = {name: values.astype(np.float32) for name, values in stack.items()}
+
+    valid = np.ones(shape, dtype=np.float32)
+    for name in CRITERION_BANDS:
+        missing = rng.random(shape) < 0.05
+        stack[name][missing] = np.nan
+        valid[missing] = 0
+    # Outside the circular region
+    valid[:3] = 0
+    stack['valid'] = valid
+    return stack
+
+
+def earth_engine_stats(stack, weights, thresholds):
+    """Statistics of a stack computed pixel by pixel like reduceRegion in compute_suitability_stats.
+
+    Pixels where any criterion is masked are left out; every other pixel
+    adds the weights of the criteria it meets.
+    """
+    max_score = sum(weights.values())
+    scores, met = [], {name: 0 for name in CRITERION_BANDS}
+    for index in np.ndindex(stack['valid'].shape):
+        values = {name: float(stack[name][index]) for name in CRITERION_BANDS}
+        if not stack['valid'][index] or any(np.isnan(value) for value in values.values()):
+            continue
+        meets = {
+            'slope': values['slope'] <= thresholds['slope'],
+            'elevation': values['elevation'] <= thresholds['elevation'],
+            'wind_speed': values['wind_speed'] >= thresholds['wind_speed'],
+            'roads': values['roads'] >= thresholds['roads'],
+            'landcover': values['landcover'] in (30, 40),
+            'natura_2000': values['natura_2000'] >= thresholds['natura_2000'],
+        }
+        for name, ok in meets.items():
+            met[name] += ok
+        scores.append(sum(weights[name] for name, ok in meets.items() if ok) / max_score * 100)
+
+    scores = np.array(scores)
+    stats = {
+        'mean_suitability': round(float(scores.mean()), 2),
+        'min_suitability': round(float(scores.min()), 2),
+        'max_suitability': round(float(scores.max()), 2),
+        'pixel_count': len(scores),
+        'criteria_coverage': {name: round(100 * count / len(scores), 2) for name, count in met.items()},
+        # fixedHistogram with 100 moved into the last bin counts like np.histogram
+        'histogram': {'edges': HISTOGRAM_EDGES,
+                      'counts': [int(c) for c in np.histogram(np.round(scores, 6), HISTOGRAM_EDGES)[0]]},
+    }
+    for level in SUITABILITY_LEVELS:
+        stats[f'percent_above_{level}'] = round(100 * float((np.round(scores, 6) >= level).mean()), 2)
+    return stats
+
+
+class LocalScoringTests(SimpleTestCase):
+    """The local engine must give the statistics Earth Engine's reduceRegion gives."""
+
+    # Equal weights put scores exactly on 50 and on the histogram edges
+    WEIGHT_SETS = [WEIGHTS, dict.fromkeys(CRITERION_BANDS, 1.0), {**dict.fromkeys(CRITERION_BANDS, 1.0), 'landcover': 0}]
+
+    def _counts(self, stack, thresholds):
+        codes = combination_codes(compact_stack(stack), thresholds)
+        return np.bincount(codes, minlength=COMBINATIONS)
+
+    def test_stats_from_counts_match_earth_engine(self):
+        for seed in range(3):
+            stack = synthetic_stack(seed)
+            counts = self._counts(stack, THRESHOLDS)
+            for weights in self.WEIGHT_SETS:
+                with self.subTest(seed=seed, weights=weights):
+                    expected = earth_engine_stats(stack, weights, THRESHOLDS)
+                    local = stats_from_counts(counts, weights)
+                    for key, value in expected.items():
+                        self.assertEqual(local[key], value, key)
+
+    def test_score_stack_matches_earth_engine(self):
+        stack = synthetic_stack(1)
+        for weights in self.WEIGHT_SETS:
+            with self.subTest(weights=weights):
+                expected = earth_engine_stats(stack, weights, THRESHOLDS)
+                local = suitability_stats(score_stack(stack, weights, THRESHOLDS))
+                for key in ('mean_suitability', 'min_suitability', 'max_suitability'):
+                    self.assertEqual(local[key], expected[key], key)
+
+    def test_no_data_pixels_are_not_scored(self):
+        stack = synthetic_stack(2)
+        no_data = np.zeros(stack['valid'].shape, dtype=bool)
+        for name in CRITERION_BANDS:
+            no_data |= np.isnan(stack[name])
+        self.assertTrue(no_data.any())
+        self.assertEqual(int(self._counts(stack, THRESHOLDS).sum()), int((stack['valid'] > 0).sum()))
+        self.assertFalse((no_data & (stack['valid'] > 0)).any())
+
+    def test_threshold_edges_are_met(self):
+        # One valid pixel with every criterion exactly on its threshold
+        stack = {name: np.array([[THRESHOLDS.get(name, 40)]], dtype=np.float32) for name in CRITERION_BANDS}
+        stack['valid'] = np.ones((1, 1), dtype=np.float32)
+        stats = stats_from_counts(self._counts(stack, THRESHOLDS), WEIGHTS)
+        self.assertEqual(stats['min_suitability'], 100)
+        self.assertEqual(stats['histogram']['counts'][-1], 1)
+
+    def test_empty_region(self):
+        stack = synthetic_stack(0, size=4)
+        stack['valid'][:] = 0
+        stats = stats_from_counts(self._counts(stack, THRESHOLDS), WEIGHTS)
+        self.assertIsNone(stats['mean_suitability'])
+        self.assertEqual(stats['pixel_count'], 0)
+
+    def test_zero_weights_are_rejected(self):
+        with self.assertRaises(ValueError):
+            stats_from_counts(np.ones(COMBINATIONS), dict.fromkeys(CRITERION_BANDS, 0))
+
+
+class ParamsHashTests(SimpleTestCase):
+
+    def test_equal_parameters_hash_equal(self):
+        a = AnalysisParameters(**FORM_VALUES)
+        b = AnalysisParameters(**{**FORM_VALUES, 'weight_slope': 0.1 + 0.1, 'latitude': 45.12341})
+        self.assertEqual(params_hash(a), params_hash(b))
+
+    def test_negative_zero_hashes_like_zero(self):
+        a = AnalysisParameters(**{**FORM_VALUES, 'longitude': 0.0})
+        b = AnalysisParameters(**{**FORM_VALUES, 'longitude': -0.0})
+        self.assertEqual(params_hash(a), params_hash(b))
+
+    def test_every_parameter_changes_the_hash(self):
+        base = params_hash(AnalysisParameters(**FORM_VALUES))
+        for field, value in FORM_VALUES.items():
+            with self.subTest(field=field):
+                changed = AnalysisParameters(**{**FORM_VALUES, field: value + 1})
+                self.assertNotEqual(params_hash(changed), base)
+
+
+class NegotiateTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'map.html')
+        for suffix in ('', '.gz', '.br'):
+            with open(self.path + suffix, 'w') as f:
+                f.write('map')
+
+    def test_preferred_encoding(self):
+        self.assertEqual(compression.negotiate('gzip, deflate, br', self.path), (self.path + '.br', 'br'))
+        self.assertEqual(compression.negotiate('gzip', self.path), (self.path + '.gz', 'gzip'))
+
+    def test_quality_values(self):
+        self.assertEqual(compression.negotiate('br;q=0.5, gzip', self.path), (self.path + '.gz', 'gzip'))
+        self.assertEqual(compression.negotiate('br;q=0, gzip;q=0', self.path), (self.path, None))
+        self.assertEqual(compression.negotiate('*;q=0.1, br;q=0', self.path), (self.path + '.gz', 'gzip'))
+        self.assertEqual(compression.negotiate('gzip;q=x', self.path), (self.path, None))
+
+    def test_identity_without_header_or_copies(self):
+        self.assertEqual(compression.negotiate('', self.path), (self.path, None))
+        os.remove(self.path + '.br')
+        os.remove(self.path + '.gz')
+        self.assertEqual(compression.negotiate('br, gzip', self.path), (self.path, None))
+
+
+class RoadDistanceTilesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.tiles = RoadDistanceTiles(self.directory, scale=100, tile_size=4)
+
+    def _global(self, rows, cols):
+        # Value of a pixel encodes its global row and column
+        return (rows[:, None] * 1000 + cols[None, :]).astype(np.float32)
+
+    def _write(self, tx, ty):
+        size = self.tiles.tile_size
+        self.tiles.write_tile(tx, ty, self._global(np.arange(ty * size, (ty + 1) * size),
+                                                   np.arange(tx * size, (tx + 1) * size)))
+
+    def test_grid_across_tiles(self):
+        for tx in (0, 1):
+            for ty in (0, 1):
+                self._write(tx, ty)
+        size = self.tiles.pixel_size
+        grid = self.tiles.tile_grid(0, 0)._replace(x0=2 * size, y0=-3 * size, width=5, height=4)
+        np.testing.assert_array_equal(self.tiles.read(grid), self._global(np.arange(3, 7), np.arange(2, 7)))
+
+    def test_empty_tile_reads_as_no_data(self):
+        self._write(0, 0)
+        self.tiles.write_tile(1, 0, np.full((4, 4), np.nan, dtype=np.float32))
+        self.assertEqual(self.tiles.store.open('road_distance', 'tile_1_0', 100).array.shape, EMPTY_TILE.shape)
+        grid = self.tiles.tile_grid(0, 0)._replace(x0=2 * self.tiles.pixel_size, width=4)
+        result = self.tiles.read(grid)
+        np.testing.assert_array_equal(result[:, :2], self._global(np.arange(4), np.arange(2, 4)))
+        self.assertTrue(np.isnan(result[:, 2:]).all())
+
+    def test_missing_tile_or_other_scale(self):
+        self._write(0, 0)
+        grid = self.tiles.tile_grid(0, 0)
+        self.assertIsNone(self.tiles.read(grid._replace(width=5)))
+        self.assertIsNone(self.tiles.read(grid._replace(pixel_size=grid.pixel_size * 2)))
+
+
+class ArtifactEvictionTests(TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        settings = override_settings(BASE_DIR=self.base_dir, ARTIFACT_MIN_AGE=60, ARTIFACT_MAX_BYTES=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def _analysis(self, viewed_days_ago, status=AnalysisParameters.STATUS_DONE, size=1000):
+        params = AnalysisParameters.objects.create(status=status, **FORM_VALUES)
+        directory = os.path.join(artifacts.artifact_root(), str(params.id))
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'map_suitability.json'), 'wb') as f:
+            f.write(b'x' * size)
+        # Old enough to be evicted
+        old = time.time() - 3600
+        os.utime(os.path.join(directory, 'map_suitability.json'), (old, old))
+        os.utime(directory, (old, old))
+        params.suitability_map = f"{artifacts.STATIC_URL_PREFIX}{params.id}/map_suitability.json"
+        params.last_viewed_at = timezone.now() - timedelta(days=viewed_days_ago)
+        params.save()
+        return params, directory
+
+    def test_least_recently_viewed_is_evicted_first(self):
+        old, old_dir = self._analysis(viewed_days_ago=5)
+        recent, recent_dir = self._analysis(viewed_days_ago=1)
+        evicted, total = artifacts.prune(max_bytes=1500)
+        self.assertEqual([artifact.key for artifact in evicted], [str(old.id)])
+        self.assertEqual(total, 1000)
+        self.assertFalse(os.path.exists(old_dir))
+        self.assertTrue(os.path.exists(recent_dir))
+        old.refresh_from_db()
+        self.assertIsNone(old.suitability_map)
+
+    def test_running_and_recent_directories_are_protected(self):
+        self._analysis(viewed_days_ago=5, status=AnalysisParameters.STATUS_RUNNING)
+        _, fresh_dir = self._analysis(viewed_days_ago=4)
+        os.utime(os.path.join(fresh_dir, 'map_suitability.json'))
+        evicted, total = artifacts.prune(max_bytes=0)
+        self.assertEqual(evicted, [])
+        self.assertEqual(total, 2000)
+
+    def test_dry_run_keeps_files(self):
+        _, directory = self._analysis(viewed_days_ago=5)
+        evicted, _ = artifacts.prune(max_bytes=0, dry_run=True)
+        self.assertEqual(len(evicted), 1)
+        self.assertTrue(os.path.exists(directory))
+
+
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        temporary_base_dir(self)
+
+    def _job(self, status=AnalysisParameters.STATUS_QUEUED, **fields):
+        return AnalysisParameters.objects.create(status=status, **{**FORM_VALUES, **fields})
+
+    def test_form_post_queues_the_analysis(self):
+        with mock.patch.object(jobs, '_submit') as submit, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('analysis:index'), FORM_VALUES)
+        params = AnalysisParameters.objects.get()
+        self.assertRedirects(response, reverse('analysis:results', args=[params.id]), fetch_redirect_response=False)
+        self.assertEqual(params.status, AnalysisParameters.STATUS_QUEUED)
+        submit.assert_called_once_with(params.id)
+
+    def test_job_is_claimed_once(self):
+        params = self._job()
+        self.assertEqual(jobs.claim_job(params.id).status, AnalysisParameters.STATUS_RUNNING)
+        self.assertIsNone(jobs.claim_job(params.id))
+
+    def test_oldest_job_is_claimed_first(self):
+        first = self._job()
+        self._job()
+        self.assertEqual(jobs.claim_next_job().id, first.id)
+
+    def test_finished_job_records_outcome(self):
+        params = self._job()
+        results = {'success': True, 'timings': {'region': 1.5}}
+        with mock.patch('analysis.gee_utils.run_suitability_analysis', return_value=results):
+            jobs.run_job(params.id)
+        params.refresh_from_db()
+        self.assertEqual(params.status, AnalysisParameters.STATUS_DONE)
+        self.assertIsNotNone(params.finished_at)
+        self.assertEqual(params.timings['region'], 1.5)
+
+    def test_errors_fail_the_job(self):
+        for target in ('analysis.gee_utils.run_suitability_analysis', 'analysis.result_cache.reuse_cached_result'):
+            with self.subTest(target=target):
+                params = self._job()
+                with mock.patch(target, side_effect=RuntimeError('quota exceeded')):
+                    jobs.run_job(params.id)
+                params.refresh_from_db()
+                self.assertEqual(params.status, AnalysisParameters.STATUS_FAILED)
+                self.assertEqual(params.error_message, 'quota exceeded')
+
+    def test_stale_running_jobs_are_requeued(self):
+        stale = self._job(AnalysisParameters.STATUS_RUNNING, started_at=timezone.now() - timedelta(hours=1))
+        fresh = self._job(AnalysisParameters.STATUS_RUNNING, started_at=timezone.now())
+        with override_settings(ANALYSIS_JOB_TIMEOUT=60):
+            self.assertEqual(jobs.requeue_stale_jobs(), 1)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, stale.started_at), (AnalysisParameters.STATUS_QUEUED, None))
+        self.assertEqual(fresh.status, AnalysisParameters.STATUS_RUNNING)
+
+    def test_status_view_resubmits_lost_jobs(self):
+        stale = self._job(AnalysisParameters.STATUS_RUNNING, started_at=timezone.now() - timedelta(hours=1))
+        with override_settings(ANALYSIS_JOB_TIMEOUT=60), mock.patch.object(jobs, '_submit') as submit:
+            response = self.client.get(reverse('analysis:status', args=[stale.id]))
+        self.assertEqual(response.json()['status'], AnalysisParameters.STATUS_QUEUED)
+        submit.assert_called_once_with(stale.id)
+
+
+class RenderMapsTests(TransactionTestCase):
+    # Maps register their tile layers from the render threads, which cannot see a test transaction
+
+    def setUp(self):
+        self.output_dir = os.path.join(temporary_base_dir(self), 'maps')
+        from . import gee_utils
+
+        self.gee_utils = gee_utils
+        self.region = gee_utils.create_region_of_interest(45.1, 2.5, 10)
+        self.images = gee_utils.load_criterion_layers(self.region)
+        self.extent = gee_utils.region_extent(45.1, 2.5, 10)
+
+    def _peak_concurrency(self, max_workers):
+        """Render every map, returning the largest number of tile URLs requested at once."""
+        lock, active, peak = threading.Lock(), [0], [0]
+
+        def _slow_tile_url(image, vis_params):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return '/tiles/' + '0' * 32 + '/{z}/{x}/{y}.png'
+
+        with mock.patch.object(self.gee_utils, 'get_tile_url', _slow_tile_url):
+            self.gee_utils.render_maps(self.images, self.region, self.output_dir, max_workers=max_workers,
+                                       extent=self.extent)
+        return peak[0]
+
+    def test_every_map_is_written(self):
+        # One worker: SQLite's shared in-memory test database does not take concurrent writes
+        paths, tile_urls, timings = self.gee_utils.render_maps(self.images, self.region, self.output_dir,
+                                                                max_workers=1, extent=self.extent)
+        self.assertEqual(set(paths), set(self.images))
+        for key, path in paths.items():
+            self.assertTrue(os.path.isfile(path), key)
+            self.assertRegex(tile_urls[key], r'^/tiles/[0-9a-f]{32}/\{z\}/\{x\}/\{y\}\.png$')
+        self.assertEqual(set(timings), set(self.images))
+
+    def test_workers_bound_concurrency(self):
+        self.assertEqual(self._peak_concurrency(max_workers=1), 1)
+        self.assertEqual(self._peak_concurrency(max_workers=3), 3)
+
+    def test_failed_map_fails_the_render(self):
+        with mock.patch.object(self.gee_utils, 'create_layer_spec', side_effect=OSError('disk full')):
+            with self.assertRaisesMessage(OSError, 'disk full'):
+                self.gee_utils.render_maps(self.images, self.region, self.output_dir, extent=self.extent)
+
+
+class RegionLayersTests(TransactionTestCase):
+
+    def setUp(self):
+        # One render thread, see RenderMapsTests
+        temporary_base_dir(self, ANALYSIS_MAP_WORKERS=1, ANALYSIS_LAZY_LAYERS=False)
+        from . import gee_utils
+
+        self.gee_utils = gee_utils
+
+    def _run(self, **fields):
+        params = AnalysisParameters.objects.create(**{**FORM_VALUES, **fields})
+        results = self.gee_utils.run_suitability_analysis(params)
+        self.assertTrue(results['success'], results.get('error_message'))
+        return params, results
+
+    def test_region_hash_ignores_weights_and_thresholds(self):
+        a = AnalysisParameters(**FORM_VALUES)
+        b = AnalysisParameters(**{**FORM_VALUES, 'weight_slope': 0.5, 'threshold_wind': 8})
+        c = AnalysisParameters(**{**FORM_VALUES, 'buffer_radius': 30})
+        self.assertEqual(region_hash(a), region_hash(b))
+        self.assertNotEqual(region_hash(a), region_hash(c))
+
+    def test_criterion_maps_are_rendered_once_per_region(self):
+        first, first_results = self._run()
+        second, second_results = self._run(weight_slope=0.5, threshold_wind=8)
+        self.assertEqual(set(first_results['timings']['maps']), {*CRITERION_BANDS, 'suitability'})
+        self.assertEqual(set(second_results['timings']['maps']), {'suitability'})
+        for name in CRITERION_BANDS:
+            self.assertEqual(getattr(second, name + '_map'), getattr(first, name + '_map'))
+            self.assertIn(f"/regions/{region_hash(first)}/", getattr(first, name + '_map'))
+        self.assertNotEqual(second.suitability_map, first.suitability_map)
+
+    def test_only_requested_layers_are_rendered(self):
+        params = AnalysisParameters.objects.create(**FORM_VALUES)
+        region = self.gee_utils.create_region_of_interest(params.latitude, params.longitude, params.buffer_radius)
+        layers = self.gee_utils.load_criterion_layers(region)
+        region_layers, timings = self.gee_utils.get_region_maps(params, layers, region, names=['slope'])
+        self.assertEqual(set(timings), {'slope'})
+        self.assertIsNone(region_layers.roads_map)
+        _, timings = self.gee_utils.get_region_maps(params, layers, region, names=['slope', 'roads'])
+        self.assertEqual(set(timings), {'roads'})
+
+
+class RasterStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = RasterStore(self.directory)
+        self.array = np.arange(12, dtype=np.float32).reshape(3, 4)
+
+    def test_round_trip(self):
+        self.store.write('slope', 'abc', 100, self.array, (0, 100, 0, 0, 0, -100))
+        layer = self.store.open('slope', 'abc', 100)
+        np.testing.assert_array_equal(layer.array, self.array)
+        self.assertIsInstance(layer.array, np.memmap)
+        self.assertFalse(layer.array.flags.writeable)
+        self.assertEqual(layer.geotransform, (0, 100, 0, 0, 0, -100))
+        self.assertEqual(layer.crs, 'EPSG:4326')
+        self.assertEqual(layer.array.offset % HEADER_ALIGNMENT, 0)
+
+    def test_missing_and_foreign_files(self):
+        self.assertIsNone(self.store.open('slope', 'abc', 100))
+        with open(self.store.path('slope', 'abc', 100), 'wb') as f:
+            f.write(b'not a raster')
+        with self.assertRaises(ValueError):
+            self.store.open('slope', 'abc', 100)
+
+    def test_least_recently_opened_are_evicted(self):
+        size = os.path.getsize(self.store.write('a', 'r', 100, self.array, (0,) * 6))
+        self.store.write('b', 'r', 100, self.array, (0,) * 6)
+        old = time.time() - 60
+        os.utime(self.store.path('b', 'r', 100), (old - 60, old - 60))
+        os.utime(self.store.path('a', 'r', 100), (old, old))
+        # Opening b makes a the least recently used file
+        self.store.open('b', 'r', 100)
+        self.store.max_bytes = 2 * size
+        self.store.write('c', 'r', 100, self.array, (0,) * 6)
+        self.assertFalse(self.store.exists('a', 'r', 100))
+        self.assertTrue(self.store.exists('b', 'r', 100))
+        self.assertTrue(self.store.exists('c', 'r', 100))
+        self.assertEqual(self.store.usage(), (2 * size, 2))
+
+
+def store_stack(params, stack):
+    """Put a criterion stack in the raster store as the downloaded rasters of an analysis' region."""
+    for name in STACK_BANDS:
+        get_raster_store().write(name, region_hash(params), DEFAULT_SCALE, stack[name], ())
+
+
+class RescoreTests(TestCase):
+
+    def setUp(self):
+        # Its own region, so combination counts cached by other tests do not apply
+        self.params = AnalysisParameters.objects.create(
+            status=AnalysisParameters.STATUS_DONE, **{**FORM_VALUES, 'latitude': 12.3456})
+        self.stack = synthetic_stack(3)
+        store_stack(self.params, self.stack)
+        self.url = reverse('analysis:rescore', args=[self.params.id])
+
+    def test_new_weights_and_thresholds(self):
+        response = self.client.get(self.url, {'weight_slope': 0.6, 'threshold_wind': 7})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['weights']['slope'], 0.6)
+        self.assertEqual(data['thresholds']['wind_speed'], 7)
+        expected = earth_engine_stats(self.stack, data['weights'], data['thresholds'])
+        for key in ('mean_suitability', 'min_suitability', 'max_suitability', 'pixel_count'):
+            self.assertEqual(data['stats'][key], expected[key], key)
+
+    def test_invalid_values_are_rejected(self):
+        no_weights = {field: 0 for field in FORM_VALUES if field.startswith('weight_')}
+        for query in ({'weight_slope': 'x'}, {'weight_slope': 'nan'}, {'threshold_roads': 'inf'},
+                      {'weight_wind': -1}, no_weights):
+            with self.subTest(query=query):
+                response = self.client.get(self.url, query)
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(response.json()['success'])
+
+    def test_scoring_failure_is_not_a_client_error(self):
+        with mock.patch('analysis.views.rescore', side_effect=ValueError('corrupt raster')):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+
+    def test_only_get(self):
+        self.assertEqual(self.client.post(self.url, {}, content_type='application/json').status_code, 405)
+
+
+def wait_for_job(test, url, timeout=10):
+    """Poll a batch or screening status URL until the job finished and return its state."""
+    deadline = time.monotonic() + timeout
+    while True:
+        state = test.client.get(url).json()
+        if state['status'] in ('done', 'failed') or time.monotonic() > deadline:
+            return state
+        time.sleep(0.05)
+
+
+class BatchApiTests(TransactionTestCase):
+    """The batch API as called by scripts: without a session, so CSRF checks must not apply."""
+
+    SHARED = {key: value for key, value in FORM_VALUES.items() if key.startswith(('weight_', 'threshold_'))}
+
+    def setUp(self):
+        self.client = Client(enforce_csrf_checks=True)
+        self.url = reverse('analysis:batch')
+        # Far enough apart to be scored separately from their stored rasters
+        self.sites = [{'name': 'north', 'latitude': 13.5, 'longitude': 3.25},
+                      {'name': 'south', 'latitude': 11.5, 'longitude': 3.25}]
+        self.expected = {}
+        for seed, site in enumerate(self.sites):
+            params = AnalysisParameters(**{**FORM_VALUES, **{k: site[k] for k in ('latitude', 'longitude')}})
+            stack = synthetic_stack(seed)
+            store_stack(params, stack)
+            self.expected[site['name']] = earth_engine_stats(stack, weights_from_params(params),
+                                                             thresholds_from_params(params))
+
+    def assert_rows(self, rows):
+        by_name = {row['name']: row for row in rows}
+        for name, expected in self.expected.items():
+            self.assertIsNone(by_name[name]['error'], name)
+            for key in ('mean_suitability', 'pixel_count'):
+                self.assertEqual(by_name[name][key], expected[key], name)
+
+    def test_json_batch(self):
+        response = self.client.post(self.url, {'sites': self.sites + [{'name': 'bad', 'latitude': 200, 'longitude': 0}],
+                                               'parameters': {**self.SHARED, 'buffer_radius': 25}},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        state = wait_for_job(self, response.json()['status_url'])
+        self.assertEqual(state['status'], 'done')
+        self.assert_rows(state['rows'])
+        # An invalid site only fails its own row
+        self.assertIn('latitude', state['rows'][2]['error'])
+
+    def test_csv_batch(self):
+        body = 'name,latitude,longitude,buffer_radius\n' + ''.join(
+            f"{site['name']},{site['latitude']},{site['longitude']},25\n" for site in self.sites)
+        # CSV bodies carry no parameters, the form defaults are used
+        self.expected = {}
+        for seed, site in enumerate(self.sites):
+            params = AnalysisParameters(**{**default_parameters(), 'latitude': site['latitude'],
+                                           'longitude': site['longitude'], 'buffer_radius': 25})
+            self.expected[site['name']] = earth_engine_stats(synthetic_stack(seed), weights_from_params(params),
+                                                             thresholds_from_params(params))
+        response = self.client.post(self.url, body, content_type='text/csv')
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        state = wait_for_job(self, status_url)
+        self.assertEqual(state['status'], 'done')
+        self.assert_rows(state['rows'])
+
+        download = self.client.get(status_url, {'format': 'csv'})
+        self.assertEqual(download['Content-Type'], 'text/csv')
+        self.assertTrue(download.content.decode().startswith(','.join(OUTPUT_FIELDS)))
+
+    def test_invalid_batches_are_rejected(self):
+        for data in ({'sites': []}, {'sites': self.sites, 'parameters': [0.5]},
+                     {'sites': self.sites, 'parameters': {'weight_slope': 'x'}},
+                     {'sites': self.sites, 'parameters': {'latitude': 10}},
+                     {'sites': self.sites + ['50.1,2.3']}):
+            with self.subTest(data=data):
+                response = self.client.post(self.url, data, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(response.json()['success'])
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+    def test_unknown_batch(self):
+        self.assertEqual(self.client.get(reverse('analysis:batch_status', args=['missing'])).status_code, 404)
+
+
+class CombinedStatisticsTests(SimpleTestCase):
+    """compute_suitability_stats against the offline Earth Engine stand-in."""
+
+    def setUp(self):
+        import ee
+        from .benchmarks import offline_ee
+
+        self.ee = ee
+        self.region = ee.Geometry.Point([2.5, 45.0]).buffer(25000)
+        self.masks = {name: ee.Image(name).gt(0) for name in ('slope', 'wind_speed')}
+        offline_ee.request_counts()
+
+    def test_one_round_trip(self):
+        from .benchmarks import offline_ee
+        from .gee_utils import compute_suitability_stats
+
+        stats = compute_suitability_stats(self.ee.Image('suitability'), self.region, self.masks)
+        self.assertEqual(offline_ee.request_counts(), {'reduceRegion': 1})
+        self.assertEqual(stats['mean_suitability'], 52.5)
+        self.assertEqual(stats['histogram']['edges'], HISTOGRAM_EDGES)
+        self.assertEqual(len(stats['histogram']['counts']), len(HISTOGRAM_EDGES) - 1)
+        self.assertEqual(set(stats['criteria_coverage']), set(self.masks))
+
+    def test_reducer_outputs_are_converted(self):
+        from .benchmarks import offline_ee
+        from .gee_utils import compute_suitability_stats
+
+        response = {
+            'suitability_mean': 61.234, 'suitability_min': 12.0, 'suitability_max': 98.5, 'suitability_count': 400,
+            'above_50_mean': 0.625, 'above_75_mean': 0.25, 'area_above_50_sum': 2.5, 'area_above_75_sum': 1.0,
+            'area_km2_sum': 4.004, 'slope_ok_mean': 0.5, 'wind_speed_ok_mean': None,
+            'histogram_histogram': [[edge, 40.0] for edge in HISTOGRAM_EDGES[:-1]],
+        }
+        with mock.patch.object(offline_ee.Expression, 'getInfo', return_value=response):
+            stats = compute_suitability_stats(self.ee.Image('suitability'), self.region, self.masks)
+        self.assertEqual(stats['mean_suitability'], 61.23)
+        self.assertEqual((stats['min_suitability'], stats['max_suitability']), (12.0, 98.5))
+        self.assertEqual(stats['pixel_count'], 400)
+        self.assertEqual((stats['percent_above_50'], stats['percent_above_75']), (62.5, 25.0))
+        self.assertEqual((stats['area_above_50_km2'], stats['area_above_75_km2']), (2.5, 1.0))
+        self.assertEqual(stats['area_km2'], 4.0)
+        self.assertEqual(stats['criteria_coverage'], {'slope': 50.0, 'wind_speed': None})
+        self.assertEqual(stats['histogram']['counts'], [40] * (len(HISTOGRAM_EDGES) - 1))
+
+
+class LayerSpecTests(SimpleTestCase):
+    """JSON layer specs written for the shared map viewer and served by map_file."""
+
+    def setUp(self):
+        temporary_base_dir(self)
+        self.root = artifacts.artifact_root()
+
+    def write_spec(self, palette=('red', 'green'), **kwargs):
+        from .gee_utils import create_layer_spec, region_extent
+
+        return create_layer_spec({'min': 0, 'max': 100, 'palette': list(palette)}, 'Land Cover',
+                                 'https://tiles.example/{z}/{x}/{y}', region_extent(45.0, 2.5, 25),
+                                 overlays=[{'name': 'Natura 2000 Sites', 'tile_url': 'https://overlay/{z}/{x}/{y}'}],
+                                 output_dir=self.root, **kwargs)
+
+    def test_spec_file(self):
+        from .gee_utils import LANDCOVER_LEGEND
+
+        spec, path = self.write_spec(landcover_legend=True)
+        self.assertTrue(path.endswith('.json'))
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), spec)
+        self.assertEqual(spec['tile_url'], 'https://tiles.example/{z}/{x}/{y}')
+        self.assertEqual(spec['region'], {'center': [45.0, 2.5], 'radius_m': 25000})
+        self.assertEqual(len(spec['legend']['entries']), len(LANDCOVER_LEGEND))
+        self.assertEqual(spec['overlays'][0]['name'], 'Natura 2000 Sites')
+        self.assertIsNone(self.write_spec()[0]['legend'])
+
+    def test_served_compressed_and_immutable(self):
+        # Large enough to be precompressed
+        spec, path = self.write_spec(palette=[f'{i:06x}' for i in range(200)])
+        self.assertGreaterEqual(os.path.getsize(path), compression.MIN_SIZE)
+        url = artifacts.served_url(artifacts.STATIC_URL_PREFIX + os.path.basename(path))
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(json.loads(gzip.decompress(b''.join(response.streaming_content))), spec)
+
+        response = self.client.get(url)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), spec)
+
+    def test_only_map_files_are_served(self):
+        _, path = self.write_spec(landcover_legend=True)
+        name = os.path.basename(path)
+        for served in (name + '.gz', '../' + name, 'missing.json'):
+            with self.subTest(path=served):
+                response = self.client.get(reverse('analysis:map_file', args=[served]))
+                self.assertEqual(response.status_code, 404)
+
+
+class AnalysisLayerTests(TransactionTestCase):
+    """Criterion maps rendered on demand when their tab is opened (ANALYSIS_LAZY_LAYERS)."""
+
+    def setUp(self):
+        temporary_base_dir(self, ANALYSIS_MAP_WORKERS=1, ANALYSIS_LAZY_LAYERS=True)
+        # Its own region, so no other test has rendered its maps
+        self.params = AnalysisParameters.objects.create(
+            status=AnalysisParameters.STATUS_DONE, **{**FORM_VALUES, 'latitude': 23.4567})
+
+    def url(self, name, params=None):
+        return reverse('analysis:layer', args=[(params or self.params).id, name])
+
+    def test_rendered_on_first_request(self):
+        data = self.client.get(self.url('slope')).json()
+        self.assertTrue(data['success'])
+        self.assertTrue(data['rendered'])
+        self.params.refresh_from_db()
+        self.assertEqual(data['url'], artifacts.served_url(self.params.slope_map))
+        self.assertIsNone(self.params.roads_map)
+
+        data = self.client.get(self.url('slope')).json()
+        self.assertFalse(data['rendered'])
+        self.assertEqual(data['url'], artifacts.served_url(self.params.slope_map))
+
+    def test_unknown_or_unfinished(self):
+        self.assertEqual(self.client.get(self.url('suitability')).status_code, 404)
+        running = AnalysisParameters.objects.create(status=AnalysisParameters.STATUS_RUNNING, **FORM_VALUES)
+        self.assertEqual(self.client.get(self.url('slope', running)).status_code, 409)
+
+    def test_render_failure(self):
+        with mock.patch('analysis.gee_utils.render_analysis_layer', side_effect=RuntimeError('quota')):
+            response = self.client.get(self.url('slope'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error'], 'quota')
+
+
+class TileUrlCacheTests(TestCase):
+
+    def setUp(self):
+        import ee
+        from django.core.cache import cache
+        from .benchmarks import offline_ee
+
+        cache.clear()
+        self.image = ee.Image('USGS/SRTMGL1_003').clip(ee.Geometry.Point([2.5, 45.0]).buffer(25000))
+        self.requests = offline_ee.request_counts
+        self.requests()
+
+    def counters(self):
+        from . import tile_cache
+
+        stats = tile_cache.cache_stats()
+        return stats['hits'], stats['misses'], stats['refreshes']
+
+    def test_map_id_is_requested_once(self):
+        from .tile_cache import get_map_id
+
+        before = self.counters()
+        first = get_map_id(self.image, {'min': 0, 'max': 3000})
+        second = get_map_id(self.image, {'max': 3000, 'min': 0})
+        self.assertEqual(second, first)
+        self.assertEqual(self.requests(), {'getMapId': 1})
+        get_map_id(self.image, {'min': 0, 'max': 1000})
+        self.assertEqual(self.requests(), {'getMapId': 1})
+        after = self.counters()
+        self.assertEqual((after[0] - before[0], after[1] - before[1]), (1, 2))
+
+    def test_refreshed_before_expiry(self):
+        from .tile_cache import REFRESH_MARGIN, get_map_id
+
+        entry = get_map_id(self.image, {}, ttl=3600)
+        self.assertGreater(entry['expires_at'] - time.time(), 3500)
+        before = self.counters()
+        with mock.patch('analysis.tile_cache.time.time', return_value=entry['expires_at'] - REFRESH_MARGIN + 1):
+            refreshed = get_map_id(self.image, {}, ttl=3600)
+        self.assertGreater(refreshed['expires_at'], entry['expires_at'])
+        self.assertEqual(self.counters()[2] - before[2], 1)
+
+        get_map_id(self.image, {}, refresh=True)
+        self.assertEqual(self.requests(), {'getMapId': 3})
+
+
+class TileProxyTests(TransactionTestCase):
+    """Tiles are fetched upstream once, then served from disk without touching the database."""
+
+    def setUp(self):
+        import ee
+        from django.core.cache import cache
+
+        from . import tiles
+        from .benchmarks import offline_ee
+
+        cache.clear()
+        temporary_base_dir(self)
+        patcher = mock.patch.object(tiles, '_registered', set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        image = ee.Image('USGS/SRTMGL1_003').clip(ee.Geometry.Point([2.5, 45.0]).buffer(25000))
+        self.url = tiles.layer_tile_url(image, {'min': 0, 'max': 3000})
+        self.key = self.url.split('/')[-4]
+        self.requests = offline_ee.request_counts
+        self.requests()
+
+    def counters(self):
+        from . import tiles
+
+        stats = tiles.cache_stats()
+        return stats['hits'], stats['misses']
+
+    def test_layer_registered_once(self):
+        import ee
+        from . import tiles
+        from .models import TileLayer
+
+        image = ee.Image('USGS/SRTMGL1_003').clip(ee.Geometry.Point([2.5, 45.0]).buffer(25000))
+        self.assertRegex(self.url, r'^/tiles/[0-9a-f]{32}/\{z\}/\{x\}/\{y\}\.png$')
+        with self.assertNumQueries(0):
+            self.assertEqual(tiles.layer_tile_url(image, {'max': 3000, 'min': 0}), self.url)
+        self.assertEqual(TileLayer.objects.filter(key=self.key).count(), 1)
+        self.assertEqual(self.requests(), {})
+
+    def test_missing_tile_fetched_then_stored(self):
+        from . import tiles
+        from .benchmarks.offline_tiles import BLANK_TILE
+
+        before = self.counters()
+        self.assertIsNone(tiles.stored_tile(self.key, 9, 260, 180))
+        self.assertEqual(tiles.fetch_tile(self.key, 9, 260, 180), BLANK_TILE)
+        self.assertEqual(self.requests(), {'getMapId': 1, 'tile': 1})
+
+        # Served from disk: no upstream request, and counting the hit writes nothing to the database
+        with self.assertNumQueries(0):
+            path = tiles.stored_tile(self.key, 9, 260, 180)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), BLANK_TILE)
+        self.assertEqual(self.requests(), {})
+        after = self.counters()
+        self.assertEqual((after[0] - before[0], after[1] - before[1]), (1, 1))
+
+    def test_tile_view(self):
+        from .benchmarks.offline_tiles import BLANK_TILE
+
+        url = self.url.format(z=9, x=260, y=180)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('max-age', response['Cache-Control'])
+        self.assertEqual(response.content, BLANK_TILE)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), BLANK_TILE)
+        self.assertEqual(self.requests(), {'getMapId': 1, 'tile': 1})
+
+    def test_unknown_tiles(self):
+        for key, z, x, y in [('0' * 32, 9, 260, 180), (self.key, 2, 4, 0), (self.key, 25, 0, 0)]:
+            with self.subTest(key=key, z=z, x=x, y=y):
+                response = self.client.get(reverse('analysis:tile', args=[key, z, x, y]))
+                self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.requests(), {})
+
+
+class TilePyramidTests(TransactionTestCase):
+    """Pyramids of a finished analysis: build, failures, background scheduling, reads and eviction."""
+
+    def setUp(self):
+        import ee
+        from django.core.cache import cache
+
+        from . import tiles
+        from .benchmarks import offline_ee
+
+        cache.clear()
+        temporary_base_dir(self, TILE_PYRAMID_WORKERS=1)
+        patcher = mock.patch.object(tiles, '_registered', set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        image = ee.Image('USGS/SRTMGL1_003').clip(ee.Geometry.Point([2.5, 45.0]).buffer(25000))
+        tile_url = tiles.layer_tile_url(image, {'min': 0, 'max': 3000})
+        self.key = tile_url.split('/')[-4]
+
+        self.params = AnalysisParameters.objects.create(status=AnalysisParameters.STATUS_DONE, **FORM_VALUES)
+        directory = os.path.join(artifacts.artifact_root(), str(self.params.id))
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'map_suitability.html'), 'w') as f:
+            f.write('<html></html>')
+        self.params.suitability_map = f"{artifacts.STATIC_URL_PREFIX}{self.params.id}/map_suitability.html"
+        self.params.tile_urls = {'suitability': tile_url}
+        self.params.save()
+        self.path = os.path.join(directory, 'tiles', self.key + '.mbtiles')
+        self.requests = offline_ee.request_counts
+        self.requests()
+
+    def expected_tiles(self, *zooms):
+        from .pyramids import tile_range
+        from .raster_engine import region_grid
+
+        bounds = region_grid(self.params.latitude, self.params.longitude, self.params.buffer_radius).bounds
+        return sum(len(xs) * len(ys) for xs, ys in (tile_range(bounds, z) for z in zooms))
+
+    def layer(self):
+        from .models import TileLayer
+
+        return TileLayer.objects.get(key=self.key)
+
+    def test_build_pyramids(self):
+        from .pyramids import build_pyramids, built_zooms
+
+        self.assertEqual(build_pyramids(self.params, zooms=(7, 8)), {'suitability': self.expected_tiles(7, 8)})
+        self.assertEqual(self.requests()['tile'], self.expected_tiles(7, 8))
+        layer = self.layer()
+        self.assertEqual(layer.pyramid, os.path.relpath(self.path, artifacts.artifact_root()))
+        self.assertIsNone(layer.pyramid_error)
+        self.assertEqual(built_zooms(self.path), [7, 8])
+
+        # Built levels are skipped
+        self.assertEqual(build_pyramids(self.params, zooms=(7, 9)), {'suitability': self.expected_tiles(9)})
+        self.assertEqual(self.requests()['tile'], self.expected_tiles(9))
+        self.assertEqual(built_zooms(self.path), [7, 8, 9])
+
+    def test_read_tile(self):
+        from . import tiles
+        from .benchmarks.offline_tiles import BLANK_TILE
+        from .pyramids import build_pyramids, read_tile, tile_range
+        from .raster_engine import region_grid
+
+        build_pyramids(self.params, zooms=(8, 8))
+        self.requests()
+        xs, ys = tile_range(region_grid(self.params.latitude, self.params.longitude, 25).bounds, 8)
+        self.assertEqual(read_tile(self.path, 8, xs[0], ys[-1]), BLANK_TILE)
+        self.assertIsNone(read_tile(self.path, 8, xs[-1] + 1, ys[0]))
+        self.assertIsNone(read_tile(self.path, 9, xs[0], ys[0]))
+        self.assertIsNone(read_tile(self.path + '.missing', 8, xs[0], ys[0]))
+
+        # The proxy reads the pyramid before going upstream
+        before = tiles.cache_stats()
+        self.assertEqual(tiles.fetch_tile(self.key, 8, xs[0], ys[0]), BLANK_TILE)
+        after = tiles.cache_stats()
+        self.assertEqual((after['pyramid_hits'] - before['pyramid_hits'], after['misses'] - before['misses']), (1, 0))
+        self.assertEqual(self.requests(), {})
+
+    def test_failed_layer(self):
+        from . import metrics
+        from .pyramids import FAILURE_COUNTER, build_pyramids
+
+        before = metrics.get_counters([FAILURE_COUNTER])[FAILURE_COUNTER]
+        with mock.patch('analysis.pyramids.build_layer_pyramid', side_effect=RuntimeError('quota exceeded')):
+            self.assertEqual(build_pyramids(self.params, zooms=(7, 7)), {'suitability': None})
+        layer = self.layer()
+        self.assertIsNone(layer.pyramid)
+        self.assertEqual(layer.pyramid_error, 'quota exceeded')
+        self.assertEqual(metrics.get_counters([FAILURE_COUNTER])[FAILURE_COUNTER], before + 1)
+
+        # A later build that succeeds clears the error
+        build_pyramids(self.params, zooms=(7, 7))
+        self.assertIsNone(self.layer().pyramid_error)
+
+    def test_schedule_pyramids(self):
+        from . import pyramids
+
+        with override_settings(TILE_PYRAMID_ZOOMS=(7, 8)):
+            pyramids.schedule_pyramids(self.params)
+            # Builds run one at a time, so this waits for the scheduled one
+            pyramids._scheduler.submit(lambda: None).result(timeout=30)
+        self.assertEqual(pyramids.built_zooms(self.path), [7, 8])
+        self.assertEqual(self.layer().pyramid, os.path.relpath(self.path, artifacts.artifact_root()))
+
+    def test_eviction_resets_pyramid(self):
+        from . import tiles
+        from .models import TileLayer
+        from .pyramids import build_pyramids
+
+        build_pyramids(self.params, zooms=(8, 8))
+        TileLayer.objects.filter(key=self.key).update(pyramid_error='stale')
+        artifact, = [artifact for artifact in artifacts.scan()[0] if artifact.key == str(self.params.id)]
+        artifacts.evict(artifact)
+        self.assertFalse(os.path.exists(self.path))
+        layer = self.layer()
+        self.assertIsNone(layer.pyramid)
+        self.assertIsNone(layer.pyramid_error)
+
+        # Tiles are fetched upstream again
+        self.requests()
+        with mock.patch('analysis.pyramids.read_tile') as read_tile:
+            tiles.fetch_tile(self.key, 8, 130, 90)
+        read_tile.assert_not_called()
+        self.assertEqual(self.requests()['tile'], 1)
+
+
+class RoadDistanceImageTests(SimpleTestCase):
+
+    def test_roads_filtered_by_the_search_distance(self):
+        import ee
+        from .gee_utils import road_distance_image
+
+        region = ee.Geometry.Point([-100.0, 40.0]).buffer(25000)
+        for max_distance in (500, 2000):
+            with self.subTest(max_distance=max_distance):
+                image = road_distance_image(region, max_distance)
+                (filtered,) = [node for node in image._nodes() if node._name == 'filterBounds' and node._called]
+                # Roads further away than the search distance cannot change a distance inside the region
+                self.assertEqual(repr(filtered._args[0]), repr(region.buffer(max_distance)))
+                (cost,) = image._calls('cumulativeCost')
+                self.assertEqual(cost._kwargs['maxDistance'], max_distance)
+
+
+def geometry_index(geometries, label='Vector'):
+    """A GeometryIndex over in-memory shapely geometries instead of a file."""
+    import shapely
+
+    from .vector_index import GeometryIndex
+
+    index = GeometryIndex('unused.gpkg', label=label)
+    geometries = np.asarray(geometries, dtype=object)
+    index.load = lambda: (shapely.STRtree(geometries), geometries)
+    return index
+
+
+class LocalRoadSourceTests(SimpleTestCase):
+    """Distances to roads from a local dataset indexed in a shapely STRtree."""
+
+    # 100 m pixels at the equator, the road runs north-south along the grid's west edge
+    GRID = RasterGrid(x0=10.0, y0=0.01, pixel_size=100 / METERS_PER_DEGREE, width=8, height=20)
+
+    def setUp(self):
+        import shapely
+
+        self.road = shapely.LineString([(10.0, -1.0), (10.0, 1.0)])
+        self.far_road = shapely.LineString([(11.0, -1.0), (11.0, 1.0)])
+        self.source = LocalRoadSource('unused.gpkg')
+        self.source.index = geometry_index([self.road, self.far_road], label='Road')
+
+    def test_distances_within_the_search_distance(self):
+        distances = self.source.distance_raster(self.GRID, max_distance=500)
+        self.assertEqual(distances.shape, (20, 8))
+        self.assertEqual(distances.dtype, np.float32)
+        # Pixel centers lie 50, 150, ... meters east of the road; beyond 500 m there is no value
+        np.testing.assert_allclose(distances[:, :5], np.tile([50, 150, 250, 350, 450], (20, 1)), atol=0.5)
+        self.assertTrue(np.isnan(distances[:, 5:]).all())
+
+    def test_only_nearby_geometries_are_measured(self):
+        self.assertEqual(list(self.source.index.query(self.GRID.bounds, margin=500)), [self.road])
+        self.assertEqual(len(self.source.index.query((10.5, -0.1, 10.6, 0.1), margin=500)), 0)
+
+    def test_local_distances_are_cached_in_the_raster_store(self):
+        from . import roads
+
+        tiles = RoadDistanceTiles(tempfile.mkdtemp(), scale=100)
+        self.addCleanup(shutil.rmtree, tiles.store.root, ignore_errors=True)
+        with mock.patch.object(roads, '_source', self.source), mock.patch.object(roads, '_tiles', tiles), \
+                mock.patch.object(self.source, 'distance_raster', wraps=self.source.distance_raster) as compute:
+            first = roads.road_distance_for_grid(self.GRID)
+            second = roads.road_distance_for_grid(self.GRID)
+        self.assertEqual(compute.call_count, 1)
+        np.testing.assert_array_equal(first, second)
+
+    def test_remote_source_downloads_with_the_other_bands(self):
+        from . import roads
+
+        tiles = RoadDistanceTiles(tempfile.mkdtemp(), scale=100)
+        self.addCleanup(shutil.rmtree, tiles.store.root, ignore_errors=True)
+        with mock.patch.object(roads, '_source', roads.EarthEngineRoadSource()), \
+                mock.patch.object(roads, '_tiles', tiles):
+            self.assertIsNone(roads.road_distance_for_grid(self.GRID))
+
+    def test_configuration_errors(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        from .roads import create_road_source
+
+        with self.assertRaises(ImproperlyConfigured):
+            create_road_source('osm')
+        with self.assertRaises(ImproperlyConfigured):
+            create_road_source('local')
+
+    @skipUnless(importlib.util.find_spec('geopandas'), 'geopandas is not installed')
+    def test_read_from_geojson(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'roads.geojson')
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {},
+                 'geometry': {'type': 'LineString', 'coordinates': [[10.0, -1.0], [10.0, 1.0]]}}]}, f)
+        np.testing.assert_array_equal(LocalRoadSource(path).distance_raster(self.GRID, 500),
+                                      self.source.distance_raster(self.GRID, 500))
+        with self.assertRaises(ImproperlyConfigured):
+            LocalRoadSource(os.path.join(directory, 'missing.gpkg')).distance_raster(self.GRID)
+
+
+class NaturaDistanceImageTests(SimpleTestCase):
+    """The natura_2000 criterion image sent to Earth Engine by each source."""
+
+    def setUp(self):
+        import ee
+
+        from . import gee_utils
+
+        self.ee = ee
+        self.gee_utils = gee_utils
+        self.region = ee.Geometry.Point([2.5, 45.0]).buffer(25000)
+
+    def test_earth_engine_source_measures_sites_in_the_region(self):
+        ee = self.ee
+        expected = ee.FeatureCollection('projects/ee-chmilew/assets/sic').filterBounds(self.region) \
+            .distance(1000000).clip(self.region)
+        self.assertEqual(repr(self.gee_utils.natura_distance_image(self.region)), repr(expected))
+
+    def test_earth_engine_placeholder(self):
+        with mock.patch.object(self.ee, 'FeatureCollection', side_effect=RuntimeError('no asset'), create=True):
+            image = self.gee_utils.natura_distance_image(self.region)
+        self.assertEqual(repr(image), repr(self.ee.Image.constant(1000000).clip(self.region)))
+
+    @override_settings(NATURA_2000_SOURCE='local')
+    def test_local_source_sends_nearby_sites(self):
+        from .natura import NATURA_MAX_DISTANCE
+
+        site = {'type': 'Polygon', 'coordinates': [[[2.6, 45.1], [2.7, 45.1], [2.7, 45.2], [2.6, 45.1]]]}
+        geojson = {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': {}, 'geometry': site}]}
+        bounds = (2.1, 44.7, 2.9, 45.3)
+        with mock.patch.object(self.gee_utils, 'natura_sites_geojson', return_value=geojson) as sites:
+            image = self.gee_utils.natura_distance_image(self.region, bounds)
+        sites.assert_called_once_with(bounds, margin=NATURA_MAX_DISTANCE)
+        ee = self.ee
+        expected = ee.FeatureCollection([ee.Feature(ee.Geometry(site))]).distance(NATURA_MAX_DISTANCE) \
+            .unmask(NATURA_MAX_DISTANCE).clip(self.region)
+        self.assertEqual(repr(image), repr(expected))
+
+
+@override_settings(NATURA_2000_SOURCE='local')
+class LocalNaturaIndexTests(SimpleTestCase):
+    """Distance rasters and overlays from the local Natura 2000 index."""
+
+    # 100 m pixels at the equator; the site covers the two western pixel columns
+    GRID = RasterGrid(x0=20.0, y0=0.01, pixel_size=100 / METERS_PER_DEGREE, width=10, height=20)
+
+    def setUp(self):
+        import shapely
+
+        from . import natura
+
+        self.natura = natura
+        width = 2 * self.GRID.pixel_size
+        index = geometry_index([shapely.box(19.0, -1.0, 20.0 + width, 1.0)], label='Natura 2000')
+        patcher = mock.patch.object(natura, '_index', index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_distances_filled_beyond_the_search_distance(self):
+        from .natura import NATURA_MAX_DISTANCE
+
+        distances = self.natura.natura_distance_for_grid(self.GRID)
+        np.testing.assert_array_equal(distances[:, :2], 0)
+        np.testing.assert_allclose(distances[:, 2:], np.tile(np.arange(8) * 100 + 50, (20, 1)), atol=0.5)
+
+        far = self.GRID._replace(x0=21.0)
+        np.testing.assert_array_equal(self.natura.natura_distance_for_grid(far), NATURA_MAX_DISTANCE)
+
+    @override_settings(NATURA_2000_SOURCE='earthengine')
+    def test_earth_engine_source_downloads_with_the_other_bands(self):
+        self.assertIsNone(self.natura.natura_distance_for_grid(self.GRID))
+
+    def test_overlay_written_once(self):
+        temporary_base_dir(self)
+        url = self.natura.natura_overlay_url(self.GRID.bounds)
+        self.assertTrue(url.startswith('/static/maps/natura/'))
+        path = artifacts.url_path(url)
+        with open(path) as f:
+            self.assertEqual(len(json.load(f)['features']), 1)
+        modified = os.path.getmtime(path)
+        self.assertEqual(self.natura.natura_overlay_url(self.GRID.bounds), url)
+        self.assertEqual(os.path.getmtime(path), modified)
+
+
+class ScreeningTests(TransactionTestCase):
+    """Grid screening and its API, called by scripts without a session."""
+
+    def setUp(self):
+        self.client = Client(enforce_csrf_checks=True)
+        self.url = reverse('analysis:screening')
+
+    def test_screening_runs_in_the_background(self):
+        for engine in ('earthengine', 'local'):
+            with self.subTest(engine=engine):
+                response = self.client.post(self.url, {'bounds': [2.0, 45.0, 2.5, 45.3], 'cell_km': 10,
+                                                       'engine': engine, 'top': 5},
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, 202)
+                state = wait_for_job(self, response.json()['status_url'])
+                self.assertEqual(state['status'], 'done', state.get('error'))
+                self.assertIsInstance(state['rows'], list)
+
+    def test_invalid_options_are_rejected(self):
+        for data in ({}, {'bounds': [2.0, 45.0, 2.5]}, {'bounds': ['west', 45.0, 2.5, 45.3]},
+                     {'bounds': [2.0, 45.0, 2.5, 45.3], 'cell_km': 'x'},
+                     {'bounds': [2.0, 45.0, 2.5, 45.3], 'engine': 'gpu'},
+                     {'bounds': [2.0, 45.0, 2.5, 45.3], 'rank_by': 'name'},
+                     {'bounds': [-180, -80, 180, 80], 'cell_km': 1}):
+            with self.subTest(data=data):
+                response = self.client.post(self.url, data, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(response.json()['success'])
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+    def test_local_cells_are_ranked_by_their_statistics(self):
+        from . import screening
+
+        plan = screening.prepare_screening((2.0, 45.0, 2.5, 45.3), cell_km=10, engine='local')
+        grid = plan.layout.grid
+        full = synthetic_stack(5, size=max(grid.width, grid.height))
+        stack = {name: values[:grid.height, :grid.width] for name, values in full.items()}
+        with mock.patch.object(screening, 'load_area_stack', return_value=stack):
+            rows = screening.screen_area((2.0, 45.0, 2.5, 45.3), cell_km=10, engine='local', min_coverage=0)
+
+        self.assertEqual(len(rows), plan.layout.count)
+        means = [row['mean_suitability'] for row in rows]
+        self.assertEqual(means, sorted(means, reverse=True))
+        weights, thresholds = weights_from_params(plan.params), thresholds_from_params(plan.params)
+        # Codes of the pixels with data, in the order of the grid
+        codes = combination_codes(compact_stack(stack), thresholds)
+        cells = plan.layout.cell_index()[stack['valid'] > 0]
+        for row in rows:
+            r, c = (int(part) for part in row['cell_id'][1:].split('c'))
+            pixels = cells == r * plan.layout.cols + c
+            expected = stats_from_counts(np.bincount(codes[pixels], minlength=COMBINATIONS), weights, 1)
+            self.assertEqual(row['pixel_count'], expected['pixel_count'])
+            self.assertAlmostEqual(row['mean_suitability'], expected['mean_suitability'], places=1)
+
+
+def parse_sse(text):
+    """Split a Server-Sent Events stream into (event, id, data) tuples, skipping comments and retry."""
+    events = []
+    for block in text.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], fields.get('id'), json.loads(fields['data'])))
+    return events
+
+
+@override_settings(ANALYSIS_PROGRESS_POLL_INTERVAL=0.01)
+class ProgressEventsTests(TestCase):
+
+    def setUp(self):
+        from .progress import ProgressReporter, clear_events
+
+        self.params = AnalysisParameters.objects.create(status=AnalysisParameters.STATUS_DONE, **FORM_VALUES)
+        self.url = reverse('analysis:events', args=[self.params.id])
+        clear_events(self.params.id)
+        self.reporter = ProgressReporter(self.params.id)
+
+    def test_stages_are_streamed_until_complete(self):
+        from .progress import FAILED, FINISHED, STARTED, get_events
+
+        self.reporter.plan(['load_layers', 'score'])
+        with self.reporter.stage('load_layers'):
+            pass
+        with self.assertRaises(RuntimeError), self.reporter.stage('score'):
+            raise RuntimeError('out of memory')
+        self.assertEqual(self.reporter.failed_stage, 'score')
+        self.assertEqual(set(self.reporter.timings), {'load_layers', 'score'})
+        self.assertEqual([event['seq'] for event in get_events(self.params.id)], [1, 2, 3, 4, 5])
+
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        events = parse_sse(b''.join(response.streaming_content).decode())
+        self.assertEqual([(event, event_id) for event, event_id, _ in events],
+                         [('progress', str(seq)) for seq in range(1, 6)] + [('complete', None)])
+        self.assertEqual([(data['stage'], data['status']) for _, _, data in events[:-1]],
+                         [('plan', STARTED), ('load_layers', STARTED), ('load_layers', FINISHED),
+                          ('score', STARTED), ('score', FAILED)])
+        self.assertEqual(events[4][2]['message'], 'out of memory')
+        self.assertEqual(events[-1][2]['status'], AnalysisParameters.STATUS_DONE)
+        self.assertEqual(events[-1][2]['results_url'], reverse('analysis:results', args=[self.params.id]))
+
+    def test_reconnect_resumes_after_the_last_event(self):
+        for stage in ('load_layers', 'score', 'statistics'):
+            with self.reporter.stage(stage):
+                pass
+        response = self.client.get(self.url, HTTP_LAST_EVENT_ID='4')
+        events = parse_sse(b''.join(response.streaming_content).decode())
+        self.assertEqual([event_id for _, event_id, _ in events], ['5', '6', None])
+
+    async def test_async_stream(self):
+        from asgiref.sync import sync_to_async
+
+        await sync_to_async(self.reporter.plan)(['load_layers'])
+        response = await self.async_client.get(self.url)
+        content = ''.join([chunk.decode() async for chunk in response.streaming_content])
+        self.assertEqual([event for event, _, _ in parse_sse(content)], ['progress', 'complete'])
+
+
+class AsyncViewsTests(TestCase):
+    """Results, export and status served by the async views."""
+
+    def setUp(self):
+        temporary_base_dir(self)
+        os.makedirs(artifacts.artifact_root())
+        with open(os.path.join(artifacts.artifact_root(), 'map.json'), 'w') as f:
+            f.write('{}')
+        maps = {field: artifacts.STATIC_URL_PREFIX + 'map.json' for field in artifacts.MAP_FIELDS}
+        self.params = AnalysisParameters.objects.create(
+            status=AnalysisParameters.STATUS_DONE, mean_suitability=61.5, min_suitability=10.0,
+            max_suitability=95.0, statistics={'pixel_count': 400}, timings={'stages': {'score': 0.5}},
+            **FORM_VALUES, **maps)
+
+    async def test_results_page(self):
+        response = await self.async_client.get(reverse('analysis:results', args=[self.params.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'analysis/results.html')
+        self.assertEqual(response.context['stats']['mean_suitability'], 61.5)
+        self.assertEqual(response.context['maps']['slope'], reverse('analysis:map_file', args=['map.json']))
+
+    async def test_unfinished_and_failed_analyses(self):
+        running = await AnalysisParameters.objects.acreate(status=AnalysisParameters.STATUS_RUNNING,
+                                                           started_at=timezone.now(), **FORM_VALUES)
+        response = await self.async_client.get(reverse('analysis:results', args=[running.id]))
+        self.assertTemplateUsed(response, 'analysis/progress.html')
+
+        failed = await AnalysisParameters.objects.acreate(status=AnalysisParameters.STATUS_FAILED,
+                                                          error_message='quota', **FORM_VALUES)
+        response = await self.async_client.get(reverse('analysis:results', args=[failed.id]))
+        self.assertRedirects(response, reverse('analysis:index'), fetch_redirect_response=False)
+
+    async def test_export(self):
+        response = await self.async_client.get(reverse('analysis:export', args=[self.params.id]))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn(f'windfarm_analysis_{self.params.id}.json', response['Content-Disposition'])
+        data = json.loads(response.content)
+        self.assertEqual(data['id'], str(self.params.id))
+        self.assertEqual(data['parameters']['weights']['natura_2000'], FORM_VALUES['weight_natura'])
+        self.assertEqual(data['results']['statistics'], {'pixel_count': 400})
+        self.assertEqual(data['timings'], {'stages': {'score': 0.5}})
+
+    async def test_unknown_analysis(self):
+        import uuid
+
+        for name in ('results', 'export', 'events'):
+            with self.subTest(view=name):
+                response = await self.async_client.get(reverse(f'analysis:{name}', args=[uuid.uuid4()]))
+                self.assertEqual(response.status_code, 404)
+
+
+class EarthEngineExecutorTests(SimpleTestCase):
+
+    @override_settings(EARTH_ENGINE_CONCURRENCY={'default': 2, 'big-project': 3})
+    async def test_concurrency_limited_per_project(self):
+        import asyncio
+
+        from .executor import run_earth_engine
+
+        running, peak = [0], {}
+        lock = threading.Lock()
+
+        def request(project):
+            with lock:
+                running[0] += 1
+                peak[project] = max(peak.get(project, 0), running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return project
+
+        for project, limit in (('small-project', 2), ('big-project', 3)):
+            running[0] = 0
+            results = await asyncio.gather(*[run_earth_engine(request, project, project=project) for _ in range(8)])
+            self.assertEqual(results, [project] * 8)
+            self.assertEqual(peak[project], limit)
+
+
+@override_settings(METRICS_FLUSH_INTERVAL=None)
+class MetricCountersTests(TestCase):
+
+    def setUp(self):
+        from . import metrics
+
+        self.metrics = metrics
+        metrics.flush()
+
+    def stored(self, name):
+        from .models import MetricCounter
+
+        return MetricCounter.objects.filter(name=name).values_list('value', flat=True).first()
+
+    def test_increments_are_buffered(self):
+        with self.assertNumQueries(0):
+            for _ in range(5):
+                self.metrics.increment('test_hits')
+            self.metrics.increment('test_misses', 2)
+        self.assertIsNone(self.stored('test_hits'))
+        self.assertEqual(self.metrics.get_counters(['test_hits', 'test_misses', 'test_other']),
+                         {'test_hits': 5, 'test_misses': 2, 'test_other': 0})
+
+        self.metrics.flush()
+        self.assertEqual(self.stored('test_hits'), 5)
+        self.metrics.increment('test_hits')
+        self.metrics.flush()
+        self.assertEqual(self.stored('test_hits'), 6)
+        self.assertEqual(self.metrics.get_counter('test_hits'), 6)
+
+    def test_failed_flush_keeps_the_counts(self):
+        from django.db import DatabaseError
+
+        self.metrics.increment('test_hits', 3)
+        with mock.patch.object(self.metrics, '_add', side_effect=DatabaseError('locked')):
+            self.metrics.flush()
+        self.assertIsNone(self.stored('test_hits'))
+        self.metrics.flush()
+        self.assertEqual(self.stored('test_hits'), 3)
+
+    def test_timers_are_flushed_with_the_counters(self):
+        from .models import MetricCounter
+
+        with self.assertNumQueries(0):
+            for seconds in (0.003, 0.2, 0.3, 500):
+                self.metrics.observe('test.op', seconds)
+        self.assertNotIn('test.op', self.metrics.get_timers())
+        self.metrics.flush()
+        timer = self.metrics.get_timers()['test.op']
+        self.assertEqual(timer['count'], 4)
+        self.assertAlmostEqual(timer['sum'], 500.503, places=5)
+        # Cumulative counts: 0.003 in the first bucket, 0.2 and 0.3 up to 0.5 s, 500 s only in +Inf
+        buckets = dict(zip(self.metrics.TIMER_BUCKETS + (float('inf'),), timer['buckets']))
+        self.assertEqual((buckets[0.005], buckets[0.25], buckets[0.5], buckets[120], buckets[float('inf')]),
+                         (1, 2, 3, 3, 4))
+        self.assertTrue(MetricCounter.objects.filter(name__startswith='timer:test.op:').exists())
+
+    def test_prometheus_text(self):
+        self.metrics.increment('test_hits', 7)
+        with self.metrics.timer('test.op'):
+            pass
+        response = self.client.get(reverse('analysis:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = self.metrics.prometheus_text({'test_hits': self.metrics.get_counter('test_hits')})
+        self.assertIn('# TYPE windfarm_test_hits_total counter\nwindfarm_test_hits_total 7\n', text)
+        self.assertIn('windfarm_operation_duration_seconds_bucket{operation="test.op",le="+Inf"} 1', text)
+        self.assertIn('windfarm_operation_duration_seconds_count{operation="test.op"} 1', text)
+        self.assertIn('# TYPE windfarm_operation_duration_seconds histogram', response.content.decode())
+
+    def test_timings_collected_per_analysis(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self.metrics.collect_timings() as collector, ThreadPoolExecutor(2) as pool:
+            self.metrics.observe('test.render', 0.5)
+            self.metrics.submit(pool, self.metrics.observe, 'test.render', 1.5).result()
+            # Tasks submitted without the context are not part of the analysis
+            pool.submit(self.metrics.observe, 'test.render', 9).result()
+        self.metrics.observe('test.render', 9)
+        self.assertEqual(collector.summary(), {'test.render': {'count': 2, 'total_s': 2.0, 'max_s': 1.5}})
+
+
+class MetricsFlusherTests(TransactionTestCase):
+    """The background thread that adds a process' counts to the database."""
+
+    def test_flushed_in_the_background(self):
+        from . import metrics
+        from .models import MetricCounter
+
+        def wait_for(condition):
+            # Only this process' state is polled, the database is locked while the thread writes
+            deadline = time.monotonic() + 5
+            while not condition() and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        with override_settings(METRICS_FLUSH_INTERVAL=0.02):
+            metrics.increment('test_background')
+            self.assertIn(os.getpid(), metrics._flushers)
+            wait_for(lambda: 'test_background' not in metrics._pending_counters)
+        # With flushing off the thread ends after its current interval
+        wait_for(lambda: os.getpid() not in metrics._flushers)
+        self.assertNotIn(os.getpid(), metrics._flushers)
+        self.assertEqual(MetricCounter.objects.get(name='test_background').value, 1)
+
+
+class BenchmarkTests(TransactionTestCase):
+
+    def setUp(self):
+        from .benchmarks import offline_ee
+
+        # Restore the test runner's configuration of the stand-in
+        self.addCleanup(offline_ee.configure, latency=0, jitter=0, seconds_per_km2=0)
+
+    def test_smoke_run(self):
+        from .benchmarks import runner
+        from .models import AnalysisParameters, MetricCounter
+
+        counters = dict(MetricCounter.objects.values_list('name', 'value'))
+        scenarios = ['analysis', 'create_map', 'preview_map', 'tile_proxy', 'tile_proxy_cached', 'export_analysis']
+        seen = []
+        # One render thread, see RenderMapsTests; worker processes would not see the test database
+        with mock.patch.dict(runner.BENCHMARK_SETTINGS, ANALYSIS_MAP_WORKERS=1):
+            run = runner.run_benchmarks(scenarios=scenarios, radii=[10], concurrency=[1], iterations=1, latency=0,
+                                        seconds_per_km2=0, progress=seen.append)
+
+        self.assertEqual([result['scenario'] for result in run['results']], scenarios)
+        self.assertEqual(seen, run['results'])
+        by_name = {result['scenario']: result for result in run['results']}
+        self.assertGreater(by_name['analysis']['ee_requests'], 0)
+        self.assertEqual(by_name['tile_proxy_cached']['ee_requests'], 0)
+        self.assertEqual(runner.compare(run, run), [])
+        # The run's analyses and counts are removed again
+        self.assertFalse(AnalysisParameters.objects.exists())
+        self.assertEqual(dict(MetricCounter.objects.values_list('name', 'value')), counters)
+
+    def test_compare(self):
+        from .benchmarks.runner import compare
+
+        def result(p50, requests=4):
+            return {'scenario': 'analysis', 'radius_km': 10, 'concurrency': 1, 'p50_ms': p50, 'p90_ms': p50,
+                    'peak_memory_kb': 100, 'ee_requests': requests}
+
+        baseline = {'config': {'iterations': 8}, 'results': [result(1000)]}
+        self.assertEqual(compare({'config': {'iterations': 8}, 'results': [result(1400)]}, baseline), [])
+        self.assertEqual(compare({'config': {'iterations': 8}, 'results': [result(1600)]}, baseline),
+                         [('analysis', 10, 1, 'p50_ms', 1000, 1600), ('analysis', 10, 1, 'p90_ms', 1000, 1600)])
+        self.assertEqual(compare({'config': {'iterations': 8}, 'results': [result(1000, 5)]}, baseline),
+                         [('analysis', 10, 1, 'ee_requests', 4, 5)])
+        with self.assertRaises(ValueError):
+            compare({'config': {'iterations': 1}, 'results': []}, baseline)
+
+
+class PreviewTests(SimpleTestCase):
+
+    def test_preview_url(self):
+        response = self.client.get(reverse('analysis:preview'), {'latitude': 45.12345678, 'longitude': 2.5,
+                                                                 'buffer_radius': 30})
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['map_url'], reverse('analysis:preview_map') +
+                         '?latitude=45.123457&longitude=2.5&buffer_radius=30&style=area')
+
+    def test_invalid_regions(self):
+        for query in ({'latitude': 'x'}, {'latitude': 'nan'}, {'longitude': 'inf'}, {'buffer_radius': '-inf'},
+                      {'latitude': 91}, {'buffer_radius': 0}, {'buffer_radius': 101}, {'style': 'terrain'}):
+            with self.subTest(query=query):
+                self.assertFalse(self.client.get(reverse('analysis:preview'), query).json()['success'])
+                self.assertEqual(self.client.get(reverse('analysis:preview_map'), query).status_code, 400)
+
+    def test_preview_page_is_cached_by_etag(self):
+        url = reverse('analysis:preview_map')
+        query = {'latitude': 45.0, 'longitude': 2.5, 'buffer_radius': 30}
+        response = self.client.get(url, query)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'analysis/preview_map.html')
+        self.assertIn('max-age=', response['Cache-Control'])
+        etag = response['ETag']
+
+        response = self.client.get(url, query, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        # Another region is another page
+        self.assertNotEqual(self.client.get(url, {**query, 'style': 'satellite'})['ETag'], etag)
@@ -0,0 +1,91 @@
+# File: analysis/tile_cache.py
+"""Cache of Earth Engine map IDs and tile URLs.
+
+Every ``getMapId`` call is a blocking Earth Engine request, yet many maps
+show the same image: the region outline and the Natura 2000 overlay are
+drawn on every map of an analysis, and criterion layers repeat for every
+analysis of a region. Map IDs are therefore cached in Django's cache
+framework, shared by the web server and the background workers, keyed by a
+hash of the serialized image expression and visualization parameters.
+
+Earth Engine map IDs stop working after a while, so every entry records when
+it expires and is requested again on the first lookup after that.
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+KEY_PREFIX = 'analysis:tile-url:'
+
+HIT_COUNTER = 'tile_url_cache_hits'
+MISS_COUNTER = 'tile_url_cache_misses'
+REFRESH_COUNTER = 'tile_url_cache_refreshes'
+COUNTERS = [HIT_COUNTER, MISS_COUNTER, REFRESH_COUNTER]
+
+# Seconds a map ID is assumed to stay valid
+DEFAULT_TTL = 4 * 60 * 60
+# Map IDs this close to expiring are refreshed, so a map page is not built with a URL about to fail
+REFRESH_MARGIN = 10 * 60
+
+
+def expression_digest(expression, vis_params):
+    """Return the hex digest of a serialized image expression with visualization parameters."""
+    payload = json.dumps({'expression': expression, 'vis_params': vis_params or {}}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def expression_key(image, vis_params):
+    """Return the cache key of an image expression rendered with visualization parameters."""
+    return KEY_PREFIX + expression_digest(image.serialize(), vis_params)
+
+
+def get_map_id(image, vis_params, ttl=None, refresh=False):
+    """Return the map ID of an image, requesting it from Earth Engine only when needed.
+
+    Args:
+        image: Earth Engine image
+        vis_params: Visualization parameters passed to getMapId
+        ttl: Seconds the map ID stays valid (defaults to settings.TILE_URL_CACHE_TTL)
+        refresh: Request a new map ID even if the cached one has not expired, e.g.
+            after Earth Engine rejected it
+
+    Returns:
+        Dictionary with 'mapid', 'tile_url' and 'expires_at' (Unix time)
+    """
+    if ttl is None:
+        ttl = getattr(settings, 'TILE_URL_CACHE_TTL', DEFAULT_TTL)
+    key = expression_key(image, vis_params)
+
+    entry = cache.get(key)
+    now = time.time()
+    if not refresh and entry is not None and entry['expires_at'] - min(REFRESH_MARGIN, ttl / 2) > now:
+        metrics.increment(HIT_COUNTER)
+        return entry
+    metrics.increment(REFRESH_COUNTER if entry is not None else MISS_COUNTER)
+
+    with metrics.timer('ee.get_map_id'):
+        map_id = image.getMapId(vis_params)
+    entry = {
+        'mapid': map_id.get('mapid'),
+        'tile_url': map_id['tile_fetcher'].url_format,
+        'expires_at': now + ttl
+    }
+    # The cache drops the entry itself once it has expired
+    cache.set(key, entry, timeout=ttl)
+    return entry
+
+
+def cache_stats():
+    """Return the tile URL cache hit/miss/refresh counters."""
+    counters = metrics.get_counters(COUNTERS)
+    return {
+        'hits': counters[HIT_COUNTER],
+        'misses': counters[MISS_COUNTER],
+        'refreshes': counters[REFRESH_COUNTER],
+        'hit_rate': metrics.hit_rate(counters[HIT_COUNTER], counters[MISS_COUNTER] + counters[REFRESH_COUNTER])
+    }
@@ -0,0 +1,333 @@
+# File: analysis/tiles.py
+"""Tile proxy with a local on-disk tile cache.
+
+Maps reference /tiles/<key>/{z}/{x}/{y}.png instead of Earth Engine tile
+URLs (see layer_tile_url). The key identifies an image expression with its
+visualization parameters, registered as a TileLayer. The first request for
+a tile fetches it from the upstream and stores it under
+settings.TILE_CACHE_DIR. Later requests, from any viewer, are served from
+disk, and tiles keep working after the Earth Engine map ID expired, since
+the upstream requests a new one from the stored expression. Layers of
+finished analyses can be prebuilt into pyramids (see pyramids.py), which
+are read before going upstream.
+
+The upstream is the class named by settings.TILE_UPSTREAM, so Earth Engine
+can be replaced by a local stand-in (see benchmarks/offline_tiles.py).
+"""
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from functools import lru_cache
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from . import metrics, tile_cache
+from .models import TileLayer
+
+HIT_COUNTER = 'tile_proxy_hits'
+MISS_COUNTER = 'tile_proxy_misses'
+PYRAMID_COUNTER = 'tile_proxy_pyramid_hits'
+COUNTERS = [HIT_COUNTER, MISS_COUNTER, PYRAMID_COUNTER]
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+MAX_ZOOM = 24
+FILE_EXTENSION = '.png'
+
+# Eviction deletes tiles until the store is this fraction of its budget, so a full
+# store is not scanned again for every new tile
+EVICT_TO = 0.9
+# Seconds after which a process counts the store's size again, to see other processes' tiles
+RESCAN_INTERVAL = 5 * 60
+
+
+class TileNotFound(Exception):
+    """The upstream has no tile at these coordinates."""
+
+
+class TileStore:
+    """Size-bounded directory of tiles, laid out as <key>/<z>/<x>/<y>.png."""
+
+    def __init__(self, root, max_bytes=None):
+        """
+        Args:
+            root: Directory holding the tiles
+            max_bytes: Total size above which the least recently used tiles are evicted
+        """
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Size of the store as last counted plus the tiles this process wrote since
+        self._bytes = None
+        self._scanned_at = 0
+        # Tile path -> lock held while it is fetched, so concurrent requests fetch it once
+        self._fetching = {}
+
+    @staticmethod
+    def valid(key, z, x, y):
+        """Whether a key and tile coordinates can be stored."""
+        return bool(KEY_PATTERN.match(key)) and 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+    def path(self, key, z, x, y):
+        """Path of the file holding one tile."""
+        return os.path.join(self.root, key, str(z), str(x), f"{y}{FILE_EXTENSION}")
+
+    def open(self, key, z, x, y):
+        """Return the path of a stored tile, or None if it is not stored."""
+        path = self.path(key, z, x, y)
+        try:
+            # The modification time doubles as the last-used time for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            pass
+        return path
+
+    def write(self, key, z, x, y, data):
+        """Store a tile and evict old tiles if the store is over budget.
+
+        Returns:
+            Path of the written file
+        """
+        path = self.path(key, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary name first so concurrent requests never serve a partial tile
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        if self.max_bytes:
+            with self._lock:
+                if self._bytes is None or time.time() - self._scanned_at > RESCAN_INTERVAL:
+                    self._bytes = None
+                else:
+                    self._bytes += len(data)
+            if self._bytes is None or self._bytes > self.max_bytes:
+                self.evict(keep={path})
+        return path
+
+    def fetching(self, path):
+        """Return the lock serializing fetches of one tile."""
+        with self._lock:
+            return self._fetching.setdefault(path, threading.Lock())
+
+    def done_fetching(self, path):
+        with self._lock:
+            self._fetching.pop(path, None)
+
+    def _files(self):
+        """Return (mtime, size, path) for every stored tile."""
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(FILE_EXTENSION):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def usage(self):
+        """Total size in bytes and number of stored tiles."""
+        files = self._files()
+        return sum(size for _, size, _ in files), len(files)
+
+    def evict(self, max_bytes=None, keep=()):
+        """Count the store and, if it is over max_bytes, delete least recently used tiles.
+
+        Returns:
+            List of deleted paths
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        with self._lock:
+            files = self._files()
+            total = sum(size for _, size, _ in files)
+            if total > max_bytes:
+                for _, size, path in sorted(files):
+                    if total <= max_bytes * EVICT_TO:
+                        break
+                    if path in keep:
+                        continue
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"Could not evict tile {path}: {e}")
+                        continue
+                    total -= size
+                    removed.append(path)
+            self._bytes = total
+            self._scanned_at = time.time()
+        return removed
+
+
+class EarthEngineUpstream:
+    """Fetches tiles from Earth Engine with the cached map ID of a layer."""
+
+    def __init__(self):
+        self.timeout = getattr(settings, 'TILE_UPSTREAM_TIMEOUT', 30)
+        self._images = {}
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def initialize(self):
+        """Initialize Earth Engine in this process, once.
+
+        The web process is initialized by gee_utils, but processes that only
+        fetch tiles, such as pyramid workers, never import it.
+        """
+        with self._lock:
+            if not self._initialized:
+                import ee
+
+                ee.Initialize(project=getattr(settings, 'EARTH_ENGINE_PROJECT', 'ee-chmilew'))
+                self._initialized = True
+
+    def image(self, layer):
+        """Return the Earth Engine image of a layer, deserialized once per process."""
+        if layer.key not in self._images:
+            import ee
+
+            self._images[layer.key] = ee.Image(ee.deserializer.fromJSON(layer.expression))
+        return self._images[layer.key]
+
+    def download(self, url):
+        """Return the body of a tile URL, or raise TileNotFound."""
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise TileNotFound(url)
+            raise
+
+    def fetch(self, layer, z, x, y):
+        """Return the PNG data of one tile of a layer, or raise TileNotFound.
+
+        A map ID rejected before it was due to expire is requested again once.
+        """
+        self.initialize()
+        image = self.image(layer)
+        url = tile_cache.get_map_id(image, layer.vis_params)['tile_url']
+        try:
+            with metrics.timer('ee.fetch_tile'):
+                return self.download(url.format(z=z, x=x, y=y))
+        except urllib.error.HTTPError as e:
+            if e.code not in (400, 401, 403):
+                raise
+        url = tile_cache.get_map_id(image, layer.vis_params, refresh=True)['tile_url']
+        with metrics.timer('ee.fetch_tile'):
+            return self.download(url.format(z=z, x=x, y=y))
+
+
+@lru_cache(maxsize=None)
+def _upstream(path):
+    return import_string(path)()
+
+
+def get_upstream():
+    """Return the upstream configured in settings.TILE_UPSTREAM."""
+    return _upstream(getattr(settings, 'TILE_UPSTREAM', 'analysis.tiles.EarthEngineUpstream'))
+
+
+@lru_cache(maxsize=None)
+def _tile_store(root, max_bytes):
+    return TileStore(root, max_bytes)
+
+
+def get_tile_store():
+    """Return the tile store configured in settings."""
+    return _tile_store(getattr(settings, 'TILE_CACHE_DIR', os.path.join(settings.BASE_DIR, 'tile_cache')),
+                       getattr(settings, 'TILE_CACHE_MAX_BYTES', None))
+
+
+# Keys registered by this process, so maps of the same layers skip the database
+_registered = set()
+
+
+def layer_tile_url(image, vis_params):
+    """Register an image with the tile proxy and return its tile URL template.
+
+    Unlike tile_cache.get_map_id this makes no Earth Engine request: the
+    map ID is requested when the first tile is.
+
+    Args:
+        image: Earth Engine image
+        vis_params: Visualization parameters passed to getMapId
+
+    Returns:
+        URL template of the form /tiles/<key>/{z}/{x}/{y}.png
+    """
+    expression = image.serialize()
+    key = tile_cache.expression_digest(expression, vis_params)[:32]
+    if key not in _registered:
+        TileLayer.objects.get_or_create(key=key, defaults={'expression': expression, 'vis_params': vis_params or {}})
+        _registered.add(key)
+    return reverse('analysis:tile', args=[key, 0, 0, 0]).replace('/0/0/0.png', '/{z}/{x}/{y}.png')
+
+
+def stored_tile(key, z, x, y):
+    """Return the path of a stored tile, or None if it has to be fetched."""
+    path = get_tile_store().open(key, z, x, y)
+    if path is not None:
+        metrics.increment(HIT_COUNTER)
+    return path
+
+
+def fetch_tile(key, z, x, y):
+    """Return the PNG data of a tile that is not stored, from its pyramid or the upstream.
+
+    Tiles of a prebuilt pyramid (see pyramids.py) are read from it; others
+    are fetched from the upstream and stored. Concurrent requests for the
+    same missing tile in a process wait for the first one instead of
+    fetching it again.
+
+    Raises:
+        TileLayer.DoesNotExist: The key is not registered
+        TileNotFound: The upstream has no such tile
+    """
+    from .artifacts import artifact_root
+    from .pyramids import read_tile
+
+    store = get_tile_store()
+    path = store.path(key, z, x, y)
+    lock = store.fetching(path)
+    try:
+        with lock:
+            stored = store.open(key, z, x, y)
+            if stored is None:
+                layer = TileLayer.objects.get(key=key)
+                if layer.pyramid:
+                    data = read_tile(os.path.join(artifact_root(), layer.pyramid), z, x, y)
+                    if data is not None:
+                        metrics.increment(PYRAMID_COUNTER)
+                        return data
+                metrics.increment(MISS_COUNTER)
+                data = get_upstream().fetch(layer, z, x, y)
+                store.write(key, z, x, y, data)
+                return data
+            metrics.increment(HIT_COUNTER)
+        with open(stored, 'rb') as f:
+            return f.read()
+    finally:
+        store.done_fetching(path)
+
+
+def cache_stats():
+    """Return the tile proxy counters: tiles served from disk, from pyramids and fetched upstream."""
+    counters = metrics.get_counters(COUNTERS)
+    return {
+        'hits': counters[HIT_COUNTER],
+        'pyramid_hits': counters[PYRAMID_COUNTER],
+        'misses': counters[MISS_COUNTER],
+        'hit_rate': metrics.hit_rate(counters[HIT_COUNTER] + counters[PYRAMID_COUNTER], counters[MISS_COUNTER])
+    }
@@ -7,8 +7,20 @@ app_name = 'analysis'
 urlpatterns = [
     path('', views.index, name='index'),
     path('results/<uuid:analysis_id>/', views.results, name='results'),
+    path('results/<uuid:analysis_id>/status/', views.analysis_status, name='status'),
+    path('results/<uuid:analysis_id>/events/', views.analysis_events, name='events'),
+    path('results/<uuid:analysis_id>/rescore/', views.rescore_analysis, name='rescore'),
+    path('results/<uuid:analysis_id>/layer/<str:name>/', views.analysis_layer, name='layer'),
+    path('maps/<path:path>', views.map_file, name='map_file'),
+    path('tiles/<str:key>/<int:z>/<int:x>/<int:y>.png', views.tile, name='tile'),
     path('preview/', views.preview_area, name='preview'),
+    path('preview/map/', views.preview_map, name='preview_map'),
     path('export/<uuid:analysis_id>/', views.export_analysis, name='export'),
+    path('batch/', views.batch_analysis, name='batch'),
+    path('batch/<str:batch_id>/', views.batch_status, name='batch_status'),
+    path('screening/', views.screening_analysis, name='screening'),
+    path('metrics/', views.prometheus_metrics, name='metrics'),
+    path('metrics/cache/', views.cache_metrics, name='cache_metrics'),
     path('test-static/', views.test_static_file, name='test_static'),
     path('simple-preview/', views.simple_preview, name='simple_preview'),
 
@@ -0,0 +1,175 @@
+# File: analysis/vector_index.py
+"""In-memory spatial index of a local vector dataset.
+
+Road networks and Natura 2000 sites can be read from local files instead of
+Earth Engine. A file is read once per process into a shapely STRtree. Each
+lookup first selects the geometries whose bounding boxes come near the
+requested area. Distances to those geometries are then measured for whole
+blocks of pixels at once with vectorized nearest-geometry queries.
+"""
+import hashlib
+import math
+import os
+import threading
+
+import numpy as np
+from django.core.exceptions import ImproperlyConfigured
+
+from .raster_engine import METERS_PER_DEGREE
+from .raster_store import get_raster_store
+
+# Rows of pixels queried at once, to bound memory use
+QUERY_CHUNK_ROWS = 256
+
+
+def _meters_per_degree_lon(lat):
+    return METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6)
+
+
+class GeometryIndex:
+    """Geometries from a local vector file in a shapely STRtree, loaded on first use."""
+
+    def __init__(self, path, layer=None, label='Vector'):
+        """
+        Args:
+            path: GeoPackage, GeoJSON or shapefile
+            layer: Layer to read from a multi-layer file such as a GeoPackage
+            label: Name of the dataset used in error messages
+        """
+        self.path = str(path)
+        self.layer = layer
+        self.label = label
+        self._geometries = None
+        self._tree = None
+        self._lock = threading.Lock()
+
+    def cache_key(self):
+        """Return a key that changes when the dataset file is replaced."""
+        try:
+            modified = os.path.getmtime(self.path)
+        except OSError:
+            modified = None
+        return f"{os.path.abspath(self.path)}:{self.layer}:{modified}"
+
+    def load(self):
+        """Read the geometries and build the spatial index on first use.
+
+        Returns:
+            Tuple of (STRtree, array of geometries in EPSG:4326)
+        """
+        with self._lock:
+            if self._tree is None:
+                # Imported here so that Earth Engine-only setups do not need the geospatial stack
+                import geopandas
+                import shapely
+
+                if not os.path.exists(self.path):
+                    raise ImproperlyConfigured(f"{self.label} dataset {self.path} does not exist")
+                frame = geopandas.read_file(self.path, layer=self.layer)
+                if frame.crs is not None and frame.crs.to_epsg() != 4326:
+                    frame = frame.to_crs(epsg=4326)
+                geometries = np.asarray(frame.geometry.values, dtype=object)
+                geometries = geometries[~(shapely.is_missing(geometries) | shapely.is_empty(geometries))]
+                self._geometries = geometries
+                self._tree = shapely.STRtree(geometries)
+        return self._tree, self._geometries
+
+    def query(self, bounds, margin=0):
+        """Return the geometries whose bounding boxes come within margin meters of a bounding box.
+
+        Args:
+            bounds: (west, south, east, north) in degrees
+            margin: Distance in meters added around the bounding box
+        """
+        import shapely
+
+        tree, geometries = self.load()
+        west, south, east, north = bounds
+        margin_x = margin / _meters_per_degree_lon((south + north) / 2)
+        margin_y = margin / METERS_PER_DEGREE
+        box = shapely.box(west - margin_x, south - margin_y, east + margin_x, north + margin_y)
+        return geometries[tree.query(box)]
+
+    def distance_raster(self, grid, max_distance):
+        """Distance in meters from every pixel center of a grid to the nearest geometry.
+
+        Args:
+            grid: RasterGrid to sample
+            max_distance: Search distance in meters
+
+        Returns:
+            float32 array shaped (grid.height, grid.width), NaN beyond max_distance
+        """
+        import shapely
+
+        result = np.full((grid.height, grid.width), np.nan, dtype=np.float32)
+        west, south, east, north = grid.bounds
+        candidates = self.query(grid.bounds, margin=max_distance)
+        if not len(candidates):
+            return result
+
+        # Measure in meters on a local equirectangular projection centered on the grid
+        lon0, lat0 = (west + east) / 2, (north + south) / 2
+        x_scale, y_scale = _meters_per_degree_lon(lat0), METERS_PER_DEGREE
+        offset = np.array([lon0, lat0])
+        factor = np.array([x_scale, y_scale])
+        local_tree = shapely.STRtree(shapely.transform(candidates, lambda coords: (coords - offset) * factor))
+
+        xs = (west + (np.arange(grid.width) + 0.5) * grid.pixel_size - lon0) * x_scale
+        for start in range(0, grid.height, QUERY_CHUNK_ROWS):
+            rows = np.arange(start, min(start + QUERY_CHUNK_ROWS, grid.height))
+            ys = (north - (rows + 0.5) * grid.pixel_size - lat0) * y_scale
+            points = shapely.points(np.tile(xs, len(rows)), np.repeat(ys, grid.width))
+            # Points without a geometry within max_distance are left out of the result;
+            # points inside a polygon are at distance 0
+            (point_index, _), distances = local_tree.query_nearest(
+                points, max_distance=max_distance, return_distance=True, all_matches=False)
+            chunk = np.full(len(points), np.nan, dtype=np.float32)
+            chunk[point_index] = distances
+            result[rows] = chunk.reshape(len(rows), grid.width)
+        return result
+
+    def geojson(self, bounds, margin=0, tolerance=0):
+        """Return the geometries near a bounding box as a GeoJSON FeatureCollection.
+
+        Args:
+            bounds: (west, south, east, north) in degrees
+            margin: Distance in meters added around the bounding box
+            tolerance: Simplification tolerance in meters, 0 keeps every vertex
+        """
+        import shapely
+
+        geometries = self.query(bounds, margin=margin)
+        if tolerance and len(geometries):
+            geometries = shapely.simplify(geometries, tolerance / METERS_PER_DEGREE, preserve_topology=True)
+        return {
+            'type': 'FeatureCollection',
+            'features': [
+                {'type': 'Feature', 'properties': {}, 'geometry': json_geometry}
+                for json_geometry in (shapely.geometry.mapping(geometry) for geometry in geometries)
+            ]
+        }
+
+
+def cached_distance_raster(source, layer, grid, max_distance):
+    """Return a source's distance raster for a grid, computing it only on first use.
+
+    Results are stored in the raster store, keyed by the source's dataset,
+    the search distance and the grid.
+
+    Args:
+        source: Object with cache_key() and distance_raster(grid, max_distance)
+        layer: Raster store layer name
+        grid: RasterGrid to sample
+        max_distance: Search distance in meters
+    """
+    store = get_raster_store()
+    grid_key = hashlib.sha256(repr((source.cache_key(), max_distance) + tuple(grid)).encode('utf-8')).hexdigest()
+    scale = int(round(grid.pixel_size * METERS_PER_DEGREE))
+    stored = store.open(layer, grid_key, scale)
+    if stored is not None:
+        return stored.array
+
+    distances = source.distance_raster(grid, max_distance)
+    store.write(layer, grid_key, scale, distances, grid.geotransform)
+    return distances
@@ -5,25 +5,120 @@ from django.shortcuts import render
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.template.loader import get_template
+from django.views.decorators.clickjacking import xframe_options_sameorigin
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from asgiref.sync import sync_to_async
+from .artifacts import artifact_root, restore_missing_maps, served_url, touch
+from .batch import OUTPUT_FIELDS, format_rows, get_batch, parse_sites, prepare_batch, submit_batch, submit_job
 from .forms import AnalysisForm
 from .models import AnalysisParameters
-from .gee_utils import run_suitability_analysis, create_region_of_interest
-import ee
-import geemap.foliumap as geemap
+from .executor import run_blocking, run_earth_engine
+from .jobs import enqueue_analysis, ensure_scheduled
+from .progress import get_events
+from .raster_engine import CRITERION_BANDS, rescore, thresholds_from_params, weights_from_params
+from .result_cache import cache_stats, params_hash, reuse_cached_result
+from . import compression
+from . import metrics
+from . import pyramids
+from . import result_cache
+from . import screening
+from . import tile_cache
+from . import tiles
+import asyncio
+import copy
+import hashlib
 import json
+import math
 import os
+import time
 from django.conf import settings
+from functools import lru_cache
+from urllib.parse import urlencode
 
 BASE_DIR = settings.BASE_DIR
 
+# Seconds between comment lines that keep an idle progress stream open through proxies
+SSE_KEEPALIVE_INTERVAL = 15
+
+# Preview page variants: the simplified area preview and the satellite preview
+PREVIEW_STYLES = ('area', 'satellite')
+PREVIEW_MAX_RADIUS = 100
+PREVIEW_TEMPLATE = 'analysis/preview_map.html'
+
+# Content types of the generated map files served by map_file
+MAP_CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.json': 'application/json',
+    '.geojson': 'application/geo+json',
+}
+
+# Form fields that can be changed without re-running the region stage
+RESCORE_FIELDS = [field for field in AnalysisForm.Meta.fields
+                  if field.startswith('weight_') or field.startswith('threshold_')]
+
+async def _aget_analysis(analysis_id):
+    """Async get_object_or_404 for an analysis"""
+    params = await AnalysisParameters.objects.filter(id=analysis_id).afirst()
+    if params is None:
+        raise Http404('Analysis not found')
+    return params
+
+def _preview_params(query, style):
+    """Validate the region of a preview from a query dictionary.
+    
+    Raises:
+        ValueError: If a value is missing from its allowed range
+    """
+    values = {name: float(query.get(name, default))
+              for name, default in (('latitude', 50.5), ('longitude', 2.0), ('buffer_radius', 25))}
+    # int() raises OverflowError rather than ValueError for infinity
+    if not all(math.isfinite(value) for value in values.values()):
+        raise ValueError('Coordinates and buffer radius must be finite numbers')
+    preview = {
+        'latitude': round(values['latitude'], 6),
+        'longitude': round(values['longitude'], 6),
+        'buffer_radius': int(values['buffer_radius']),
+        'style': query.get('style', style)
+    }
+    if not -90 <= preview['latitude'] <= 90 or not -180 <= preview['longitude'] <= 180:
+        raise ValueError('Coordinates out of range')
+    if not 1 <= preview['buffer_radius'] <= PREVIEW_MAX_RADIUS:
+        raise ValueError(f'Buffer radius must be between 1 and {PREVIEW_MAX_RADIUS} km')
+    if preview['style'] not in PREVIEW_STYLES:
+        raise ValueError(f"Unknown preview style '{preview['style']}'")
+    return preview
+
+def _preview_response(request, style, url_key):
+    """JSON response with the URL of the preview page for the requested region"""
+    if request.method != 'GET':
+        return JsonResponse({'success': False, 'error': 'Method not allowed'}, status=405)
+    try:
+        preview = _preview_params(request.GET, style)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+    return JsonResponse({
+        'success': True,
+        url_key: reverse('analysis:preview_map') + '?' + urlencode(preview)
+    })
+
 def index(request):
     """Home page with analysis form"""
     if request.method == 'POST':
         form = AnalysisForm(request.POST)
         if form.is_valid():
             # Save parameters
-            params = form.save()
+            params = form.save(commit=False)
+            params.params_hash = params_hash(params)
+            
+            # Reuse an earlier analysis with identical parameters, otherwise
+            # run the analysis in the background job queue
+            if not reuse_cached_result(params):
+                params.save()
+                enqueue_analysis(params)
             
             # Redirect to results page with ID
             return redirect('analysis:results', analysis_id=params.id)
@@ -33,153 +128,433 @@ def index(request):
     # For GET requests or invalid forms
     return render(request, 'analysis/index.html', {'form': form})
 
-def results(request, analysis_id):
+async def results(request, analysis_id):
     """Results page showing analysis results"""
     # Get analysis parameters
-    params = get_object_or_404(AnalysisParameters, id=analysis_id)
+    params = await _aget_analysis(analysis_id)
     
-    # Check if analysis has been run (based on whether maps exist)
-    if not params.suitability_map:
-        # Run analysis
-        results = run_suitability_analysis(params)
-        
-        if not results['success']:
-            messages.error(request, f"Analysis failed: {results.get('error_message', 'Unknown error')}")
-            return redirect('analysis:index')
+    # Messages, sessions and templates use the synchronous ORM, so they run through sync_to_async
+    if params.status == AnalysisParameters.STATUS_FAILED:
+        await sync_to_async(messages.error)(request, f"Analysis failed: {params.error_message or 'Unknown error'}")
+        return redirect('analysis:index')
+    
+    # Maps evicted by the artifact store are rendered again by a background job
+    if params.status == AnalysisParameters.STATUS_DONE:
+        await sync_to_async(restore_missing_maps)(params)
+    
+    # While the background job is queued or running show a progress page instead
+    if params.status != AnalysisParameters.STATUS_DONE:
+        await sync_to_async(ensure_scheduled)(params)
+        return await sync_to_async(render)(request, 'analysis/progress.html', {'params': params})
+    await sync_to_async(touch)(params)
     
     # Prepare context for template
     context = {
         'params': params,
+        'rescore_form': AnalysisForm(instance=params, auto_id='rescore_%s'),
+        'rescore_fields': RESCORE_FIELDS,
+        # Maps are served compressed by map_file
         'maps': {
-            'suitability': params.suitability_map,
-            'slope': params.slope_map,
-            'elevation': params.elevation_map,
-            'wind_speed': params.wind_speed_map,
-            'roads': params.roads_map,
-            'landcover': params.landcover_map,
-            'natura_2000': params.natura_2000_map
+            'suitability': served_url(params.suitability_map),
+            'slope': served_url(params.slope_map),
+            'elevation': served_url(params.elevation_map),
+            'wind_speed': served_url(params.wind_speed_map),
+            'roads': served_url(params.roads_map),
+            'landcover': served_url(params.landcover_map),
+            'natura_2000': served_url(params.natura_2000_map)
         },
         'stats': {
             'mean_suitability': params.mean_suitability,
             'min_suitability': params.min_suitability,
             'max_suitability': params.max_suitability
-        }
+        },
+        'statistics': params.statistics
     }
+    # Analyses rendered as JSON layer specs are shown in the shared map viewer. Criterion
+    # maps that are still empty are rendered through analysis_layer when first opened.
+    context['layer_viewer'] = bool(params.suitability_map) and params.suitability_map.endswith('.json')
+    
+    return await sync_to_async(render)(request, 'analysis/results.html', context)
+
+def analysis_status(request, analysis_id):
+    """JSON endpoint polled by the progress page while the analysis job runs"""
+    params = get_object_or_404(AnalysisParameters, id=analysis_id)
+    
+    if not params.is_finished:
+        ensure_scheduled(params)
+    
+    return JsonResponse({
+        'id': str(params.id),
+        'status': params.status,
+        'finished': params.is_finished,
+        'error_message': params.error_message,
+        'started_at': params.started_at.isoformat() if params.started_at else None,
+        'finished_at': params.finished_at.isoformat() if params.finished_at else None,
+        'results_url': reverse('analysis:results', args=[params.id])
+    })
+
+def _sse(data, event, event_id=None):
+    """Format one Server-Sent Event."""
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+def _poll_progress(analysis_id, after):
+    """Return (new progress events, final status or None) of an analysis.
     
-    return render(request, 'analysis/results.html', context)
+    The status is read before the events, and a finished job has emitted all
+    of its events, so no event is missed when the stream ends.
+    """
+    row = AnalysisParameters.objects.filter(id=analysis_id).values('status', 'error_message').first()
+    finished = None
+    if row is None or row['status'] in (AnalysisParameters.STATUS_DONE, AnalysisParameters.STATUS_FAILED):
+        finished = {
+            'status': row['status'] if row else AnalysisParameters.STATUS_FAILED,
+            'error_message': row['error_message'] if row else 'The analysis no longer exists',
+            'results_url': reverse('analysis:results', args=[analysis_id])
+        }
+    return get_events(analysis_id, after), finished
+
+def _event_stream(analysis_id, after):
+    """Synchronous SSE stream, used when the app is served over WSGI."""
+    interval = getattr(settings, 'ANALYSIS_PROGRESS_POLL_INTERVAL', 0.5)
+    deadline = time.monotonic() + getattr(settings, 'ANALYSIS_JOB_TIMEOUT', 30 * 60)
+    last_sent = time.monotonic()
+    yield 'retry: 2000\n\n'
+    while time.monotonic() < deadline:
+        events, finished = _poll_progress(analysis_id, after)
+        for event in events:
+            after = event['seq']
+            last_sent = time.monotonic()
+            yield _sse(event, 'progress', event['seq'])
+        if finished is not None:
+            yield _sse(finished, 'complete')
+            return
+        if time.monotonic() - last_sent >= SSE_KEEPALIVE_INTERVAL:
+            last_sent = time.monotonic()
+            yield ': keep-alive\n\n'
+        time.sleep(interval)
+
+async def _aevent_stream(analysis_id, after):
+    """Asynchronous SSE stream: under ASGI a waiting browser holds no worker thread."""
+    interval = getattr(settings, 'ANALYSIS_PROGRESS_POLL_INTERVAL', 0.5)
+    deadline = time.monotonic() + getattr(settings, 'ANALYSIS_JOB_TIMEOUT', 30 * 60)
+    last_sent = time.monotonic()
+    poll = sync_to_async(_poll_progress)
+    yield 'retry: 2000\n\n'
+    while time.monotonic() < deadline:
+        events, finished = await poll(analysis_id, after)
+        for event in events:
+            after = event['seq']
+            last_sent = time.monotonic()
+            yield _sse(event, 'progress', event['seq'])
+        if finished is not None:
+            yield _sse(finished, 'complete')
+            return
+        if time.monotonic() - last_sent >= SSE_KEEPALIVE_INTERVAL:
+            last_sent = time.monotonic()
+            yield ': keep-alive\n\n'
+        await asyncio.sleep(interval)
+
+async def analysis_events(request, analysis_id):
+    """Server-Sent Events stream of an analysis' pipeline progress.
+    
+    Every stage event of run_suitability_analysis is sent as a 'progress'
+    event with its sequence number as ID, so a reconnecting browser resumes
+    after the last event it saw (Last-Event-ID). A final 'complete' event
+    carries the job status and the results URL.
+    """
+    params = await _aget_analysis(analysis_id)
+    if not params.is_finished:
+        await sync_to_async(ensure_scheduled)(params)
+    
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.GET.get('after') or 0)
+    except ValueError:
+        after = 0
+    
+    # Streaming responses are buffered when the iterator does not match the server
+    # type, so the stream is async under ASGI (windfarm_project.asgi) and sync under WSGI
+    if isinstance(request, ASGIRequest):
+        stream = _aevent_stream(params.id, after)
+    else:
+        stream = _event_stream(params.id, after)
+    return StreamingHttpResponse(stream, content_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+async def analysis_layer(request, analysis_id, name):
+    """JSON endpoint returning the map of one criterion layer, rendering it on first request.
+    
+    The results page calls this when a map tab is opened for a layer that
+    has not been rendered yet (see ANALYSIS_LAZY_LAYERS). Rendering makes
+    blocking Earth Engine requests, which run in the bounded executor.
+    """
+    params = await _aget_analysis(analysis_id)
+    if name not in CRITERION_BANDS:
+        return JsonResponse({'success': False, 'error': f"Unknown layer '{name}'"}, status=404)
+    if params.status != AnalysisParameters.STATUS_DONE:
+        return JsonResponse({'success': False, 'error': 'The analysis has not finished'}, status=409)
+    
+    # Imported here so that loading the URLconf does not initialize Earth Engine
+    from .gee_utils import render_analysis_layer
+    
+    start = time.perf_counter()
+    try:
+        map_url, timings = await run_earth_engine(render_analysis_layer, params, name)
+    except Exception as e:
+        print(f"Error rendering layer {name} of analysis {params.id}: {e}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=503)
+    
+    return JsonResponse({
+        'success': True,
+        'name': name,
+        'url': served_url(map_url),
+        'rendered': bool(timings),
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)
+    })
 
-def preview_area(request):
-    """AJAX endpoint to generate a simplified preview of the analysis area"""
-    if request.method == 'GET':
+@xframe_options_sameorigin
+def map_file(request, path):
+    """Serve a generated map file from static/maps, compressed when the browser accepts it.
+    
+    Copies written by compression.precompress are chosen from the
+    Accept-Encoding header. Every map file has a unique name and never
+    changes, so responses may be cached for good.
+    """
+    root = os.path.realpath(artifact_root())
+    file_path = os.path.realpath(os.path.join(root, *path.split('/')))
+    extension = os.path.splitext(file_path)[1]
+    # Only the map files themselves, not their compressed copies or anything outside static/maps
+    if not file_path.startswith(root + os.sep) or extension not in MAP_CONTENT_TYPES \
+            or not os.path.isfile(file_path):
+        raise Http404('Map not found')
+    
+    send_path, encoding = compression.negotiate(request.headers.get('Accept-Encoding'), file_path)
+    # Named after the map itself, so saving the page does not produce a .gz or .br file
+    response = FileResponse(open(send_path, 'rb'), content_type=MAP_CONTENT_TYPES[extension],
+                            filename=os.path.basename(file_path))
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'MAP_CACHE_MAX_AGE', 365 * 24 * 60 * 60),
+                        immutable=True)
+    return response
+
+async def tile(request, key, z, x, y):
+    """Tile proxy: serve a map tile from the tile cache or a prebuilt pyramid, else fetch it upstream.
+    
+    Tiles of a key never change, so browsers may keep them for
+    settings.TILE_CACHE_MAX_AGE. Upstream requests run in the bounded
+    Earth Engine executor.
+    """
+    if not tiles.TileStore.valid(key, z, x, y):
+        raise Http404('Tile not found')
+    
+    path = await run_blocking(tiles.stored_tile, key, z, x, y)
+    if path is not None:
+        response = FileResponse(open(path, 'rb'), content_type='image/png')
+    else:
         try:
-            # Get parameters from request
-            lat = float(request.GET.get('latitude', 50.5))
-            lon = float(request.GET.get('longitude', 2.0))
-            buffer_radius = int(request.GET.get('buffer_radius', 25))
-            
-            # Create a simple HTML representation of the preview using Leaflet
-            html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Analysis Region Preview</title>
-                <meta charset="utf-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css" />
-                <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
-                <style>
-                    body {{ margin: 0; padding: 0; }}
-                    html, body, #map {{ height: 100%; width: 100%; }}
-                    .info-box {{
-                        background: white;
-                        padding: 8px;
-                        border-radius: 4px;
-                        box-shadow: 0 0 15px rgba(0,0,0,0.2);
-                        position: absolute;
-                        bottom: 10px;
-                        left: 10px;
-                        z-index: 1000;
-                        font-family: Arial, sans-serif;
-                        font-size: 12px;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div id="map"></div>
-                <div class="info-box">
-                    <strong>Analysis Region</strong><br>
-                    Center: {lat}, {lon}<br>
-                    Radius: {buffer_radius} km
-                </div>
-                <script>
-                    // Create the map centered at the specified coordinates
-                    var map = L.map('map').setView([{lat}, {lon}], 9);
-                    
-                    // Add satellite imagery layer
-                    L.tileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{{z}}/{{y}}/{{x}}', {{
-                        attribution: 'Imagery &copy; Esri'
-                    }}).addTo(map);
-                    
-                    // Add a terrain/topo layer
-                    var topoLayer = L.tileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer/tile/{{z}}/{{y}}/{{x}}', {{
-                        attribution: 'Imagery &copy; Esri'
-                    }});
-                    
-                    // Add layer control
-                    var baseLayers = {{
-                        "Satellite": map.getPane('tilePane').lastChild,
-                        "Topographic": topoLayer
-                    }};
-                    L.control.layers(baseLayers).addTo(map);
-                    
-                    // Create a circle representing the analysis area
-                    var circle = L.circle([{lat}, {lon}], {{
-                        color: 'red',
-                        fillColor: '#f03',
-                        fillOpacity: 0.2,
-                        radius: {buffer_radius * 1000}  // Convert km to meters
-                    }}).addTo(map);
-                    
-                    // Add a marker at the center
-                    L.marker([{lat}, {lon}]).addTo(map)
-                        .bindPopup("<strong>Analysis Center</strong><br>Lat: {lat}, Lon: {lon}")
-                        .openPopup();
-                </script>
-            </body>
-            </html>
-            """
-            
-            # Save the HTML to a file
-            preview_path = os.path.join(BASE_DIR, 'static', 'preview_maps')
-            os.makedirs(preview_path, exist_ok=True)
-            
-            map_filename = f"preview_{lat}_{lon}_{buffer_radius}.html"
-            map_path = os.path.join(preview_path, map_filename)
-            
-            with open(map_path, 'w') as f:
-                f.write(html)
-                
-            # Return URL to preview map
-            map_url = f'/static/preview_maps/{map_filename}'
-            print(f"Generated preview map at: {map_url}")
-            
-            return JsonResponse({
-                'success': True,
-                'map_url': map_url
-            })
-            
+            data = await run_earth_engine(tiles.fetch_tile, key, z, x, y)
+        except (tiles.TileLayer.DoesNotExist, tiles.TileNotFound):
+            raise Http404('Tile not found')
         except Exception as e:
-            print(f"Error generating preview: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({
-                'success': False,
-                'error': str(e)
-            })
-
-def export_analysis(request, analysis_id):
-    """Endpoint to export analysis results"""
+            print(f"Error fetching tile {key}/{z}/{x}/{y}: {e}")
+            return HttpResponse(status=502)
+        response = HttpResponse(data, content_type='image/png')
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'TILE_CACHE_MAX_AGE', 7 * 24 * 60 * 60))
+    return response
+
+def rescore_analysis(request, analysis_id):
+    """JSON endpoint re-scoring an analysis with new weights and thresholds.
+    
+    Accepts any of the weight_* and threshold_* form fields as query
+    parameters of a GET request; missing fields keep the analysis' values.
+    Re-scoring changes nothing, so it is a GET like the results page's
+    requests, which also keeps it clear of CSRF checks. Scoring uses the
+    cached criterion rasters of the region, so no maps are created and no
+    Earth Engine call is made once the region has been downloaded.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'success': False, 'error': 'Method not allowed'}, status=405)
     params = get_object_or_404(AnalysisParameters, id=analysis_id)
+    start = time.perf_counter()
+    
+    # Only invalid input is the client's fault; failures while scoring are answered below
+    try:
+        candidate = copy.copy(params)
+        for field in RESCORE_FIELDS:
+            if field in request.GET:
+                value = float(request.GET[field])
+                # NaN passes every comparison below and would end up in the JSON response
+                if not math.isfinite(value):
+                    raise ValueError(f"{field} must be a finite number")
+                setattr(candidate, field, value)
+        
+        weights = weights_from_params(candidate)
+        if any(weight < 0 for weight in weights.values()):
+            raise ValueError("Weights must not be negative")
+        if not sum(weights.values()) > 0:
+            raise ValueError("At least one weight must be greater than zero")
+        thresholds = thresholds_from_params(candidate)
+    except (TypeError, ValueError) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    
+    try:
+        stats = rescore(params, weights, thresholds)
+    except Exception as e:
+        print(f"Error re-scoring analysis {analysis_id}: {e}")
+        return JsonResponse({'success': False, 'error': 'Criterion data is not available'}, status=503)
+    
+    return JsonResponse({
+        'success': True,
+        'weights': weights,
+        'thresholds': thresholds,
+        'stats': stats,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)
+    })
+
+@csrf_exempt
+def batch_analysis(request):
+    """API to screen many sites at once.
+    
+    POST a JSON object with a 'sites' list (or a CSV body) plus optional
+    'parameters' (weight_*/threshold_* values shared by all sites) and
+    'render_maps'. The batch runs in the background; the response holds
+    the URL to poll for its results. Like the other JSON APIs it is called
+    by scripts without a session, so it is exempt from CSRF checks.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'POST a JSON or CSV list of sites'}, status=405)
+    
+    try:
+        if request.content_type == 'text/csv':
+            sites = parse_sites(request.body.decode('utf-8'), 'csv')
+            shared, render_maps = {}, False
+        else:
+            data = json.loads(request.body or '{}')
+            sites = parse_sites(json.dumps(data.get('sites', [])), 'json')
+            shared = data.get('parameters', {})
+            render_maps = bool(data.get('render_maps', False))
+    except (UnicodeDecodeError, ValueError, AttributeError) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    
+    max_sites = getattr(settings, 'BATCH_MAX_SITES', 1000)
+    if not sites or len(sites) > max_sites:
+        return JsonResponse({'success': False, 'error': f'Submit between 1 and {max_sites} sites'}, status=400)
+    
+    try:
+        prepare_batch(sites, shared)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    
+    batch_id = submit_batch(sites, shared, render_maps=render_maps)
+    return JsonResponse({
+        'success': True,
+        'batch_id': batch_id,
+        'status_url': reverse('analysis:batch_status', args=[batch_id])
+    }, status=202)
+
+def batch_status(request, batch_id):
+    """Status and, once finished, result rows of a batch (?format=csv for a CSV download)"""
+    state = get_batch(batch_id)
+    if state is None:
+        return JsonResponse({'success': False, 'error': 'Unknown batch'}, status=404)
+    
+    if request.GET.get('format') == 'csv' and state['rows'] is not None:
+        response = HttpResponse(format_rows(state['rows'], 'csv', state.get('fields', OUTPUT_FIELDS)),
+                                content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="windfarm_batch_{batch_id}.csv"'
+        return response
+    
+    return JsonResponse({'success': True, **state})
+
+@csrf_exempt
+def screening_analysis(request):
+    """API to screen a whole area on a grid of cells.
+    
+    POST a JSON object with 'bounds' ([west, south, east, north]) and optional
+    'cell_km', 'top', 'engine', 'rank_by' and 'parameters' (weight_*/threshold_*
+    values). The screening runs in the background like a batch; the response
+    holds the URL to poll for the ranked cells. Exempt from CSRF checks like
+    batch_analysis.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'POST a JSON object with the bounds to screen'}, status=405)
+    
+    try:
+        data = json.loads(request.body or '{}')
+        options = {
+            'bounds': data.get('bounds') or [],
+            'cell_km': data.get('cell_km'),
+            'shared': data.get('parameters', {}),
+            'engine': data.get('engine'),
+            'rank_by': data.get('rank_by', 'mean_suitability')
+        }
+        top = int(data.get('top', 20)) or None
+        # Reject invalid options now rather than in the background job
+        screening.prepare_screening(**options)
+    except (UnicodeDecodeError, ValueError, TypeError, AttributeError) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    
+    batch_id = submit_job(lambda progress: screening.screen_area(top=top, **options), 1,
+                          fields=screening.OUTPUT_FIELDS)
+    return JsonResponse({
+        'success': True,
+        'batch_id': batch_id,
+        'status_url': reverse('analysis:batch_status', args=[batch_id])
+    }, status=202)
+
+def cache_metrics(request):
+    """JSON endpoint reporting cache hit/miss counters"""
+    return JsonResponse({
+        'result_cache': cache_stats(),
+        'tile_url_cache': tile_cache.cache_stats(),
+        'tile_proxy': tiles.cache_stats()
+    })
+
+def prometheus_metrics(request):
+    """Cache counters and operation timing histograms in the Prometheus text format"""
+    # This process' latest timings are only in memory until they are flushed
+    metrics.flush()
+    counters = metrics.get_counters(result_cache.COUNTERS + tile_cache.COUNTERS + tiles.COUNTERS + pyramids.COUNTERS)
+    return HttpResponse(metrics.prometheus_text(counters), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+async def preview_area(request):
+    """AJAX endpoint returning the URL of a simplified preview of the analysis area"""
+    return _preview_response(request, 'area', 'map_url')
+
+@lru_cache(maxsize=1)
+def _preview_template_digest():
+    # Part of every preview ETag, so cached previews are refreshed when the template changes
+    return hashlib.sha256(get_template(PREVIEW_TEMPLATE).template.source.encode('utf-8')).hexdigest()[:16]
+
+@xframe_options_sameorigin
+def preview_map(request):
+    """Leaflet preview page of a region, rendered from the shared template.
+    
+    The region and style come from the query string. The page only depends
+    on them and the template, so it is served with an ETag and a long
+    Cache-Control lifetime, and a matching If-None-Match gets a 304 without
+    rendering.
+    """
+    try:
+        preview = _preview_params(request.GET, 'area')
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    
+    key = json.dumps(preview, sort_keys=True) + _preview_template_digest()
+    etag = '"' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32] + '"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(request, PREVIEW_TEMPLATE, {'preview': preview})
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'PREVIEW_CACHE_MAX_AGE', 24 * 60 * 60))
+    return response
+
+async def export_analysis(request, analysis_id):
+    """Endpoint to export analysis results"""
+    params = await _aget_analysis(analysis_id)
     
     # Generate a JSON export of the parameters and results
     export_data = {
@@ -210,8 +585,11 @@ def export_analysis(request, analysis_id):
         'results': {
             'mean_suitability': params.mean_suitability,
             'min_suitability': params.min_suitability,
-            'max_suitability': params.max_suitability
-        }
+            'max_suitability': params.max_suitability,
+            'statistics': params.statistics
+        },
+        # Seconds per stage, map and timed operation of the run that produced the results
+        'timings': params.timings
     }
     
     # Create response with JSON file
@@ -262,168 +640,6 @@ def test_static_file(request):
         'test_url': '/static/test.html'
     })
 
-def simple_preview(request):
+async def simple_preview(request):
     """Generate a map preview with satellite imagery"""
-    if request.method == 'GET':
-        try:
-            # Get parameters from request
-            lat = float(request.GET.get('latitude', 50.5))
-            lon = float(request.GET.get('longitude', 2.0))
-            buffer_radius = int(request.GET.get('buffer_radius', 25))
-            
-            # Create an enhanced HTML file with Leaflet and satellite imagery
-            html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Satellite Preview</title>
-                <meta charset="utf-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css" />
-                <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
-                <style>
-                    body, html, #map {{
-                        height: 100%;
-                        margin: 0;
-                        padding: 0;
-                    }}
-                    .info-box {{
-                        background: white;
-                        padding: 8px;
-                        border-radius: 4px;
-                        box-shadow: 0 0 15px rgba(0,0,0,0.2);
-                        position: absolute;
-                        bottom: 10px;
-                        right: 10px;
-                        z-index: 1000;
-                        font-family: Arial, sans-serif;
-                        font-size: 12px;
-                        max-width: 180px;
-                        line-height: 1.4;
-                    }}
-                    .circle-label {{
-                        background: rgba(255,255,255,0.8);
-                        border: none;
-                        border-radius: 50%;
-                        text-align: center;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div id="map"></div>
-                <div class="info-box">
-                    <strong>Analysis Region</strong><br>
-                    Center: {lat:.4f}, {lon:.4f}<br>
-                    Radius: {buffer_radius} km
-                </div>
-                <script>
-                    // Initialize map centered at the specified coordinates
-                    var map = L.map('map').setView([{lat}, {lon}], 10);
-                    
-                    // Add Esri satellite imagery layer (no API key required)
-                    var satelliteLayer = L.tileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{{z}}/{{y}}/{{x}}', {{
-                        attribution: 'Imagery &copy; Esri',
-                        maxZoom: 19
-                    }}).addTo(map);
-                    
-                    // Add OpenStreetMap as an alternative layer
-                    var streetsLayer = L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
-                        attribution: '&copy; OpenStreetMap contributors',
-                        maxZoom: 19
-                    }});
-                    
-                    // Add Esri Topographic map as another option
-                    var topoLayer = L.tileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer/tile/{{z}}/{{y}}/{{x}}', {{
-                        attribution: 'Imagery &copy; Esri',
-                        maxZoom: 19
-                    }});
-                    
-                    // Create layer control for basemaps
-                    var baseLayers = {{
-                        "Satellite": satelliteLayer,
-                        "Streets": streetsLayer,
-                        "Topographic": topoLayer
-                    }};
-                    
-                    L.control.layers(baseLayers).addTo(map);
-                    
-                    // Create a circle representing the analysis area
-                    // Using a bright color with border that will be visible on satellite imagery
-                    var circle = L.circle([{lat}, {lon}], {{
-                        color: 'red',
-                        weight: 3,
-                        fillColor: 'yellow',
-                        fillOpacity: 0.15,
-                        radius: {buffer_radius * 1000}  // Convert km to meters
-                    }}).addTo(map);
-                    
-                    // Add a marker at the center
-                    var marker = L.marker([{lat}, {lon}]).addTo(map);
-                    marker.bindPopup("<strong>Analysis Center</strong><br>Latitude: {lat:.4f}<br>Longitude: {lon:.4f}");
-                    
-                    // Display radius on the circle (approximate position calculation)
-                    var radiusLabelPos = getPointOnCircle({lat}, {lon}, {buffer_radius * 1000}, 45);
-                    var radiusLabel = L.marker(radiusLabelPos, {{
-                        icon: L.divIcon({{
-                            className: 'circle-label',
-                            html: '<div style="padding:3px 6px;background:white;border-radius:3px;font-size:11px;font-weight:bold;box-shadow:0 0 3px rgba(0,0,0,0.3);">{buffer_radius} km</div>',
-                            iconSize: [40, 20],
-                            iconAnchor: [20, 10]
-                        }})
-                    }}).addTo(map);
-                    
-                    // Helper function to calculate a point on the circle edge
-                    function getPointOnCircle(lat, lng, radiusMeters, angleDegrees) {{
-                        // Earth radius in meters
-                        var earthRadius = 6378137;
-                        
-                        // Convert angle from degrees to radians
-                        var angleRadians = angleDegrees * Math.PI / 180;
-                        
-                        // Convert latitude and longitude to radians
-                        var latRad = lat * Math.PI / 180;
-                        var lngRad = lng * Math.PI / 180;
-                        
-                        // Calculate distance in radians
-                        var distanceRadians = radiusMeters / earthRadius;
-                        
-                        // Calculate new latitude
-                        var newLatRad = Math.asin(
-                            Math.sin(latRad) * Math.cos(distanceRadians) + 
-                            Math.cos(latRad) * Math.sin(distanceRadians) * Math.cos(angleRadians)
-                        );
-                        
-                        // Calculate new longitude
-                        var newLngRad = lngRad + Math.atan2(
-                            Math.sin(angleRadians) * Math.sin(distanceRadians) * Math.cos(latRad),
-                            Math.cos(distanceRadians) - Math.sin(latRad) * Math.sin(newLatRad)
-                        );
-                        
-                        // Convert back to degrees
-                        var newLat = newLatRad * 180 / Math.PI;
-                        var newLng = newLngRad * 180 / Math.PI;
-                        
-                        return [newLat, newLng];
-                    }}
-                </script>
-            </body>
-            </html>
-            """
-            
-            # Save the file
-            filename = f"satellite_preview_{lat}_{lon}.html"
-            file_path = os.path.join(BASE_DIR, 'static', filename)
-            
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(html)
-            
-            return JsonResponse({
-                'success': True,
-                'url': f'/static/{filename}'
-            })
-            
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({'success': False, 'error': str(e)})
\ No newline at end of file
+    return _preview_response(request, 'satellite', 'url')
@@ -100,3 +100,160 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Crispy Forms settings
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
+
+# Cache shared by the web server and background workers (counters, Earth Engine tile URLs)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        # Room for cached Earth Engine tile URLs and progress events
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
+# Seconds an Earth Engine map ID (tile URL) is reused before it is requested again
+TILE_URL_CACHE_TTL = 4 * 60 * 60
+
+# Background analysis jobs
+# Run queued analyses in a thread pool inside the web process. Set to False and
+# start `python manage.py run_analysis_worker` to run them in separate processes.
+ANALYSIS_RUN_IN_PROCESS = True
+ANALYSIS_WORKER_THREADS = 2
+# Seconds after which a running job is assumed to have lost its worker
+ANALYSIS_JOB_TIMEOUT = 30 * 60
+# Maximum number of analysis maps rendered concurrently within one analysis (1 = sequential)
+ANALYSIS_MAP_WORKERS = 7
+# Map output: 'json' writes small layer specs shown by the shared map viewer on the
+# results page, 'html' writes a standalone folium page per map
+ANALYSIS_MAP_FORMAT = 'json'
+# Render only the suitability map with the analysis; each criterion map is rendered
+# (and shared with the region) the first time its tab is opened on the results page
+ANALYSIS_LAZY_LAYERS = True
+
+# Suitability statistics engine: 'earthengine' runs reduceRegion for every analysis,
+# 'local' downloads the criterion rasters of a region once and scores them with NumPy
+ANALYSIS_SCORING_ENGINE = 'earthengine'
+RASTER_CACHE_DIR = os.path.join(BASE_DIR, 'raster_cache')
+# Disk budget of the raster store; least recently used rasters are evicted beyond it
+RASTER_CACHE_MAX_BYTES = 2 * 1024 ** 3
+RASTER_DOWNLOAD_WORKERS = 4
+
+# Batch screening (analysis/batch.py)
+BATCH_MAX_WORKERS = 4
+BATCH_MAX_SITES = 1000
+# Largest covering raster (pixels per band) downloaded for a group of overlapping sites.
+# A cluster holds 7 float32 bands per pixel, about 110 MB at this size.
+BATCH_MAX_SHARED_PIXELS = 4_000_000
+# Pixels of the clusters scored at the same time in one process; further clusters wait
+BATCH_MAX_CONCURRENT_PIXELS = 8_000_000
+# Seconds without progress after which an unfinished batch is assumed lost, e.g. to a restart
+BATCH_JOB_TIMEOUT = 60 * 60
+
+# Road network used for the distance-to-roads criterion in local scoring: 'earthengine'
+# (TIGER/2016/Roads, US only) or 'local' (a GeoPackage/GeoJSON/shapefile extract, e.g.
+# OpenStreetMap roads, indexed with shapely). Earth Engine statistics and maps always
+# use the Earth Engine collection.
+ROAD_SOURCE = 'earthengine'
+ROAD_DATASET_PATH = None
+# Layer of a multi-layer ROAD_DATASET_PATH such as a GeoPackage
+ROAD_DATASET_LAYER = None
+
+# Precomputed distance-to-roads tiles (python manage.py precompute_road_distance).
+# Local scoring reads road distances from them for regions inside the covered area.
+ROAD_DISTANCE_DIR = os.path.join(BASE_DIR, 'road_distance')
+ROAD_DISTANCE_SCALE = 100
+# Area covered by the precompute command: (west, south, east, north), the contiguous US
+# covered by the TIGER road collection
+ROAD_DISTANCE_BOUNDS = (-125.0, 24.0, -66.0, 50.0)
+
+# Natura 2000 sites: 'earthengine' filters the Earth Engine asset for every analysis,
+# 'local' reads the site polygons (GeoPackage/GeoJSON/shapefile) once per process into
+# a shapely index used for local distance rasters, map overlays and the site collection
+# sent to Earth Engine
+NATURA_2000_SOURCE = 'earthengine'
+NATURA_2000_DATASET_PATH = None
+# Layer of a multi-layer NATURA_2000_DATASET_PATH such as a GeoPackage
+NATURA_2000_DATASET_LAYER = None
+
+# Grid screening of whole areas (analysis/screening.py, python manage.py screen_area)
+# Engine: 'earthengine' runs one reduceRegions over all cells, 'local' downloads the
+# area's criterion rasters once and computes per-cell statistics with NumPy
+SCREENING_ENGINE = 'earthengine'
+SCREENING_CELL_KM = 10
+# Pixel size in meters; coarser than single analyses so a country fits in one pass
+SCREENING_SCALE = 1000
+# reduceRegions results are returned with one getInfo, which is limited to 5000 features
+SCREENING_MAX_CELLS = 5000
+SCREENING_MAX_PIXELS = 25_000_000
+
+# Progress events of running analyses, streamed to the progress page over Server-Sent
+# Events. Serve the app with an ASGI server (e.g. `uvicorn windfarm_project.asgi:application`)
+# so open streams do not hold a worker thread each.
+ANALYSIS_PROGRESS_POLL_INTERVAL = 0.5
+# Seconds the events of an analysis are kept
+ANALYSIS_PROGRESS_TIMEOUT = 24 * 60 * 60
+
+# Earth Engine project requests are billed to
+EARTH_ENGINE_PROJECT = 'ee-chmilew'
+# Async views (results, previews, export, lazy layers) run blocking Earth Engine calls and
+# file writes in a pool of this many threads (analysis/executor.py)
+ASYNC_BLOCKING_WORKERS = 16
+# Concurrent Earth Engine requests per project from one process; 'default' applies to
+# projects not listed
+EARTH_ENGINE_CONCURRENCY = {'default': 8}
+
+# Metric counters and operation timers (analysis/metrics.py) are kept in memory and added
+# to the database by a background thread of each process this often, in seconds, and when
+# a job or the process ends. None turns the thread off. /metrics/ serves them in the
+# Prometheus text format.
+METRICS_FLUSH_INTERVAL = 10
+
+# Seconds browsers and proxies may cache a region preview page (/preview/map/); previews
+# only change with the template, whose hash is part of their ETag
+PREVIEW_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Disk budget of the generated maps in static/maps (analysis/artifacts.py). Above it the
+# maps of the least recently viewed analyses and regions are deleted; they are rendered
+# again when their results are opened. None disables eviction.
+ARTIFACT_MAX_BYTES = 5 * 1024 ** 3
+# Finished jobs check the budget at most this often, in seconds
+ARTIFACT_PRUNE_INTERVAL = 5 * 60
+# Directories written more recently than this many seconds are never evicted
+ARTIFACT_MIN_AGE = 10 * 60
+# Views of the same analysis within this many seconds are recorded once
+ARTIFACT_VIEW_RESOLUTION = 60 * 60
+
+# Generated maps get .gz copies, and .br copies when the brotli package is installed,
+# which /maps/ serves to browsers accepting them (analysis/compression.py)
+MAP_PRECOMPRESS = True
+# Seconds browsers may cache a map file served by /maps/; map file names are unique
+MAP_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Maps load their tiles through the tile proxy (/tiles/<key>/<z>/<x>/<y>.png, analysis/tiles.py),
+# which fetches each tile upstream once and serves it from TILE_CACHE_DIR afterwards.
+# False embeds Earth Engine tile URLs, which stop working when their map ID expires.
+TILE_PROXY = True
+TILE_CACHE_DIR = os.path.join(BASE_DIR, 'tile_cache')
+# Disk budget of the tile cache; least recently used tiles are evicted beyond it
+TILE_CACHE_MAX_BYTES = 1024 ** 3
+# Class fetching tiles the cache does not hold, replaceable by a local stand-in for testing
+TILE_UPSTREAM = 'analysis.tiles.EarthEngineUpstream'
+TILE_UPSTREAM_TIMEOUT = 30
+# Seconds browsers may cache a proxied tile
+TILE_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Zoom levels (lowest, highest) rendered into a tile pyramid per layer when an analysis
+# finishes (analysis/pyramids.py); the tile proxy serves them without going upstream.
+# Off (None) by default, since every build fetches all tiles of the levels from Earth
+# Engine; set e.g. (7, 11) to enable it. `python manage.py build_tile_pyramids` builds
+# missing levels either way.
+TILE_PYRAMID_ZOOMS = None
+# Pyramids are built one analysis at a time on a background thread of the process that ran
+# the job, with one long-lived pool of worker processes fetching the tiles
+# (1 fetches them in the builder thread)
+TILE_PYRAMID_WORKERS = 4
+# Niceness added to the pyramid worker processes so they yield the CPU to requests and jobs
+TILE_PYRAMID_NICENESS = 10
+
+# The tests run against the offline Earth Engine stand-in of the benchmarks (analysis/test_runner.py)
+TEST_RUNNER = 'analysis.test_runner.OfflineTestRunner'